@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import sys
+import time
+import statistics
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+def init_maya():
+    # mayapyから実行した場合はstandaloneを初期化しておく
+    try:
+        import maya.standalone
+    except ImportError:
+        return
+    maya.standalone.initialize(name='python')
+
+def measure(func, repeat:int=5):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def report(name:str, seconds:float, baseline:float=None):
+    line = "{:<40} {:>10.2f} ms".format(name, seconds * 1000)
+    if baseline:
+        line += "  (x{:.1f})".format(baseline / seconds if seconds else float('inf'))
+    print(line)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# alkana_ (英単語 -> カナ変換) の速度比較
+#   mayapy benchmarks/bench_alkana.py [--log-dir <ChatMaya/log>]
+import re
+import json
+import argparse
+from pathlib import Path
+
+from _common import init_maya, measure, report
+
+init_maya()
+
+import alkana
+from chatmaya import voice
+from chatmaya.journal import load_messages
+
+DATA_FILE = Path(__file__).parent / "data" / "answers.jsonl"
+
+def legacy_alkana_(text:str) -> str:
+    # 変更前の実装
+    pattern = r'[a-zA-Z]+'
+    words = re.findall(pattern, text)
+    for w in words:
+        kana = alkana.get_kana(w)
+        if kana:
+            text = re.sub(w, kana, text)
+    return text
+
+def load_corpus(log_dir:Path=None):
+    corpus = []
+    if log_dir:
+        # 実際のセッションログから返答を集める
+        for session_dir in sorted(Path(log_dir).iterdir()):
+            messages = load_messages(session_dir) if session_dir.is_dir() else None
+            corpus += [m["content"] for m in messages or [] if m.get("role") == "assistant"]
+    else:
+        with open(DATA_FILE, encoding='utf-8') as f:
+            corpus = [json.loads(line)["content"] for line in f if line.strip()]
+    return corpus
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--log-dir", type=Path, default=None)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.log_dir)
+    print("{} answers, {} chars".format(len(corpus), sum(len(t) for t in corpus)))
+
+    def run(func):
+        for _ in range(args.repeat):
+            for text in corpus:
+                func(text)
+
+    legacy = measure(lambda: run(legacy_alkana_))
+    report("legacy alkana_", legacy)
+    voice.get_kana.cache_clear()
+    voice.word_to_kana.cache_clear()
+    report("single pass + cache", measure(lambda: run(voice.alkana_)), legacy)
+
+if __name__ == '__main__':
+    main()
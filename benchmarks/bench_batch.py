@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# バッチ実行 (chatmaya.batch) の同時実行数ごとのスループットと再開の確認
+#   mayapy benchmarks/bench_batch.py [--prompts 24] [--concurrency 1 4 8]
+#   スタブのOpenAI API (TTFT 0.5 s, 20 ms/チャンク) にdata/script_prompts.jsonlの質問を送る
+import json
+import argparse
+import tempfile
+from pathlib import Path
+
+from _common import init_maya
+
+init_maya()
+
+import openai
+import fake_openai
+from chatmaya.batch import BatchRunner, BatchPrompt, read_progress
+
+DATA_DIR = Path(__file__).parent / "data"
+
+def load_prompts(count:int):
+    with open(DATA_DIR / "script_prompts.jsonl", encoding='utf-8') as f:
+        questions = [json.loads(line)["prompt"] for line in f if line.strip()]
+    with open(DATA_DIR / "answers.jsonl", encoding='utf-8') as f:
+        answers = [json.loads(line)["content"] for line in f if line.strip()]
+    prompts = [BatchPrompt(i, u"{} ({})".format(questions[i % len(questions)], i), "python") for i in range(count)]
+    return prompts, answers
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--prompts", type=int, default=24)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--ttft", type=float, default=0.5)
+    parser.add_argument("--delay", type=float, default=0.02)
+    args = parser.parse_args()
+
+    prompts, answers = load_prompts(args.prompts)
+    server, url = fake_openai.start_server(ttft=args.ttft, delay=args.delay, chunk_chars=4, text=answers[0])
+    openai.api_base = url
+    openai.api_key = "sk-fake"
+
+    for concurrency in args.concurrency:
+        with tempfile.TemporaryDirectory() as tmp:
+            progress = Path(tmp) / "prompts.progress.jsonl"
+            runner = BatchRunner(Path(tmp) / "log", concurrency=concurrency, progress_path=progress)
+            summary = runner.run(prompts)
+            print("concurrency {:<2} {}".format(concurrency, summary))
+
+            # 途中で止めた場合: 半分を消して再開する
+            with open(progress, encoding='utf-8') as f:
+                lines = f.readlines()
+            with open(progress, 'w', encoding='utf-8') as f:
+                f.writelines(lines[:len(lines) // 2])
+            resumed = BatchRunner(Path(tmp) / "log", concurrency=concurrency, progress_path=progress).run(prompts)
+            print("  resume: {} skipped, {} rerun, {} prompts recorded as done".format(
+                resumed.skipped, resumed.done + resumed.failed, len(read_progress(progress))))
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
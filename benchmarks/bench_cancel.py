@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# 中断してから待機状態に戻るまでの時間 (cancel-to-idle)
+#   mayapy benchmarks/bench_cancel.py
+#   legacy: チャンクを受け取るたびにフラグを確認する (変更前のkeyboard.is_pressedと同じタイミング)
+#   token : CancelTokenで受信中の接続をその場で切る
+import time
+import threading
+import statistics
+
+from _common import init_maya, report
+
+init_maya()
+
+import openai
+import fake_openai
+from chatmaya import openai_utils
+from chatmaya.cancel import CancelToken
+from chatmaya.voice import SynthesisPipeline
+from chatmaya.player import AudioPlayer, NullSink
+from stub_voicevox import make_wav
+
+CANCEL_AFTER = 5 # 受信したチャンク数
+REPEAT = 5
+
+def cancel_stream(server, scenario:dict, use_token:bool) -> float:
+    server.push(**scenario)
+    token = CancelToken()
+    flag = threading.Event()
+    received = threading.Event()
+    done = {}
+
+    def consume():
+        stream = openai_utils.chat_completion_stream(
+            [{"role": "user", "content": "test"}], cancel=token if use_token else None)
+        count = 0
+        for content in stream:
+            if flag.is_set():
+                break
+            count += 1
+            if count == CANCEL_AFTER:
+                received.set()
+        stream.close()
+        done["at"] = time.perf_counter()
+
+    thread = threading.Thread(target=consume)
+    thread.start()
+    received.wait()
+    start = time.perf_counter()
+    flag.set()
+    if use_token:
+        token.cancel()
+    thread.join()
+    return done["at"] - start
+
+def cancel_voice(clear:bool) -> float:
+    # 10文を合成待ちにした状態で中断し、再生が止まるまで
+    wav = make_wav(1.0)
+
+    def synthesize(text):
+        time.sleep(0.1)
+        return wav
+
+    pipeline = SynthesisPipeline(synthesize, workers=2)
+    player = AudioPlayer(sink=NullSink(realtime=True))
+    stop = threading.Event()
+
+    def play():
+        while not stop.is_set():
+            try:
+                player.play(pipeline.output.get(timeout=0.05))
+            except Exception:
+                continue
+
+    thread = threading.Thread(target=play, daemon=True)
+    thread.start()
+    for i in range(10):
+        pipeline.submit("sentence {}".format(i))
+    time.sleep(0.5)
+
+    start = time.perf_counter()
+    if clear:
+        pipeline.clear()
+        player.clear()
+    while not (pipeline.output.empty() and player.is_idle() and pipeline._executor._work_queue.empty()):
+        time.sleep(0.005)
+    seconds = time.perf_counter() - start
+
+    stop.set()
+    thread.join()
+    pipeline.shutdown(wait=False)
+    player.close()
+    return seconds
+
+def main():
+    server, url = fake_openai.start_server()
+    openai.api_base = url
+    openai.api_key = "sk-fake"
+    openai_utils.STALL_TIMEOUT = 5
+
+    scenarios = [
+        ("streaming (50 ms/chunk)", {"delay": 0.05}),
+        ("stalled stream (3 s)", {"delay": 0.01, "stall_after": CANCEL_AFTER, "stall": 3.0}),
+    ]
+    for name, scenario in scenarios:
+        legacy = statistics.median(cancel_stream(server, scenario, False) for _ in range(REPEAT))
+        token = statistics.median(cancel_stream(server, scenario, True) for _ in range(REPEAT))
+        report("legacy: " + name, legacy)
+        report("token : " + name, token, legacy)
+
+    legacy = cancel_voice(False)
+    drained = cancel_voice(True)
+    report("legacy: voice (10 sentences queued)", legacy)
+    report("drain : voice (10 sentences queued)", drained, legacy)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# チャット欄の描画コスト (行数を増やしても一定か)
+#   mayapy benchmarks/bench_chat_view.py [--rows 100 1000 3000]
+#   legacy: QStringListModel + 折り返しのQListView
+#   cached: ChatModel + ChatView (行ごとにレイアウトをキャッシュ)
+#   stream: 最終行に差分を足しながら描画する1回あたりの時間
+#   scroll: スクロールして再描画する1回あたりの時間
+import os
+import time
+import random
+import argparse
+
+from _common import init_maya, report
+
+init_maya()
+
+from PySide2 import QtWidgets, QtCore
+
+from chatmaya.chat_view import ChatModel, ChatView
+
+STREAM_FLUSHES = 60
+SCROLL_STEPS = 40
+
+def make_rows(rows:int):
+    rng = random.Random(0)
+    texts = []
+    for i in range(rows):
+        if i % 2 == 0:
+            texts.append(u"選択したオブジェクトを原点に移動して、名前に接頭辞を付けてください。" * rng.randint(1, 4))
+        else:
+            code = "\n".join("    cmds.xform(obj, translation=({0}, {0}, {0}), worldSpace=True)".format(n)
+                             for n in range(rng.randint(10, 120)))
+            texts.append(u"以下のスクリプトで実行できます。\n```python\nimport maya.cmds as cmds\n\n"
+                         u"for obj in cmds.ls(selection=True):\n" + code + u"\n```\n選択したオブジェクトが移動します。")
+    return texts
+
+def make_view(cached:bool):
+    if cached:
+        model = ChatModel()
+        view = ChatView()
+    else:
+        model = QtCore.QStringListModel()
+        view = QtWidgets.QListView()
+        view.setWordWrap(True)
+        view.setAlternatingRowColors(True)
+        view.setStyleSheet("""
+            QListView::item { border-bottom: 0px solid; padding: 5px; }
+            QListView::item { background-color: #27272e; }
+            QListView::item:alternate { background-color: #363842; }
+            """)
+    view.setModel(model)
+    view.resize(600, 500)
+    view.show()
+    return model, view
+
+def run(app, texts, cached:bool):
+    model, view = make_view(cached)
+
+    start = time.perf_counter()
+    model.setStringList(texts)
+    view.scrollToBottom()
+    app.processEvents()
+    view.viewport().repaint()
+    load = time.perf_counter() - start
+
+    # 最後の返答をストリーミングで受け取る
+    answer = texts[-1]
+    model.insertRow(model.rowCount())
+    index = model.index(model.rowCount() - 1)
+    if cached:
+        view.begin_stream()
+    start = time.perf_counter()
+    for i in range(1, STREAM_FLUSHES + 1):
+        model.setData(index, answer[:len(answer) * i // STREAM_FLUSHES])
+        view.scrollToBottom()
+        app.processEvents()
+        view.viewport().repaint()
+    if cached:
+        view.end_stream()
+        app.processEvents()
+    stream = (time.perf_counter() - start) / STREAM_FLUSHES
+
+    bar = view.verticalScrollBar()
+    start = time.perf_counter()
+    for i in range(SCROLL_STEPS):
+        bar.setValue(bar.maximum() * i // SCROLL_STEPS)
+        app.processEvents()
+        view.viewport().repaint()
+    scroll = (time.perf_counter() - start) / SCROLL_STEPS
+
+    view.close()
+    view.deleteLater()
+    app.processEvents()
+    return load, stream, scroll
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 3000])
+    args = parser.parse_args()
+
+    if QtWidgets.QApplication.instance() is None:
+        os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+
+    for rows in args.rows:
+        texts = make_rows(rows)
+        legacy = run(app, texts, False)
+        cached = run(app, texts, True)
+        print("{} rows".format(rows))
+        for name, before, after in zip(("load", "stream (per flush)", "scroll (per frame)"), legacy, cached):
+            report("  {} legacy".format(name), before)
+            report("  {} cached".format(name), after, before)
+
+if __name__ == '__main__':
+    main()
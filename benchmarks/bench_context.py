@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# 長いセッションで1リクエストごとに送るプロンプトの比較
+#   mayapy benchmarks/bench_context.py [--turns 40] [--model gpt-3.5-turbo gpt-4]
+#   legacy : 合計が2500トークン以下になるまで古いメッセージを履歴から削る
+#   context: モデルのコンテキスト長まで、古い返答のコードを参照に置き換え古いやり取りを要約して送る
+import time
+import random
+import argparse
+import statistics
+
+from _common import init_maya, report
+
+init_maya()
+
+from chatmaya.history import MessageHistory
+from chatmaya.context import ContextManager, QUESTION_PATTERN
+from chatmaya.prompts import SYSTEM_TEMPLATE_PY, USER_TEMPLATE, FIX_TEMPLATE
+
+MAX_TOKENS = 2500
+COMMANDS = ["polyCube", "polySphere", "move", "rotate", "setAttr", "parent", "group", "duplicate", "xform", "select"]
+
+def make_requests(turns:int, seed:int=0):
+    # セッションのメッセージを順に返す。2割の返答はエラーになり修正を依頼する
+    rng = random.Random(seed)
+    for turn in range(turns):
+        question = u"質問{}: 選択したオブジェクトを{}して、{}してください。".format(
+            turn, rng.choice(COMMANDS), rng.choice(COMMANDS))
+        yield {"role": "user", "content": USER_TEMPLATE.format(script_type="Maya Python", questions=question)}
+        for attempt in range(3):
+            code = "\n".join("    cmds.{}(obj, {})".format(rng.choice(COMMANDS), n) for n in range(rng.randint(10, 60)))
+            yield {"role": "assistant", "content": u"以下のスクリプトで実行できます。\n```python\nimport maya.cmds as cmds\n\n"
+                   u"for obj in cmds.ls(selection=True):\n" + code + u"\n```\n選択したオブジェクトに適用されます。"}
+            if rng.random() > 0.2:
+                break
+            error = u"# Error: Traceback (most recent call last):\n#   File \"<maya console>\", line {}\n# NameError: name 'obj{}' is not defined".format(
+                rng.randint(1, 60), turn)
+            yield {"role": "user", "content": FIX_TEMPLATE.format(error=error)}
+
+def questions_in(messages) -> int:
+    # 送信内容に残っている過去の質問の数 (要約の行も含む)
+    count = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if message["role"] == "user" and QUESTION_PATTERN.match(content):
+            count += 1
+        elif message["role"] == "system":
+            count += sum(1 for line in content.splitlines() if line.startswith("Q: "))
+    return count
+
+def trim(history:MessageHistory, max_tokens:int=MAX_TOKENS):
+    # 変更前の送信処理: systemメッセージと最新のメッセージを残して古い順に削る
+    while history.total_tokens > max_tokens and len(history) > 2:
+        history.pop(1)
+
+def run(turns:int, model:str, use_context:bool):
+    history = MessageHistory([{"role": "system", "content": SYSTEM_TEMPLATE_PY}])
+    manager = ContextManager()
+    tokens, questions, seconds = [], [], []
+    asked = 0
+    for message in make_requests(turns):
+        history.append(message)
+        if message["role"] != "user":
+            continue
+        asked += QUESTION_PATTERN.match(message["content"]) is not None
+        start = time.perf_counter()
+        if use_context:
+            context = manager.build(history, model)
+            request, prompt_tokens = context.messages, context.prompt_tokens
+        else:
+            trim(history)
+            request, prompt_tokens = list(history), history.total_tokens
+        seconds.append(time.perf_counter() - start)
+        tokens.append(prompt_tokens)
+        questions.append(questions_in(request) / asked)
+    return tokens, questions, seconds
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, default=40)
+    parser.add_argument("--model", nargs="+", default=["gpt-3.5-turbo", "gpt-4"])
+    args = parser.parse_args()
+
+    for model in args.model:
+        print("{} ({} turns)".format(model, args.turns))
+        for name, use_context in (("legacy ", False), ("context", True)):
+            tokens, questions, seconds = run(args.turns, model, use_context)
+            print("  {}  prompt tokens mean {:.0f} / max {}  total {}  questions kept {:.0%}".format(
+                name, statistics.mean(tokens), max(tokens), sum(tokens), statistics.mean(questions)))
+            report("    build (per request)", statistics.mean(seconds))
+
+if __name__ == '__main__':
+    main()
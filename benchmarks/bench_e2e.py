@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+# Maya/APIキー/VOICEVOX無しで、ChatMayaのウィンドウから送信して読み上げ終わるまでを計測する
+#   python benchmarks/bench_e2e.py [--session basic fix long] [--repeat 3]
+#   python benchmarks/bench_e2e.py --from-log <LOG_DIR/session_...>   過去のセッションの質問と返答を再生する
+#   python benchmarks/bench_e2e.py --save-baseline base.json  /  --baseline base.json [--tolerance 0.2]
+#     reply       : 送信から返答を受け取り終わるまで
+#     first audio : 送信から最初の音声が出力されるまで
+#     speech done : 送信から読み上げが終わるまで
+#     blocked     : メインスレッドが1フレーム(16 ms)以上止まった時間の合計 / max stall: 最長の停止
+#   maya.cmds/OpenMayaUIはstub_maya、APIはfake_openai、VOICEVOXはstub_voicevoxで置き換える
+#   (mayapyでもmaya.standaloneは初期化しない。PySide2が必要)
+#   CHATMAYA_WARMUP=0 で起動直後の準備無しの送信を計測する
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+from _common import report
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PySide2 import QtWidgets, QtCore
+
+import stub_maya
+import fake_openai
+import stub_voicevox
+
+DATA_DIR = Path(__file__).parent / "data"
+SESSIONS_FILE = DATA_DIR / "e2e_sessions.json"
+ANSWERS_FILE = DATA_DIR / "answers.jsonl"
+
+TICK = 5 # ms メインスレッドの停止を測る間隔
+FRAME = 0.016
+IDLE_CONFIRM = 0.1 # 読み上げの終了とみなすまで待つ秒数
+TURN_TIMEOUT = 60.0
+METRICS = ("reply", "first audio", "speech done", "blocked", "max stall")
+MIN_REGRESSION = 0.005 # これ未満の差は誤差とみなす
+
+def load_sessions(names):
+    with open(SESSIONS_FILE, encoding='utf-8') as f:
+        sessions = json.load(f)
+    with open(ANSWERS_FILE, encoding='utf-8') as f:
+        answers = [json.loads(line)["content"] for line in f if line.strip()]
+    result = {}
+    for name in names:
+        result[name] = [{"question": turn.get("question"), "fix": turn.get("fix"), "answer": answers[turn["answer"]]}
+                        for turn in sessions[name]]
+    return result
+
+def load_log_session(session_dir:Path):
+    # 記録された質問/エラーと返答をそのまま再生する
+    from chatmaya.journal import load_messages
+    from chatmaya.context import QUESTION_PATTERN, ERROR_PATTERN
+
+    turns = []
+    pending = None
+    for message in load_messages(session_dir) or []:
+        content = message.get("content") or ""
+        if message.get("role") == "user":
+            fix = ERROR_PATTERN.match(content)
+            question = QUESTION_PATTERN.match(content)
+            pending = {"question": None if fix else (question.group(1) if question else content),
+                       "fix": fix.group(1) if fix else None}
+        elif message.get("role") == "assistant" and pending is not None:
+            turns.append(dict(pending, answer=content))
+            pending = None
+    return {Path(session_dir).name: turns}
+
+class FirstAudioSink(object):
+    # 最初に書き込まれた時刻を記録する (再生は実時間で待つ)
+    def __init__(self):
+        from chatmaya.player import NullSink
+        self.sink = NullSink(realtime=True)
+        self.first_write = None
+
+    def open(self, fmt):
+        self.sink.open(fmt)
+
+    def write(self, frames:bytes):
+        if self.first_write is None:
+            self.first_write = time.perf_counter()
+        self.sink.write(frames)
+
+    def close(self):
+        self.sink.close()
+
+class Harness(object):
+
+    def __init__(self, app, window, sink):
+        self.app = app
+        self.window = window
+        self.sink = sink
+        self.ticks = []
+
+    def run_until(self, predicate, timeout:float=TURN_TIMEOUT) -> float:
+        # イベントループを回しながら条件を満たした時刻を返す (タイマーの間隔でメインスレッドの停止を測る)
+        loop = QtCore.QEventLoop()
+        deadline = time.perf_counter() + timeout
+        state = {"at": None}
+
+        def tick():
+            now = time.perf_counter()
+            self.ticks.append(now)
+            if predicate():
+                state["at"] = now
+                loop.quit()
+            elif now > deadline:
+                loop.quit()
+
+        timer = QtCore.QTimer()
+        timer.setInterval(TICK)
+        timer.timeout.connect(tick)
+        timer.start()
+        tick()
+        if state["at"] is None:
+            loop.exec_()
+        timer.stop()
+        if state["at"] is None:
+            raise RuntimeError("timed out")
+        return state["at"]
+
+    def speech_done(self) -> bool:
+        window = self.window
+        return (window.q_voice_synthesis.unfinished_tasks == 0
+                and window.q_voice_play._next >= window.voice_pipeline._seq
+                and window.audio_player.is_idle())
+
+    def wait_speech(self) -> float:
+        # 取り出してから再生を始めるまでの一瞬を終了と誤認しないよう、しばらく続いたら終了とする
+        while True:
+            at = self.run_until(self.speech_done)
+            self.run_until(lambda: not self.speech_done() or time.perf_counter() - at > IDLE_CONFIRM)
+            if self.speech_done():
+                return at
+
+    def blocking(self, start:float, end:float):
+        ticks = [start] + [t for t in self.ticks if start < t <= end]
+        gaps = [b - a for a, b in zip(ticks, ticks[1:])] or [0.0]
+        return sum(gap - FRAME for gap in gaps if gap > FRAME), max(gaps)
+
+    def turn(self, server, turn, timing) -> dict:
+        window = self.window
+        server.push(text=turn["answer"], **timing)
+        self.sink.first_write = None
+        self.ticks = []
+
+        start = time.perf_counter()
+        if turn["fix"]:
+            window.last_error = turn["fix"]
+            window.send_fix_message()
+        else:
+            window.user_input.setPlainText(turn["question"])
+            window.send_message()
+        reply = self.run_until(lambda: not window.is_generating())
+        done = self.wait_speech()
+        blocked, stall = self.blocking(start, done)
+        first = self.sink.first_write
+        return {
+            "reply": reply - start,
+            "first audio": (first - start) if first else float('nan'),
+            "speech done": done - start,
+            "blocked": blocked,
+            "max stall": stall,
+        }
+
+def summarize(results) -> dict:
+    summary = {}
+    for metric in METRICS:
+        values = sorted(r[metric] for r in results if r[metric] == r[metric])
+        if values:
+            summary[metric] = {"median": statistics.median(values),
+                               "p95": values[min(len(values) - 1, int(round(0.95 * (len(values) - 1))))]}
+    return summary
+
+def compare(summary:dict, baseline:dict, tolerance:float) -> bool:
+    regressed = False
+    print("{:<40} {:>10} {:>10}".format("vs baseline (median)", "baseline", "current"))
+    for metric in METRICS:
+        if metric not in summary or metric not in baseline:
+            continue
+        before, after = baseline[metric]["median"], summary[metric]["median"]
+        mark = ""
+        if after > before * (1 + tolerance) and after - before > MIN_REGRESSION:
+            mark = "  REGRESSION"
+            regressed = True
+        print("{:<40} {:>7.1f} ms {:>7.1f} ms{}".format("  " + metric, before * 1000, after * 1000, mark))
+    return not regressed
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--session", nargs="+", default=["basic", "fix", "long"])
+    parser.add_argument("--from-log", type=Path, nargs="+")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--ttft", type=float, default=0.4)
+    parser.add_argument("--delay", type=float, default=0.02, help="seconds between SSE chunks")
+    parser.add_argument("--chunk-chars", type=int, default=3)
+    parser.add_argument("--query-latency", type=float, default=0.05)
+    parser.add_argument("--synthesis-latency", type=float, default=0.2)
+    parser.add_argument("--save-baseline", type=Path)
+    parser.add_argument("--baseline", type=Path)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    tmp = tempfile.TemporaryDirectory()
+    stub_maya.install(Path(tmp.name))
+
+    server, api_url = fake_openai.start_server()
+    voice_server, voice_url = stub_voicevox.start_server(
+        query_latency=args.query_latency, synthesis_latency=args.synthesis_latency)
+
+    import openai
+    from chatmaya import core, voice
+    from chatmaya.player import AudioPlayer
+    from chatmaya.warmup import ENABLED as WARMUP_ENABLED
+
+    openai.api_base = api_url
+    openai.api_key = "sk-fake"
+    voice.BASE_URL = voice_url
+    sessions = load_sessions(args.session) if not args.from_log else {}
+    for session_dir in args.from_log or []:
+        sessions.update(load_log_session(session_dir))
+
+    timing = {"ttft": args.ttft, "delay": args.delay, "chunk_chars": args.chunk_chars}
+    results = []
+    for name, turns in sessions.items():
+        for _ in range(args.repeat):
+            window = core.showUI()
+            sink = FirstAudioSink()
+            player, window.audio_player = window.audio_player, AudioPlayer(sink=sink)
+            player.close()
+            harness = Harness(app, window, sink)
+            if WARMUP_ENABLED:
+                # 送信はウィンドウを開いて準備が終わってから
+                harness.run_until(lambda: len(window.warmup.results) == len(window.warmup.steps()))
+
+            session = [harness.turn(server, turn, timing) for turn in turns]
+            results += session
+            window.close()
+            window.deleteLater()
+            app.processEvents()
+            print("{} ({} turns)".format(name, len(turns)))
+            for metric in METRICS:
+                report("  " + metric, statistics.median(r[metric] for r in session))
+
+    summary = summarize(results)
+    print("all ({} turns)".format(len(results)))
+    for metric, values in summary.items():
+        report("  {} p95".format(metric), values["p95"])
+
+    ok = True
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            ok = compare(summary, json.load(f)["summary"], args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({"config": vars(args), "summary": summary}, f, indent=4, default=str)
+        print("baseline saved to {}".format(args.save_baseline))
+
+    server.shutdown()
+    voice_server.shutdown()
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
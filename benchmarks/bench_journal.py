@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# セッションログの書き込み量と時間の比較
+#   mayapy benchmarks/bench_journal.py [--turns 50 200]
+#   legacy : 返答のたびにmessages.json全体をindent=4で書き直す
+#   journal: 変更をmessages.jsonlに追記する
+import json
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+from _common import init_maya, report
+
+init_maya()
+
+from chatmaya.history import MessageHistory
+from chatmaya.journal import SessionJournal, read_journal
+
+SYSTEM = {"role": "system", "content": "You are a Maya Python assistant. " * 20}
+
+def make_turns(turns:int):
+    rng = random.Random(0)
+    result = []
+    for i in range(turns):
+        user = {"role": "user", "content": u"質問{} ".format(i) + "select objects and move them " * rng.randint(3, 15)}
+        answer = {"role": "assistant", "content": u"回答です。\n```python\n" + "cmds.polyCube()\n" * rng.randint(20, 80) + "```"}
+        result.append((user, answer, rng.random() < 0.1))
+    return result
+
+def run(turns, use_journal:bool, directory:Path):
+    # 1ターン: 質問を追加 -> 返答を追加 -> ログ出力 (10%の確率で最後のやり取りを削除)
+    messages = MessageHistory([SYSTEM])
+    messages.count = lambda message: 0 # tokenizerは計測に含めない
+    log_file = directory / "messages.json"
+    written = 0
+    journal = None
+    if use_journal:
+        journal = SessionJournal(directory)
+        messages.add_listener(journal.record)
+
+    start = time.perf_counter()
+    for user, answer, delete in turns:
+        messages.append(user)
+        messages.append(answer)
+        if delete:
+            messages.pop(-1)
+            messages.pop(-1)
+        if journal is not None:
+            journal.sync()
+        else:
+            with open(log_file, 'w', encoding='utf-8-sig') as f:
+                json.dump(messages, f, indent=4, ensure_ascii=False)
+            written += log_file.stat().st_size
+    seconds = time.perf_counter() - start
+
+    if journal is not None:
+        journal.close()
+        written = journal.bytes_written
+        assert read_journal(journal.path) == list(messages)
+    return seconds, written
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--turns", type=int, nargs="+", default=[50, 200])
+    args = parser.parse_args()
+
+    for turns in args.turns:
+        data = make_turns(turns)
+        with tempfile.TemporaryDirectory() as tmp:
+            legacy, legacy_bytes = run(data, False, Path(tmp))
+        with tempfile.TemporaryDirectory() as tmp:
+            journal, journal_bytes = run(data, True, Path(tmp))
+        print("{} turns".format(turns))
+        report("  legacy  ({:.1f} MB written)".format(legacy_bytes / 1e6), legacy)
+        report("  journal ({:.1f} MB written)".format(journal_bytes / 1e6), journal, legacy)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+# 計測 (MetricsRegistry) のオーバーヘッドと、スタブVOICEVOXでの記録内容の確認
+#   mayapy benchmarks/bench_metrics.py [--calls 100000] [--threads 4]
+#   observe : 1回の記録にかかる時間 (リスナー無し / metrics.jsonlへの書き出しあり / 複数スレッド)
+#   pipeline: 設定した遅延のスタブVOICEVOXで合成し、記録されたaudio_query/synthesisの時間を表示する
+#   windows : 2つのウィンドウに相当するパイプラインを同時に動かし、記録がそれぞれの集計にだけ入ることを確認する
+import sys
+import json
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+from _common import init_maya, report
+from stub_voicevox import start_server
+
+init_maya()
+
+from chatmaya import voice
+from chatmaya.metrics import MetricsRegistry, MetricsWriter, METRICS, AUDIO_QUERY, SYNTHESIS, use_metrics
+
+SENTENCES = [
+    u"選択したオブジェクトを原点に移動するスクリプトです。",
+    u"まず選択中のオブジェクトを取得します。",
+    u"次にそれぞれのトランスフォームを0に設定します。",
+    u"以上です。",
+]
+
+def per_call(registry:MetricsRegistry, calls:int, threads:int=1) -> float:
+    def work():
+        for i in range(calls // threads):
+            registry.observe("bench", i)
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / calls
+
+def report_us(name:str, seconds:float):
+    print("{:<40} {:>10.2f} us".format(name, seconds * 1000000))
+
+def bench_overhead(calls:int, threads:int):
+    report_us("observe (no listener)", per_call(MetricsRegistry(), calls))
+    with tempfile.TemporaryDirectory() as tmp:
+        registry = MetricsRegistry()
+        writer = MetricsWriter(Path(tmp), registry)
+        report_us("observe (writer)", per_call(registry, calls))
+        start = time.perf_counter()
+        writer.close()
+        report("  flush {} events".format(calls), time.perf_counter() - start)
+        registry = MetricsRegistry()
+        report_us("observe ({} threads)".format(threads), per_call(registry, calls, threads))
+        summary = registry.summary()
+        start = time.perf_counter()
+        registry.summary()
+        report("summary (panel refresh)", time.perf_counter() - start)
+    assert summary[0].count == calls // threads * threads
+
+def bench_pipeline(query_latency:float, synthesis_latency:float):
+    server, url = start_server(query_latency=query_latency, synthesis_latency=synthesis_latency)
+    voice.BASE_URL = url
+    with tempfile.TemporaryDirectory() as tmp:
+        METRICS.reset()
+        writer = MetricsWriter(Path(tmp))
+        pipeline = voice.SynthesisPipeline(voice.text2voice, workers=2)
+        for text in SENTENCES:
+            pipeline.submit(text)
+        for _ in SENTENCES:
+            pipeline.output.get(timeout=30)
+        pipeline.shutdown()
+        writer.close()
+        with open(writer.path, encoding='utf-8') as f:
+            lines = [json.loads(line) for line in f]
+    server.shutdown()
+
+    print("stub VOICEVOX: audio_query {:.0f} ms, synthesis {:.0f} ms + per char".format(
+        query_latency * 1000, synthesis_latency * 1000))
+    for metric in METRICS.summary():
+        if metric.name in (AUDIO_QUERY, SYNTHESIS):
+            print("  {:<24} n={}  p50 {:.0f} ms  p95 {:.0f} ms".format(metric.name, metric.count, metric.p50, metric.p95))
+    print("  metrics.jsonl: {} lines".format(len(lines)))
+
+def check_windows() -> bool:
+    # ChatMaya.synthesize_voice と同じく、合成をウィンドウの集計に割り当てて呼ぶ
+    server, url = start_server(query_latency=0.01, synthesis_latency=0.01)
+    voice.BASE_URL = url
+    METRICS.reset()
+    registries = [MetricsRegistry(), MetricsRegistry()]
+    pipelines = []
+    for registry in registries:
+        def synthesize(text, registry=registry):
+            with use_metrics(registry):
+                return voice.text2voice(text)
+        pipelines.append(voice.SynthesisPipeline(synthesize, workers=2))
+    for i, pipeline in enumerate(pipelines):
+        for text in SENTENCES[:i + 2]:
+            pipeline.submit(text)
+    for i, pipeline in enumerate(pipelines):
+        for _ in SENTENCES[:i + 2]:
+            pipeline.output.get(timeout=30)
+        pipeline.shutdown()
+    server.shutdown()
+
+    counts = [{m.name: m.count for m in registry.summary()}.get(SYNTHESIS, 0) for registry in registries]
+    ok = counts == [2, 3] and not METRICS.summary()
+    print("{:<4} windows: synthesis counts {} (expected [2, 3]), shared registry {} metrics".format(
+        "PASS" if ok else "FAIL", counts, len(METRICS.summary())))
+    return ok
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=100000)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--query-latency", type=float, default=0.05)
+    parser.add_argument("--synthesis-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    bench_overhead(args.calls, args.threads)
+    bench_pipeline(args.query_latency, args.synthesis_latency)
+    if not check_windows():
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# AudioPlayerの途切れ(underrun)の数え方を確認する
+#   mayapy benchmarks/bench_player.py
+#   再生中に次の音声が間に合わなかった場合だけを数え、停止/次の質問でclear()した後の再生は数えない
+import sys
+import time
+
+from _common import init_maya
+from stub_voicevox import make_wav
+
+init_maya()
+
+from chatmaya.player import AudioPlayer, NullSink
+
+SENTENCE = make_wav(0.2)
+
+def drained(player:AudioPlayer):
+    # 再生し終わってから次の文が届く
+    player.play(SENTENCE)
+    player.wait_idle(5)
+    time.sleep(0.1)
+    player.play(SENTENCE)
+
+def cleared(player:AudioPlayer):
+    # 再生中に停止し、すぐ次の返答の音声が届く
+    player.play(SENTENCE)
+    time.sleep(0.05)
+    player.clear()
+    player.wait_idle(5)
+    time.sleep(0.1)
+    player.play(SENTENCE)
+
+def cleared_then_drained(player:AudioPlayer):
+    # 停止後の返答の途中で途切れた場合は数える
+    cleared(player)
+    player.wait_idle(5)
+    time.sleep(0.1)
+    player.play(SENTENCE)
+
+CASES = [
+    ("drained then next sentence", drained, 1),
+    ("clear then next answer", cleared, 0),
+    ("clear, next answer, then drained", cleared_then_drained, 1),
+]
+
+def check(name:str, scenario, expect_underruns:int) -> bool:
+    player = AudioPlayer(NullSink(realtime=True))
+    try:
+        scenario(player)
+        player.wait_idle(5)
+    finally:
+        player.close()
+    ok = player.underruns == expect_underruns
+    print("{:<4} {:<40} underruns={} (expected {})".format(
+        "PASS" if ok else "FAIL", name, player.underruns, expect_underruns))
+    return ok
+
+def main():
+    results = [check(*case) for case in CASES]
+    print("{}/{} passed".format(sum(results), len(results)))
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == '__main__':
+    main()
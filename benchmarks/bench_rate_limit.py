@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# 複数のプロセス(ウィンドウ)から同じAPIキーで送った場合の RateLimitError の数と全体の時間
+#   mayapy benchmarks/bench_rate_limit.py [--processes 3] [--threads 2] [--requests 8] [--rpm 60] [--tpm-requests 30]
+#   スタブのOpenAI APIはRPM/TPMのトークンバケットで制限し、超えたら429とx-ratelimit-*ヘッダを返す
+#     legacy    : RateSchedulerなし (429を受けてから指数バックオフでリトライ)
+#     local     : プロセスごとのRateScheduler (状態ファイルを共有しない)
+#     scheduler : 状態ファイルを共有するRateSchedulerで送信前に待つ
+import time
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+from typing import Optional
+
+from _common import init_maya
+
+init_maya()
+
+import fake_openai
+
+REPLY = u"立方体を作成します。\n```python\nimport maya.cmds as cmds\ncmds.polyCube()\n```"
+
+class LimitedServer(fake_openai.FakeOpenAIServer):
+    # 1分で満杯に戻るバケットでRPM/TPMを制限する (APIと同じく受け付け時にプロンプト+max_tokensを数える)
+
+    def __init__(self, address, handler, default, rpm:int, tpm:int):
+        super(LimitedServer, self).__init__(address, handler, default)
+        from chatmaya.openai_utils import num_tokens_from_messages
+        self.count_prompt = num_tokens_from_messages
+        self.rpm, self.tpm = rpm, tpm
+        self.requests_left, self.tokens_left = float(rpm), float(tpm)
+        self.updated = time.time()
+        self.accepted = 0
+        self.limited = 0
+
+    def next_scenario(self, request:dict) -> dict:
+        with self._lock:
+            now = time.time()
+            elapsed, self.updated = now - self.updated, now
+            self.requests_left = min(self.rpm, self.requests_left + elapsed * self.rpm / 60)
+            self.tokens_left = min(self.tpm, self.tokens_left + elapsed * self.tpm / 60)
+            tokens = self.count_prompt(request["messages"], request["model"]) + (request.get("max_tokens") or 0)
+            limited = self.requests_left < 1 or self.tokens_left < tokens
+            if not limited:
+                self.requests_left -= 1
+                self.tokens_left -= tokens
+                self.accepted += 1
+            else:
+                self.limited += 1
+            headers = {
+                "x-ratelimit-limit-requests": self.rpm,
+                "x-ratelimit-limit-tokens": self.tpm,
+                "x-ratelimit-remaining-requests": int(max(0, self.requests_left)),
+                "x-ratelimit-remaining-tokens": int(max(0, self.tokens_left)),
+                "x-ratelimit-reset-requests": "{:.3f}s".format(max(0, 1 - self.requests_left) * 60 / self.rpm),
+                "x-ratelimit-reset-tokens": "{:.3f}s".format(max(0, tokens - self.tokens_left) * 60 / self.tpm),
+            }
+            return dict(self.default, status=429 if limited else 200, headers=headers)
+
+def worker(url:str, state:Optional[str], threads:int, count:int, results):
+    # 1つのMaya (ウィンドウ) に相当するプロセス
+    import openai
+    from chatmaya import openai_utils
+    from chatmaya.rate_limit import RateScheduler, set_rate_scheduler
+
+    openai.api_base = url
+    openai.api_key = "sk-fake"
+    if state is not None:
+        set_rate_scheduler(RateScheduler(Path(state) if state else None))
+
+    def send(thread:int):
+        for i in range(count):
+            messages = [{"role": "user", "content": u"ボックスを{}個作成してください。 ({}-{})".format(i + 1, thread, i)}]
+            start = time.perf_counter()
+            try:
+                text = "".join(c for c in openai_utils.chat_completion_stream(messages) if c is not openai_utils.STREAM_RESET)
+                results.put((True, time.perf_counter() - start, len(text)))
+            except Exception as e:
+                results.put((False, time.perf_counter() - start, type(e).__name__))
+
+    pool = [threading.Thread(target=send, args=(t,)) for t in range(threads)]
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+
+def run(mode:str, args) -> dict:
+    server = LimitedServer(("127.0.0.1", 0), fake_openai.FakeOpenAIHandler,
+                           {"text": REPLY, "ttft": args.ttft, "chunk_chars": 8}, args.rpm, 0)
+    prompt_tokens = server.count_prompt([{"role": "user", "content": u"ボックスを1個作成してください。 (0-0)"}], "gpt-3.5-turbo")
+    server.tpm = prompt_tokens * args.tpm_requests
+    server.tokens_left = float(server.tpm)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/v1".format(server.server_address[1])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        state = {"legacy": None, "local": "", "scheduler": str(Path(tmp) / "rate_limit.json")}[mode]
+        results = multiprocessing.Queue()
+        start = time.perf_counter()
+        processes = [multiprocessing.Process(target=worker, args=(url, state, args.threads, args.requests, results))
+                     for _ in range(args.processes)]
+        for p in processes:
+            p.start()
+        total = args.processes * args.threads * args.requests
+        items = [results.get() for _ in range(total)]
+        for p in processes:
+            p.join()
+        seconds = time.perf_counter() - start
+    server.shutdown()
+
+    ok = [seconds for success, seconds, _ in items if success]
+    return {
+        "ok": len(ok),
+        "failed": total - len(ok),
+        "429": server.limited,
+        "seconds": seconds,
+        "max latency": max(ok) if ok else float('nan'),
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--processes", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=8, help="requests per thread")
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--tpm-requests", type=int, default=30, help="TPM limit expressed in requests of the benchmark prompt")
+    parser.add_argument("--ttft", type=float, default=0.1)
+    parser.add_argument("--mode", nargs="+", default=["legacy", "local", "scheduler"])
+    args = parser.parse_args()
+
+    total = args.processes * args.threads * args.requests
+    # バケットが空になった後は1分あたりの上限の速さでしか送れない
+    ideal = max(0, total - min(args.rpm, args.tpm_requests)) * 60.0 / min(args.rpm, args.tpm_requests)
+    print("{} processes x {} threads x {} requests, {} RPM / {} requests-worth TPM (ideal {:.1f}s)".format(
+        args.processes, args.threads, args.requests, args.rpm, args.tpm_requests, ideal))
+    for mode in args.mode:
+        r = run(mode, args)
+        print("{:<10} {:>3} ok {:>3} failed {:>4} x 429  {:>6.1f}s total  {:>6.1f}s max latency".format(
+            mode, r["ok"], r["failed"], r["429"], r["seconds"], r["max latency"]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# 実行に成功したスクリプトの検索と、例として差し込んだ場合の効果
+#   mayapy benchmarks/bench_retrieval.py
+#     閾値ごとの検索の精度(hit@k)/差し込むトークン数と検索時間 (APIは使わない)
+#   mayapy benchmarks/bench_retrieval.py --live
+#     実際にAPIで生成してMaya上で実行し、Fix Errorの往復回数と送信したプロンプトのトークン数を比較
+#     (OPENAI_API_KEY が必要)
+import json
+import random
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+from _common import init_maya, measure, report
+
+init_maya()
+
+from chatmaya.retrieval import ScriptMemory, format_examples, TOP_K, MIN_SCORE
+from chatmaya.openai_utils import num_tokens_for_model, num_tokens_from_message
+from chatmaya.history import MessageHistory
+from chatmaya.prompts import SYSTEM_TEMPLATE_PY, USER_TEMPLATE, FIX_TEMPLATE
+
+DATA_FILE = Path(__file__).parent / "data" / "script_prompts.jsonl"
+MAX_FIX = 3
+
+NOISE_PREFIXES = [u"選択した", u"シーン内の", u"全ての", u"選んだ", ""]
+NOISE_TARGETS = [u"ジョイント", u"カーブ", u"ライト", u"ブレンドシェイプ", u"コンストレイント", u"UV", u"ディスプレイレイヤー", u"参照"]
+NOISE_ATTRS = [u"表示", u"名前", u"接続", u"設定", u"ウェイト", u"一覧"]
+NOISE_COMMANDS = [(u"リセット", "setAttr"), (u"コピー", "duplicate"), (u"確認", "listConnections"),
+                  (u"削除", "delete"), (u"出力", "ls"), (u"接続", "connectAttr"), (u"変更", "rename")]
+
+def load_data():
+    with open(DATA_FILE, encoding='utf-8') as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    seeds = [r for r in records if r.get("code")]
+    queries = [r for r in records if not r.get("code")]
+    return seeds, queries
+
+def build_memory(directory:Path, seeds, noise:int=0) -> ScriptMemory:
+    memory = ScriptMemory(directory / "script_memory.jsonl")
+    for seed in seeds:
+        memory.add(seed["prompt"], seed["code"], seed["script_type"])
+    # 無関係な例 (日本語の質問の言い回しはそろえ、対象と操作だけ変える)
+    rng = random.Random(0)
+    for i in range(noise):
+        target, command = rng.choice(NOISE_TARGETS), rng.choice(NOISE_COMMANDS)
+        question = u"{}{}の{}を{}して".format(rng.choice(NOISE_PREFIXES), target, rng.choice(NOISE_ATTRS), command[0])
+        code = "\n".join("cmds.{}('{}{}')".format(command[1], target, rng.randint(0, 999)) for _ in range(rng.randint(3, 15)))
+        memory.add(question, "import maya.cmds as cmds\n\n" + code, "python")
+    return memory
+
+def offline(args):
+    seeds, queries = load_data()
+    groups = {seed["prompt"]: seed["group"] for seed in seeds}
+    related = [q for q in queries if q["group"] is not None]
+    unrelated = [q for q in queries if q["group"] is None]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = build_memory(Path(tmp), seeds, args.noise)
+        print("{} examples in memory, {} related / {} unrelated queries".format(len(memory), len(related), len(unrelated)))
+        print("  min score  hit@1  hit@{}  unrelated injected  tokens (mean/max)".format(TOP_K))
+        for min_score in args.min_score:
+            hit1 = hitk = 0
+            tokens = []
+            for query in related:
+                found = memory.search(query["prompt"], query["script_type"], min_score=min_score)
+                found_groups = [groups.get(e.question) for e in found]
+                hit1 += bool(found_groups) and found_groups[0] == query["group"]
+                hitk += query["group"] in found_groups
+                examples = format_examples(found)
+                tokens.append(num_tokens_for_model(examples["content"]) if examples else 0)
+            injected = sum(format_examples(memory.search(q["prompt"], q["script_type"], min_score=min_score)) is not None for q in unrelated)
+            print("  {:9.2f}  {:5.0%}  {:5.0%}  {:>18}  {:.0f}/{}".format(
+                min_score, hit1 / len(related), hitk / len(related), "{}/{}".format(injected, len(unrelated)),
+                statistics.mean(tokens), max(tokens)))
+        report("  search latency", measure(lambda: [memory.search(q["prompt"], "python") for q in queries], 5) / len(queries))
+
+def run_conversation(prompt:str, memory:ScriptMemory=None):
+    # 生成 -> 実行 -> エラーならFix Error を最大MAX_FIX回まで
+    from chatmaya.openai_utils import chat_completion_stream
+    from chatmaya.stream_parser import decompose
+    from chatmaya.exec_code import exec_py
+
+    messages = MessageHistory([{"role": "system", "content": SYSTEM_TEMPLATE_PY}])
+    messages.append({"role": "user", "content": USER_TEMPLATE.format(script_type="Maya Python", questions=prompt)})
+    examples = format_examples(memory.search(prompt, "python")) if memory else None
+
+    prompt_tokens = 0
+    for turn in range(MAX_FIX + 1):
+        request = list(messages)
+        if examples and turn == 0:
+            request.insert(len(request) - 1, examples)
+        prompt_tokens += sum(num_tokens_from_message(m, messages.model) for m in request)
+        answer = "".join(c for c in chat_completion_stream(request) if isinstance(c, str))
+        messages.append({"role": "assistant", "content": answer})
+
+        _, code_list = decompose(answer, "python")
+        result = exec_py(code_list[0]) if code_list else "no code"
+        if result == 0:
+            return turn, prompt_tokens, True
+        messages.append({"role": "user", "content": FIX_TEMPLATE.format(error=result)})
+    return MAX_FIX, prompt_tokens, False
+
+def live(args):
+    from maya import cmds
+
+    seeds, queries = load_data()
+    queries = [q for q in queries if q["group"] is not None]
+    with tempfile.TemporaryDirectory() as tmp:
+        memory = build_memory(Path(tmp), seeds)
+        for name, use_memory in (("without examples", False), ("with examples", True)):
+            fixes = tokens = solved = 0
+            for query in queries:
+                cmds.file(new=True, force=True)
+                cmds.polyCube()
+                cmds.select(all=True)
+                turns, prompt_tokens, ok = run_conversation(query["prompt"], memory if use_memory else None)
+                fixes += turns
+                tokens += prompt_tokens
+                solved += ok
+            print(name)
+            print("  solved {}/{}  fix turns {}  prompt tokens {}".format(solved, len(queries), fixes, tokens))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--live", action="store_true")
+    parser.add_argument("--noise", type=int, default=2000, help="関係の無い例の数")
+    parser.add_argument("--min-score", type=float, nargs="+", default=[0.0, 0.03, MIN_SCORE, 0.1])
+    args = parser.parse_args()
+    if args.live:
+        live(args)
+    else:
+        offline(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# 障害を注入したスタブサーバーに対して、リトライ/タイムアウト/再開の挙動と所要時間を確認する
+#   mayapy benchmarks/bench_retry.py
+import time
+
+from _common import init_maya
+from fake_openai import start_server, DEFAULT_TEXT
+
+init_maya()
+
+import openai
+from chatmaya import openai_utils
+from chatmaya.openai_utils import chat_completion_stream, STREAM_RESET
+
+OTHER_TEXT = DEFAULT_TEXT.replace(u"原点", u"ワールド原点")
+SHORT_TEXT = DEFAULT_TEXT[:20] # 切断までに受け取った部分より短い返答
+
+def collect():
+    text = ""
+    resets = 0
+    for content in chat_completion_stream(messages=[{"role": "user", "content": "test"}], model="gpt-3.5-turbo"):
+        if content is STREAM_RESET:
+            resets += 1
+            text = ""
+            continue
+        text += content
+    return text, resets
+
+def run_case(server, name:str, scenarios, expect_error=None, expect_text=DEFAULT_TEXT, expect_resets=0):
+    server.scenarios.clear()
+    server.requests.clear()
+    for scenario in scenarios:
+        server.push(**scenario)
+
+    start = time.perf_counter()
+    error = None
+    text, resets = None, 0
+    try:
+        text, resets = collect()
+    except Exception as e:
+        error = e
+    elapsed = time.perf_counter() - start
+
+    if expect_error:
+        ok = isinstance(error, expect_error)
+    else:
+        ok = error is None and text == expect_text and resets == expect_resets
+    print("{:<4} {:<36} {:>8.0f} ms  requests={} {}".format(
+        "PASS" if ok else "FAIL", name, elapsed * 1000, len(server.requests),
+        type(error).__name__ if error else ""))
+    return ok
+
+def main():
+    server, url = start_server(delay=0.002)
+    openai.api_base = url
+    openai.api_key = "sk-fake"
+
+    # ベンチマーク用にリトライ待ちとタイムアウトを短くする
+    openai_utils.MIN_SECONDS = 0.05
+    openai_utils.TTFT_TIMEOUT = 0.5
+    openai_utils.STALL_TIMEOUT = 0.5
+
+    results = [
+        run_case(server, "success", [{}]),
+        run_case(server, "401 fails fast", [{"status": 401}], openai.error.AuthenticationError),
+        run_case(server, "400 context length fails fast", [{"status": 400}], openai.error.InvalidRequestError),
+        run_case(server, "429 + retry-after then success", [{"status": 429, "headers": {"retry-after": "0.2"}}, {}]),
+        run_case(server, "500 then success", [{"status": 500}, {}]),
+        run_case(server, "503 x3 gives up", [{"status": 503}] * 3, openai.error.ServiceUnavailableError),
+        run_case(server, "drop mid-stream, same answer", [{"drop_after": 10}, {}]),
+        run_case(server, "drop mid-stream, new answer", [{"drop_after": 10}, {"text": OTHER_TEXT}], expect_text=OTHER_TEXT, expect_resets=1),
+        run_case(server, "drop mid-stream, shorter answer", [{"drop_after": 10}, {"text": SHORT_TEXT}], expect_text=SHORT_TEXT, expect_resets=1),
+        run_case(server, "slow first token (TTFT)", [{"ttft": 3.0}, {}]),
+        run_case(server, "stall mid-stream", [{"stall_after": 5, "stall": 3.0}, {}]),
+    ]
+    server.shutdown()
+    print("{}/{} passed".format(sum(results), len(results)))
+
+if __name__ == '__main__':
+    main()
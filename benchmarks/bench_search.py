@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# 過去のセッションの検索速度
+#   mayapy benchmarks/bench_search.py [--sessions 500] [--log-dir <ChatMaya/log>]
+#   legacy: 全セッションのファイルを読んで部分一致で探す
+#   index : SQLite FTS5のインデックスで探す (作成/差分更新の時間も表示)
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+from _common import init_maya, measure, report
+
+init_maya()
+
+from chatmaya.history import MessageHistory
+from chatmaya.journal import SessionJournal, load_messages
+from chatmaya.search import SearchIndex, read_scripts
+
+QUERIES = [u"polyCube", u"原点に移動", u"xform translation", u"存在しない語句"]
+WORDS = ["polyCube", "polySphere", "xform", "translation", "rotate", "select", "parent", "keyframe", "setAttr", "group"]
+
+def make_logs(log_dir:Path, sessions:int):
+    rng = random.Random(0)
+    for i in range(sessions):
+        session_dir = log_dir / "session_230401_{:06d}".format(i)
+        messages = MessageHistory([{"role": "system", "content": "system"}])
+        messages.count = lambda message: 0
+        journal = SessionJournal(session_dir)
+        messages.add_listener(journal.record)
+        for turn in range(rng.randint(2, 8)):
+            words = " ".join(rng.choice(WORDS) for _ in range(20))
+            messages.append({"role": "user", "content": u"質問: オブジェクトを原点に移動したい " + words})
+            code = "\n".join("cmds.{}('obj{}')".format(rng.choice(WORDS), n) for n in range(30))
+            messages.append({"role": "assistant", "content": u"回答です。\n```python\n" + code + "\n```"})
+            with open(session_dir / "script_120000_{:02d}.py".format(turn), 'w', encoding='utf-8-sig') as f:
+                f.write(code)
+        journal.close()
+
+def legacy_search(log_dir:Path, text:str):
+    terms = text.split()
+    hits = []
+    for session_dir in sorted(log_dir.iterdir()):
+        contents = [m["content"] for m in load_messages(session_dir) or [] if m.get("role") != "system"]
+        for path in read_scripts(session_dir):
+            with open(path, encoding='utf-8-sig') as f:
+                contents.append(f.read())
+        hits += [c for c in contents if all(term in c for term in terms)]
+    return hits
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=500)
+    parser.add_argument("--log-dir")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.log_dir:
+            log_dir = Path(args.log_dir)
+        else:
+            log_dir = Path(tmp) / "log"
+            make_logs(log_dir, args.sessions)
+        index = SearchIndex(Path(tmp) / "index.sqlite3", log_dir)
+
+        start = time.perf_counter()
+        updated = index.rebuild()
+        report("build ({} sessions)".format(updated), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        index.rebuild()
+        report("rebuild (no change)", time.perf_counter() - start)
+
+        session_dir = index.session_dirs()[-1]
+        with open(session_dir / "script_235959_00.py", 'w', encoding='utf-8-sig') as f:
+            f.write("cmds.polyTorus()")
+        start = time.perf_counter()
+        updated = index.rebuild()
+        report("rebuild ({} changed)".format(updated), time.perf_counter() - start)
+
+        for query in QUERIES:
+            legacy = measure(lambda: legacy_search(log_dir, query), repeat=3)
+            indexed = measure(lambda: index.search(query), repeat=10)
+            print(u"query: {}".format(query))
+            report("  legacy (scan files)", legacy)
+            report("  index  ({} hits)".format(len(index.search(query))), indexed, legacy)
+        index.close()
+
+if __name__ == '__main__':
+    main()
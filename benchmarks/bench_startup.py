@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# 起動時間の計測
+#   mayapy benchmarks/bench_startup.py
+#     import chatmaya / chatmaya.core にかかる時間と、読み込まれた重い依存モジュールを表示
+#     (毎回新しいプロセスで計測するので、2回目以降のimportのキャッシュは効かない)
+#
+#   ウィンドウが表示されるまでの時間は Maya のスクリプトエディタで計測する
+#     import sys; sys.path.append(r"<ChatGPT_Maya>/benchmarks")
+#     import bench_startup; bench_startup.measure_window()
+#   CHATMAYA_DEV=1 の読み込み直しの時間と、読み込み直されなかったモジュールの確認
+#     import bench_startup; bench_startup.measure_reload()
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+from _common import ROOT_DIR, report
+
+# 変更前は chatmaya.core の読み込み時に全てimportされていたモジュール
+HEAVY_MODULES = ("openai", "tiktoken", "requests", "urllib3", "alkana", "pyaudio", "keyboard", "pydantic")
+
+def child(target:str):
+    from _common import init_maya
+    init_maya()
+
+    start = time.perf_counter()
+    if target == "legacy":
+        # 変更前と同じく重い依存を先にすべて読み込む
+        for name in HEAVY_MODULES:
+            try:
+                __import__(name)
+            except ImportError:
+                pass
+        target = "chatmaya.core"
+    __import__(target)
+    seconds = time.perf_counter() - start
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(json.dumps({"seconds": seconds, "loaded": loaded}))
+
+def run_child(target:str) -> dict:
+    proc = subprocess.run(
+        [sys.executable, __file__, "--child", target],
+        cwd=str(ROOT_DIR / "benchmarks"), capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def measure_import(target:str, repeat:int):
+    results = [run_child(target) for _ in range(repeat)]
+    return statistics.median(r["seconds"] for r in results), results[-1]["loaded"]
+
+def measure_window(timeout:float=10.0):
+    # Maya上で chatmaya.run() からウィンドウが最初に描画されるまで
+    from PySide2 import QtWidgets, QtCore
+
+    class PaintWatcher(QtCore.QObject):
+        painted_at = None
+
+        def eventFilter(self, obj, event):
+            if event.type() == QtCore.QEvent.Paint and self.painted_at is None:
+                self.painted_at = time.perf_counter()
+            return False
+
+    for name in [name for name in sys.modules if name == "chatmaya" or name.startswith("chatmaya.")]:
+        del sys.modules[name]
+    before = set(name for name in HEAVY_MODULES if name in sys.modules)
+
+    start = time.perf_counter()
+    import chatmaya
+    imported = time.perf_counter()
+    watcher = PaintWatcher()
+    app = QtWidgets.QApplication.instance()
+    app.installEventFilter(watcher)
+    try:
+        window = chatmaya.run()
+        shown = time.perf_counter()
+        deadline = shown + timeout
+        while watcher.painted_at is None and time.perf_counter() < deadline:
+            app.processEvents()
+    finally:
+        app.removeEventFilter(watcher)
+
+    report("import chatmaya", imported - start)
+    report("run() -> show()", shown - start)
+    if watcher.painted_at is not None:
+        report("run() -> first paint", watcher.painted_at - start)
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules and name not in before]
+    print("loaded at startup: {}".format(", ".join(loaded) or "-"))
+    return window
+
+def measure_reload():
+    # chatmaya.run() の後に実行する
+    import pkgutil
+    import chatmaya
+
+    start = time.perf_counter()
+    chatmaya.reload_modules()
+    report("reload_modules()", time.perf_counter() - start)
+    order = chatmaya.reload_order()
+    print("reload order: {}".format(", ".join(order)))
+    missing = sorted(m.name for m in pkgutil.iter_modules(chatmaya.__path__) if m.name not in order)
+    print("not loaded (not reloaded): {}".format(", ".join(missing) or "-"))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    print("cold import ({} runs each, median)".format(args.repeat))
+    legacy, _ = measure_import("legacy", args.repeat)
+    report("legacy (eager dependencies)", legacy)
+    for target in ("chatmaya", "chatmaya.core"):
+        seconds, loaded = measure_import(target, args.repeat)
+        report("import " + target, seconds, legacy)
+        print("  loaded: {}".format(", ".join(loaded) or "-"))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# StreamParserの分解結果を変更前の正規表現(decompose_response)と比べ、1チャンクあたりの処理時間を計測する
+#   mayapy benchmarks/bench_stream_parser.py
+#   どの区切り方で受け取っても、まとめて正規表現で分解した場合と同じコードと文章になることを確認する
+import re
+import sys
+import json
+import time
+import random
+from pathlib import Path
+
+from _common import init_maya
+
+init_maya()
+
+from chatmaya.stream_parser import StreamParser
+
+DATA_DIR = Path(__file__).parent / "data"
+CHUNK_CHARS = 4
+
+CASES = [
+    ("fence at line start", u"以下のスクリプトです。\n```python\nimport maya.cmds as cmds\ncmds.polyCube()\n```\n実行してください。"),
+    ("fence after text", u"Here: ```python\nx=1\n``` done"),
+    ("fence after sentence", u"立方体を作ります: ```python\ncmds.polyCube()\n```\n以上です。"),
+    ("indented fence", u"手順:\n  ```python\n  cmds.polySphere()\n  ```\n"),
+    ("inline code", u"`cmds.ls` で選択を取得します。\n```python\nprint(cmds.ls(sl=True))\n```"),
+    ("two blocks", u"```python\na = 1\n```\nそして\n```python\nb = 2\n```"),
+    ("mel block", u"MELの場合: ```mel\npolyCube;\n```"),
+]
+
+def legacy_decompose(txt:str, script_type:str="python"):
+    # 変更前の ChatMaya.decompose_response
+    pattern = r"```python([\s\S]*?)```" if script_type == "python" else r"```mel([\s\S]*?)```"
+    code_list = [code.strip() for code in re.findall(pattern, txt)]
+    comment = re.sub(pattern, '', txt)
+    comment = re.sub('[\r?\n]+', '\n', comment)
+    return comment.strip(), code_list
+
+def parse(text:str, sizes):
+    parser = StreamParser()
+    i = 0
+    for size in sizes:
+        if i >= len(text):
+            break
+        parser.feed(text[i:i + size])
+        i += size
+    parser.feed(text[i:])
+    parser.close()
+    return parser
+
+def check(name:str, text:str) -> bool:
+    rng = random.Random(0)
+    splits = {
+        "whole": [len(text)],
+        "1 char": [1] * len(text),
+        "random": [rng.randint(1, 8) for _ in range(len(text))],
+    }
+    ok = True
+    for script_type in ("python", "mel"):
+        expected = legacy_decompose(text, script_type)
+        for split, sizes in splits.items():
+            parser = parse(text, sizes)
+            code_list = [code for lang, code in parser.code_blocks if lang == script_type]
+            # 正規表現は他の言語のブロックを文章に残すので、その場合はコードのみ比べる
+            other = any(lang != script_type for lang, _ in parser.code_blocks)
+            result = (expected[0] if other else parser.comment(), code_list)
+            if result != expected:
+                print("     {} / {}: {!r} != {!r}".format(script_type, split, result, expected))
+                ok = False
+    print("{:<4} {}".format("PASS" if ok else "FAIL", name))
+    return ok
+
+def bench():
+    with open(DATA_DIR / "answers.jsonl", encoding='utf-8') as f:
+        answers = [json.loads(line)["content"] for line in f if line.strip()]
+    chunks = 0
+    start = time.perf_counter()
+    for text in answers:
+        parser = StreamParser()
+        for i in range(0, len(text), CHUNK_CHARS):
+            parser.feed(text[i:i + CHUNK_CHARS])
+            chunks += 1
+        parser.close()
+    seconds = time.perf_counter() - start
+    print("{:<40} {:>10.2f} us  ({} answers, {} chunks)".format(
+        "feed per chunk", seconds / chunks * 1000000, len(answers), chunks))
+
+def main():
+    results = [check(name, text) for name, text in CASES]
+    print("{}/{} passed".format(sum(results), len(results)))
+    bench()
+    sys.exit(0 if all(results) else 1)
+
+if __name__ == '__main__':
+    main()
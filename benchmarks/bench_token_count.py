@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# メッセージのトークン数の見積もりとAPIのusage.prompt_tokensの比較
+#   mayapy benchmarks/bench_token_count.py
+#     legacy : 全メッセージの本文をつなげてcl100k_baseで数える
+#     chatml : モデルのエンコーディングで、1メッセージごとの区切り/role/nameを含めて数える
+#     data/usage_samples.jsonl があれば記録したusageと一致するか確かめる
+#   mayapy benchmarks/bench_token_count.py --record [--model gpt-3.5-turbo gpt-4]
+#     サンプルをmax_tokens=1で送り、usage.prompt_tokensを data/usage_samples.jsonl に記録する (OPENAI_API_KEY が必要)
+import json
+import random
+import argparse
+import statistics
+from pathlib import Path
+
+from _common import init_maya, measure, report
+
+init_maya()
+
+from chatmaya.openai_utils import (
+    num_tokens_from_text,
+    num_tokens_from_messages,
+    check_context_length,
+    context_window,
+    ContextLengthError
+)
+from chatmaya.prompts import SYSTEM_TEMPLATE_PY, USER_TEMPLATE, FIX_TEMPLATE
+
+USAGE_FILE = Path(__file__).parent / "data" / "usage_samples.jsonl"
+QUESTIONS = [u"選択したオブジェクトを原点に移動して", u"10x10のグリッド状にキューブを並べて",
+             u"Create a locator at each selected vertex", u"全てのジョイントの回転を0にして"]
+
+def make_samples(count:int=20, seed:int=0):
+    rng = random.Random(seed)
+    samples = [[{"role": "user", "content": "hi"}]]
+    for i in range(count):
+        messages = [{"role": "system", "content": SYSTEM_TEMPLATE_PY}]
+        for turn in range(rng.randint(1, 8)):
+            messages.append({"role": "user", "content": USER_TEMPLATE.format(
+                script_type="Maya Python", questions=rng.choice(QUESTIONS))})
+            code = "\n".join("cmds.xform('obj{}', translation=({}, 0, 0))".format(n, rng.random()) for n in range(rng.randint(3, 40)))
+            messages.append({"role": "assistant", "content": u"以下です。\n```python\nimport maya.cmds as cmds\n" + code + "\n```"})
+            if rng.random() < 0.3:
+                messages.append({"role": "user", "content": FIX_TEMPLATE.format(error="# NameError: name 'obj' is not defined")})
+        if i % 5 == 0:
+            messages.insert(1, {"role": "system", "name": "example_user", "content": u"例: キューブを作って"})
+        samples.append(messages)
+    return samples
+
+def legacy_count(messages) -> int:
+    return num_tokens_from_text("".join(message["content"] for message in messages))
+
+def record(models):
+    import openai
+
+    USAGE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(USAGE_FILE, 'a', encoding='utf-8') as f:
+        for model in models:
+            for messages in make_samples():
+                response = openai.ChatCompletion.create(model=model, messages=messages, max_tokens=1)
+                f.write(json.dumps({"model": model, "messages": messages,
+                                    "prompt_tokens": response["usage"]["prompt_tokens"]}, ensure_ascii=False) + "\n")
+    print("recorded to {}".format(USAGE_FILE))
+
+def compare(models):
+    samples = make_samples()
+    for model in models:
+        diffs = [num_tokens_from_messages(m, model) - legacy_count(m) for m in samples]
+        print("{}: legacy estimate is low by {:.0f} tokens on average (max {}) over {} samples".format(
+            model, statistics.mean(diffs), max(diffs), len(samples)))
+
+    if USAGE_FILE.is_file():
+        with open(USAGE_FILE, encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        print("recorded usage ({} samples)".format(len(records)))
+        for model in sorted(set(r["model"] for r in records)):
+            rows = [r for r in records if r["model"] == model]
+            exact = sum(num_tokens_from_messages(r["messages"], model) == r["prompt_tokens"] for r in rows)
+            legacy = statistics.mean(r["prompt_tokens"] - legacy_count(r["messages"]) for r in rows)
+            print("  {}: chatml exact {}/{}  legacy off by {:.1f} on average".format(model, exact, len(rows), legacy))
+    else:
+        print("no recorded usage ({}); run with --record to verify against the API".format(USAGE_FILE.name))
+
+    # コンテキスト長を超える送信は通信せずに止める
+    model = models[0]
+    big = [{"role": "user", "content": u"cmds.polyCube()\n" * (context_window(model) // 4)}]
+    def preflight():
+        try:
+            check_context_length(big, model)
+        except ContextLengthError:
+            return
+        raise AssertionError("not rejected")
+    report("pre-flight rejection ({} tokens)".format(num_tokens_from_messages(big, model)), measure(preflight, 5))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--model", nargs="+", default=["gpt-3.5-turbo", "gpt-4"])
+    args = parser.parse_args()
+    if args.record:
+        record(args.model)
+    else:
+        compare(args.model)
+
+if __name__ == '__main__':
+    main()
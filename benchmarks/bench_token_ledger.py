@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# 200ターンの擬似セッションでトークン計算のコストを比較する
+#   mayapy benchmarks/bench_token_ledger.py
+import random
+
+from _common import init_maya, measure, report
+
+init_maya()
+
+import tiktoken
+from chatmaya.history import MessageHistory
+from chatmaya.prompts import SYSTEM_TEMPLATE_PY, USER_TEMPLATE
+
+TURNS = 200
+
+WORDS = ["polyCube", "cmds.ls", "selection", "translate", "rotate", "joint", "skinCluster",
+         u"選択した", u"オブジェクトを", u"移動", u"回転", u"作成してください", u"原点に"]
+
+def make_session(turns:int=TURNS, seed:int=0):
+    rnd = random.Random(seed)
+    messages = []
+    for i in range(turns):
+        question = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(5, 30)))
+        code = "\n".join("cmds.{}('{}{}')".format(rnd.choice(['polyCube', 'select', 'move']), rnd.choice(WORDS), n)
+                         for n in range(rnd.randint(3, 20)))
+        messages.append({"role": "user", "content": USER_TEMPLATE.format(script_type="Maya Python", questions=question)})
+        messages.append({"role": "assistant", "content": u"以下のスクリプトです。\n```python\n{}\n```".format(code)})
+    return messages
+
+def legacy_num_tokens(text:str) -> int:
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return len(encoding.encode(text))
+
+def run_legacy(session):
+    messages = [{"role": "system", "content": SYSTEM_TEMPLATE_PY}]
+    for i in range(0, len(session), 2):
+        messages.append(session[i])
+        legacy_num_tokens("".join(msg["content"] for msg in messages))
+        legacy_num_tokens("".join(msg["content"] for msg in messages))
+        messages.append(session[i + 1])
+        legacy_num_tokens(session[i + 1]["content"])
+
+def run_ledger(session):
+    messages = MessageHistory([{"role": "system", "content": SYSTEM_TEMPLATE_PY}])
+    for i in range(0, len(session), 2):
+        messages.append(session[i])
+        messages.total_tokens
+        messages.append(session[i + 1])
+        messages.token_count(-1)
+
+def main():
+    session = make_session()
+    print("{} turns".format(TURNS))
+
+    legacy = measure(lambda: run_legacy(session), repeat=1)
+    report("legacy", legacy)
+    report("ledger", measure(lambda: run_ledger(session)), legacy)
+
+if __name__ == '__main__':
+    main()
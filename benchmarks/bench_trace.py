@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# トレース (Tracer) のオーバーヘッドと、1回の送信を記録したタイムラインの確認
+#   mayapy benchmarks/bench_trace.py [--out DIR]
+#   span    : 無効/有効時の1スパンあたりの時間
+#   timeline: スタブのOpenAI/VOICEVOXで送信から読み上げまでを記録し、返答の受信中に合成が重なった割合を表示する
+#             --out を指定するとtrace.jsonを残す (chrome://tracing / https://ui.perfetto.dev で開く)
+import json
+import time
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+
+from _common import init_maya
+from stub_voicevox import start_server as start_voicevox
+
+init_maya()
+
+import openai
+import fake_openai
+from chatmaya import openai_utils, voice
+from chatmaya.player import AudioPlayer, NullSink
+from chatmaya.stream_parser import StreamParser, SENTENCE
+from chatmaya.trace import Tracer, TRACER
+
+CALLS = 100000
+TEXT = u"""選択したオブジェクトを原点に移動するスクリプトです。まず選択中のオブジェクトを取得します。
+```python
+import maya.cmds as cmds
+
+for obj in cmds.ls(selection=True):
+    cmds.xform(obj, worldSpace=True, translation=(0, 0, 0))
+```
+次にそれぞれのトランスフォームを0に設定します。ピボットがずれている場合は、先にフリーズしてください。以上です。"""
+
+def bench_span():
+    for enabled in (False, True):
+        tracer = Tracer(enabled)
+        start = time.perf_counter()
+        for _ in range(CALLS):
+            with tracer.span("bench"):
+                pass
+        print("{:<40} {:>10.2f} us".format("span ({})".format("enabled" if enabled else "disabled"),
+                                           (time.perf_counter() - start) / CALLS * 1000000))
+
+def send(server):
+    # CompletionWorkerと同じく、受信した文から順に合成/再生する
+    server.push(text=TEXT, delay=0.02, ttft=0.3)
+    pipeline = voice.SynthesisPipeline(voice.text2voice, workers=2)
+    player = AudioPlayer(sink=NullSink(realtime=True))
+    parser = StreamParser()
+    count = 0
+
+    def play():
+        for _ in range(count):
+            player.play(pipeline.output.get(timeout=30))
+
+    start = time.perf_counter()
+    for content in openai_utils.chat_completion_stream([{"role": "user", "content": "test"}]):
+        with TRACER.span("chunk", "completion"):
+            with TRACER.span("parse", "completion"):
+                events = parser.feed(content)
+            for event in events:
+                if event.kind == SENTENCE:
+                    pipeline.submit(event.text)
+                    count += 1
+    with TRACER.span("parse", "completion"):
+        events = parser.close()
+    for event in events:
+        if event.kind == SENTENCE:
+            pipeline.submit(event.text)
+            count += 1
+    TRACER.complete("completion", start, cat="completion")
+
+    thread = threading.Thread(target=play, name="voice_play")
+    thread.start()
+    thread.join()
+    player.wait_idle(30)
+    time.sleep(0.05)
+    pipeline.shutdown()
+    player.close()
+
+def overlap(events, name:str, window:dict) -> float:
+    begin, end = window['ts'], window['ts'] + window['dur']
+    spans = [e for e in events if e.get('name') == name and e.get('ph') == 'X']
+    total = sum(e['dur'] for e in spans)
+    inside = sum(max(0, min(end, e['ts'] + e['dur']) - max(begin, e['ts'])) for e in spans)
+    return inside / total if total else 0.0
+
+def bench_timeline(out:Path):
+    server, url = fake_openai.start_server()
+    openai.api_base = url
+    openai.api_key = "sk-fake"
+    voice_server, voice.BASE_URL = start_voicevox()
+
+    TRACER.enabled = True
+    TRACER.open(out)
+    path = TRACER.path
+    send(server)
+    TRACER.close()
+    TRACER.enabled = False
+
+    with open(path, encoding='utf-8') as f:
+        events = json.load(f)
+    names = {}
+    for event in events:
+        if event['ph'] != 'M':
+            names[event['name']] = names.get(event['name'], 0) + 1
+    threads = sum(1 for event in events if event['ph'] == 'M')
+    window = [e for e in events if e['name'] == 'completion'][0]
+    print("timeline: {} events on {} threads  {}".format(len(events), threads, path))
+    print("  " + "  ".join("{} {}".format(name, n) for name, n in sorted(names.items())))
+    print("  synthesis during streaming: {:.0%}  (completion {:.0f} ms)".format(
+        overlap(events, 'text2voice', window), window['dur'] / 1000))
+    server.shutdown()
+    voice_server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", type=Path)
+    args = parser.parse_args()
+
+    bench_span()
+    if args.out:
+        bench_timeline(args.out)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            bench_timeline(Path(tmp))
+
+if __name__ == '__main__':
+    main()
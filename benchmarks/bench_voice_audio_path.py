@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# 1文あたりの音声受け渡しのオーバーヘッドを比較する (一時wav経由 / メモリ上)
+#   mayapy benchmarks/bench_voice_audio_path.py
+import io
+import wave
+import tempfile
+from pathlib import Path
+from uuid import uuid4
+
+from _common import init_maya, measure, report
+from stub_voicevox import make_wav
+
+init_maya()
+
+CHUNK_SIZE = 1024
+SENTENCES = 100
+
+def consume(wf):
+    # 再生部分(stream.write)は除き、フレームの読み出しのみ
+    data = wf.readframes(CHUNK_SIZE)
+    while data != b'':
+        data = wf.readframes(CHUNK_SIZE)
+
+def run_temp_file(audio:bytes, tmp:Path):
+    for _ in range(SENTENCES):
+        audio_file = Path(tmp, str(uuid4()) + '.wav')
+        with open(audio_file, mode="wb") as f:
+            f.write(audio)
+        with wave.open(str(audio_file), mode='r') as wf:
+            consume(wf)
+        audio_file.unlink()
+
+def run_memory(audio:bytes):
+    for _ in range(SENTENCES):
+        with wave.open(io.BytesIO(audio), mode='rb') as wf:
+            consume(wf)
+
+def main():
+    audio = make_wav(3.0)
+    print("{} sentences, {} KB wav each".format(SENTENCES, len(audio) // 1024))
+    with tempfile.TemporaryDirectory() as tmp:
+        legacy = measure(lambda: run_temp_file(audio, Path(tmp)))
+    report("temp file (per sentence)", legacy / SENTENCES)
+    report("in memory (per sentence)", measure(lambda: run_memory(audio)) / SENTENCES, legacy / SENTENCES)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# スタブVOICEVOXに対して、直列合成と並列合成の初回音声/全文完了までの時間を比較する
+#   mayapy benchmarks/bench_voice_synthesis.py
+import json
+import time
+import tempfile
+import argparse
+from pathlib import Path
+from uuid import uuid4
+
+from _common import init_maya
+from stub_voicevox import start_server
+
+init_maya()
+
+import requests
+from chatmaya import voice
+
+SENTENCES = [
+    u"選択したオブジェクトを原点に移動するスクリプトです。",
+    u"まず選択中のオブジェクトを取得します。",
+    u"次にそれぞれのトランスフォームを0に設定します。",
+    u"ピボットがずれている場合は、先にフリーズしてください。",
+    u"以下のスクリプトを実行してください。",
+    u"エラーが出た場合は Fix Error を押してください。",
+    u"ジョイントが含まれている場合は注意が必要です。",
+    u"以上です。",
+]
+
+def legacy_text2voice(text:str, path:Path):
+    # 変更前の実装 (毎回新しい接続)
+    text = voice.alkana_(text)
+    res1 = requests.post(voice.BASE_URL + "/audio_query", params={"text": text, "speaker": 0})
+    res1.raise_for_status()
+    res2 = requests.post(voice.BASE_URL + "/synthesis", params={"speaker": 0}, data=json.dumps(res1.json()))
+    audio_file = Path(path, str(uuid4()) + '.wav')
+    with open(audio_file, mode="wb") as f:
+        f.write(res2.content)
+    return audio_file
+
+def run_legacy(tmp:Path):
+    start = time.perf_counter()
+    first = None
+    for text in SENTENCES:
+        legacy_text2voice(text, tmp)
+        if first is None:
+            first = time.perf_counter() - start
+    return first, time.perf_counter() - start
+
+def run_pipeline(workers:int):
+    pipeline = voice.SynthesisPipeline(voice.text2voice, workers=workers)
+    start = time.perf_counter()
+    for text in SENTENCES:
+        pipeline.submit(text)
+    first = None
+    for _ in SENTENCES:
+        pipeline.output.get(timeout=30)
+        if first is None:
+            first = time.perf_counter() - start
+    total = time.perf_counter() - start
+    pipeline.shutdown()
+    return first, total
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--query-latency", type=float, default=0.05)
+    parser.add_argument("--synthesis-latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    server, url = start_server(query_latency=args.query_latency, synthesis_latency=args.synthesis_latency)
+    voice.BASE_URL = url
+
+    print("{} sentences, audio_query {:.0f} ms, synthesis {:.0f} ms + per char".format(
+        len(SENTENCES), args.query_latency * 1000, args.synthesis_latency * 1000))
+    print("{:<24} {:>16} {:>18}".format("", "first audio", "all speech ready"))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        first, total = run_legacy(tmp)
+        print("{:<24} {:>13.0f} ms {:>15.0f} ms".format("legacy (serial)", first * 1000, total * 1000))
+        for workers in (1, 2, 4):
+            first, total = run_pipeline(workers)
+            print("{:<24} {:>13.0f} ms {:>15.0f} ms".format("pipeline x{}".format(workers), first * 1000, total * 1000))
+
+    server.shutdown()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# ウォームアップの有無による、最初の送信と10回目の送信の比較
+#   mayapy benchmarks/bench_warmup.py [--handshake 0.3] [--model-load 1.5]
+#   (tokenizerの読み込みも含めるため、毎回新しいプロセスで計測する)
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+from _common import ROOT_DIR, report
+
+PROMPT = u"選択したオブジェクトを原点に移動するスクリプトを書いてください。"
+SENDS = 10
+
+def send(openai_utils, voice) -> dict:
+    # 1回の送信: プロンプトのトークン数を数え、最初のトークンと最初の音声までの時間を計る
+    start = time.perf_counter()
+    openai_utils.num_tokens_from_text(PROMPT)
+    first_token = None
+    text = ""
+    for content in openai_utils.chat_completion_stream([{"role": "user", "content": PROMPT}]):
+        if first_token is None:
+            first_token = time.perf_counter() - start
+        text += content
+    voice.text2voice(text.splitlines()[0], speaker=1)
+    return {"first_token": first_token, "first_voice": time.perf_counter() - start}
+
+def child(args):
+    import openai
+    import fake_openai
+    import stub_voicevox
+    from chatmaya import openai_utils, voice
+
+    _, api_url = fake_openai.start_server(handshake=args.handshake)
+    _, voice_url = stub_voicevox.start_server(model_load_latency=args.model_load)
+    openai.api_base = api_url
+    openai.api_key = "sk-fake"
+    voice.BASE_URL = voice_url
+
+    if args.child == "warm":
+        # WarmUpと同じ処理を送信前に済ませておく
+        openai_utils.num_tokens_from_text("ChatMaya")
+        openai_utils.preconnect()
+        voice.alkana_("ChatMaya")
+        voice.initialize_speaker(1)
+
+    results = [send(openai_utils, voice) for _ in range(SENDS)]
+    print(json.dumps(results))
+
+def run_child(mode:str, args) -> list:
+    proc = subprocess.run(
+        [sys.executable, __file__, "--child", mode,
+         "--handshake", str(args.handshake), "--model-load", str(args.model_load)],
+        cwd=str(ROOT_DIR / "benchmarks"), capture_output=True, text=True, check=True)
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--child")
+    parser.add_argument("--handshake", type=float, default=0.3)
+    parser.add_argument("--model-load", type=float, default=1.5)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return
+
+    cold = [run_child("cold", args) for _ in range(args.repeat)]
+    warm = [run_child("warm", args) for _ in range(args.repeat)]
+
+    for key in ("first_token", "first_voice"):
+        steady = statistics.median(r[-1][key] for r in cold + warm)
+        print(key)
+        report("  send #{} (steady)".format(SENDS), steady)
+        report("  send #1 without warm-up", statistics.median(r[0][key] for r in cold), steady)
+        report("  send #1 after warm-up", statistics.median(r[0][key] for r in warm), steady)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# ストリームを再生する OpenAI Chat Completions API のスタブ (障害の注入も可能)
+#   python benchmarks/fake_openai.py --port 8765
+import json
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_TEXT = u"""選択したオブジェクトを原点に移動するスクリプトです。
+```python
+import maya.cmds as cmds
+
+for obj in cmds.ls(selection=True):
+    cmds.xform(obj, worldSpace=True, translation=(0, 0, 0))
+```
+オブジェクトを選択してから実行してください。"""
+
+DEFAULT_SCENARIO = {
+    "status": 200,          # 200以外ならエラーを返す
+    "error": None,          # エラー時のerrorオブジェクト
+    "headers": {},          # 追加のレスポンスヘッダ
+    "texts": None,          # 候補ごとの返答 (Noneならtextをn個)
+    "text": DEFAULT_TEXT,
+    "chunk_chars": 4,       # 1チャンクの文字数
+    "ttft": 0.0,            # 最初のチャンクまでの秒数
+    "delay": 0.0,           # チャンク間の秒数
+    "drop_after": None,     # Nチャンク送信後に接続を切る
+    "stall_after": None,    # Nチャンク送信後にstall秒止まる
+    "stall": 60.0,
+}
+
+ERRORS = {
+    400: {"message": "This model's maximum context length is 4097 tokens.", "type": "invalid_request_error", "code": "context_length_exceeded"},
+    401: {"message": "Incorrect API key provided.", "type": "invalid_request_error", "code": "invalid_api_key"},
+    429: {"message": "Rate limit reached.", "type": "requests", "code": "rate_limit_exceeded"},
+    500: {"message": "The server had an error while processing your request.", "type": "server_error", "code": None},
+    503: {"message": "The engine is currently overloaded.", "type": "server_error", "code": None},
+}
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        # 新しい接続ごとにTLSハンドシェイク相当の時間がかかる
+        super(FakeOpenAIHandler, self).setup()
+        time.sleep(self.server.handshake)
+
+    def _write_chunk(self, data:bytes):
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_GET(self):
+        # /v1/models (接続の事前確立用)
+        body = json.dumps({"object": "list", "data": []}).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length).decode('utf-8') or "{}")
+        scenario = self.server.next_scenario(request)
+
+        if scenario["status"] != 200:
+            error = scenario["error"] or ERRORS.get(scenario["status"], ERRORS[500])
+            body = json.dumps({"error": error}).encode('utf-8')
+            self.send_response(scenario["status"])
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for key, value in scenario["headers"].items():
+                self.send_header(key, str(value))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        n = int(request.get("n", 1))
+        texts = scenario["texts"] or [scenario["text"]] * n
+        step = scenario["chunk_chars"]
+        pieces = []
+        for i in range(0, max(len(t) for t in texts), step):
+            for index, text in enumerate(texts):
+                if i < len(text):
+                    pieces.append((index, text[i:i + step]))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        for key, value in scenario["headers"].items():
+            self.send_header(key, str(value))
+        self.end_headers()
+
+        time.sleep(scenario["ttft"])
+        try:
+            for count, (index, content) in enumerate(pieces):
+                if scenario["drop_after"] is not None and count >= scenario["drop_after"]:
+                    # 終端チャンクを送らずに切断
+                    self.close_connection = True
+                    return
+                if scenario["stall_after"] is not None and count == scenario["stall_after"]:
+                    time.sleep(scenario["stall"])
+                chunk = {
+                    "id": "chatcmpl-fake",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": request.get("model"),
+                    "choices": [{"index": index, "delta": {"content": content}, "finish_reason": None}],
+                }
+                self._write_chunk(b"data: " + json.dumps(chunk, ensure_ascii=False).encode('utf-8') + b"\n\n")
+                if scenario["delay"]:
+                    time.sleep(scenario["delay"])
+            self._write_chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+class FakeOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, default:dict=None, handshake:float=0.0):
+        super(FakeOpenAIServer, self).__init__(address, handler)
+        self.handshake = handshake
+        self.default = dict(DEFAULT_SCENARIO, **(default or {}))
+        self.scenarios = []
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def push(self, **scenario):
+        # 次のリクエストに使うシナリオを追加 (無ければdefault)
+        with self._lock:
+            self.scenarios.append(dict(self.default, **scenario))
+
+    def next_scenario(self, request:dict) -> dict:
+        with self._lock:
+            self.requests.append((time.time(), request))
+            if self.scenarios:
+                return self.scenarios.pop(0)
+            return self.default
+
+def start_server(port:int=0, handshake:float=0.0, **default):
+    server = FakeOpenAIServer(("127.0.0.1", port), FakeOpenAIHandler, default, handshake)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:{}/v1".format(server.server_address[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=0.02)
+    parser.add_argument("--ttft", type=float, default=0.3)
+    args = parser.parse_args()
+    server, url = start_server(args.port, delay=args.delay, ttft=args.ttft)
+    print("fake OpenAI API running at", url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
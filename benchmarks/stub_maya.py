@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# ベンチマーク用のmaya.cmds/mel/OpenMaya/OpenMayaUIのスタブ (Maya無しでChatMayaのウィンドウを開く)
+#   import stub_maya; stub_maya.install(app_dir)  (chatmayaをimportする前、QApplicationを作った後に呼ぶ)
+#   スクリプトエディタ/レポーターはQPlainTextEditで代用し、シーンを操作するコマンドは何もしない
+import sys
+import types
+import itertools
+from pathlib import Path
+
+from PySide2 import QtWidgets
+import shiboken2
+
+def pointer(widget:QtWidgets.QWidget) -> int:
+    return int(shiboken2.getCppPointer(widget)[0])
+
+class StubCmds(types.ModuleType):
+
+    def __init__(self, app_dir:Path):
+        super(StubCmds, self).__init__('maya.cmds')
+        self.app_dir = Path(app_dir)
+        self.controls = {}
+        self.errors = []
+        self._names = itertools.count(1)
+
+    def __getattr__(self, name:str):
+        # 生成されたスクリプトから呼ばれるシーン操作のコマンド
+        return lambda *args, **kwargs: None
+
+    def internalVar(self, userAppDir:bool=False, **kwargs) -> str:
+        return str(self.app_dir) + '/'
+
+    def error(self, message:str):
+        self.errors.append(message)
+        raise RuntimeError(message)
+
+    def warning(self, message:str):
+        self.errors.append(message)
+
+    def _control(self, prefix:str) -> str:
+        name = "{}{}".format(prefix, next(self._names))
+        self.controls[name] = QtWidgets.QPlainTextEdit()
+        return name
+
+    def cmdScrollFieldReporter(self, name:str=None, e:bool=False, clear:bool=False, **kwargs):
+        if name is None:
+            return self._control("cmdScrollFieldReporter")
+        if clear:
+            self.controls[name].clear()
+
+    def cmdScrollFieldExecuter(self, name:str=None, e:bool=False, q:bool=False, clear:bool=False,
+                               t:str=None, text:bool=False, **kwargs):
+        if name is None:
+            return self._control("cmdScrollFieldExecuter")
+        editor = self.controls[name]
+        if q and text:
+            return editor.toPlainText()
+        if clear:
+            editor.clear()
+        if t is not None:
+            editor.setPlainText(t)
+
+class MQtUtil(object):
+    main_window = None
+    cmds = None
+
+    @classmethod
+    def mainWindow(cls) -> int:
+        if cls.main_window is None:
+            cls.main_window = QtWidgets.QMainWindow()
+        return pointer(cls.main_window)
+
+    @classmethod
+    def findControl(cls, name:str) -> int:
+        return pointer(cls.cmds.controls[name])
+
+class MGlobal(object):
+    errors = []
+
+    @classmethod
+    def displayError(cls, message:str):
+        cls.errors.append(message)
+
+def install(app_dir:Path) -> StubCmds:
+    cmds = StubCmds(app_dir)
+    MQtUtil.cmds = cmds
+
+    maya = types.ModuleType('maya')
+    mel = types.ModuleType('maya.mel')
+    mel.eval = lambda code: None
+    open_maya = types.ModuleType('maya.OpenMaya')
+    open_maya.MGlobal = MGlobal
+    open_maya_ui = types.ModuleType('maya.OpenMayaUI')
+    open_maya_ui.MQtUtil = MQtUtil
+
+    maya.cmds, maya.mel, maya.OpenMaya, maya.OpenMayaUI = cmds, mel, open_maya, open_maya_ui
+    sys.modules.update({'maya': maya, 'maya.cmds': cmds, 'maya.mel': mel,
+                        'maya.OpenMaya': open_maya, 'maya.OpenMayaUI': open_maya_ui})
+    return cmds
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# ベンチマーク用のVOICEVOX ENGINEスタブ
+#   python benchmarks/stub_voicevox.py --port 50021
+import io
+import json
+import time
+import wave
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+SAMPLE_RATE = 24000
+
+def make_wav(seconds:float, rate:int=SAMPLE_RATE) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(rate)
+        wf.writeframes(b'\x00\x00' * int(rate * seconds))
+    return buf.getvalue()
+
+class StubVoicevoxHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    # サーバーごとに上書きされる
+    query_latency = 0.05
+    synthesis_latency = 0.2
+    synthesis_latency_per_char = 0.005
+    seconds_per_char = 0.1
+    model_load_latency = 0.0 # 話者ごとに最初に使われた時のモデル読み込み時間
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status:int, body:bytes=b'', content_type:str="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def load_model(self, speaker:str):
+        with self.server.model_lock:
+            if speaker not in self.server.loaded_speakers:
+                time.sleep(self.model_load_latency)
+                self.server.loaded_speakers.add(speaker)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b''
+        self.server.count(url.path)
+        if url.path in ("/audio_query", "/synthesis", "/initialize_speaker"):
+            self.load_model(params.get("speaker", ["0"])[0])
+
+        if url.path == "/audio_query":
+            time.sleep(self.query_latency)
+            text = params.get("text", [""])[0]
+            query = {
+                "accent_phrases": [],
+                "speedScale": 1.0,
+                "pitchScale": 0.0,
+                "intonationScale": 1.0,
+                "volumeScale": 1.0,
+                "prePhonemeLength": 0.1,
+                "postPhonemeLength": 0.1,
+                "outputSamplingRate": SAMPLE_RATE,
+                "outputStereo": False,
+                "kana": text,
+            }
+            self._send(200, json.dumps(query, ensure_ascii=False).encode('utf-8'))
+        elif url.path == "/synthesis":
+            query = json.loads(body.decode('utf-8') or "{}")
+            text = query.get("kana", "")
+            time.sleep(self.synthesis_latency + self.synthesis_latency_per_char * len(text))
+            self._send(200, make_wav(max(0.1, self.seconds_per_char * len(text) / 10),
+                                     query.get("outputSamplingRate", SAMPLE_RATE)), "audio/wav")
+        elif url.path == "/initialize_speaker":
+            self._send(204)
+        else:
+            self._send(404)
+
+class StubVoicevoxServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler):
+        super(StubVoicevoxServer, self).__init__(address, handler)
+        self.requests = {}
+        self.loaded_speakers = set()
+        self.model_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def count(self, path:str):
+        with self._lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+
+def start_server(port:int=0, **latency):
+    handler = type("Handler", (StubVoicevoxHandler,), latency)
+    server = StubVoicevoxServer(("127.0.0.1", port), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, "http://127.0.0.1:{}".format(server.server_address[1])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=50021)
+    parser.add_argument("--query-latency", type=float, default=0.05)
+    parser.add_argument("--synthesis-latency", type=float, default=0.2)
+    args = parser.parse_args()
+    server, url = start_server(args.port, query_latency=args.query_latency, synthesis_latency=args.synthesis_latency)
+    print("stub VOICEVOX running at", url)
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,22 +1,61 @@
 # -*- coding: utf-8 -*-
 import os
+import sys
 
-from maya import cmds
+# CHATMAYA_DEV=1 の場合のみ、起動のたびにモジュールを読み込み直す
+DEV_MODE = os.environ.get('CHATMAYA_DEV') == '1'
 
-from . import info, core, prompts, openai_utils, voice, exec_code, settings
-from importlib import reload
-reload(info)
-reload(core)
-reload(prompts)
-reload(openai_utils)
-reload(voice)
-reload(exec_code)
-reload(settings)
+def module_dependencies(module) -> set:
+    # from .x import ... / from . import x で読み込んでいるパッケージ内のモジュール
+    import ast
+    path = getattr(module, '__file__', None)
+    if not path or not path.endswith('.py'):
+        return set()
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read(), path)
+    dependencies = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.ImportFrom) and node.level == 1:
+            if node.module:
+                dependencies.add(node.module.split('.')[0])
+            else:
+                dependencies.update(alias.name for alias in node.names)
+    return dependencies
+
+def reload_order() -> list:
+    # 読み込み済みのchatmaya.*を、依存される側から順に並べる
+    prefix = __name__ + '.'
+    modules = {name[len(prefix):]: module for name, module in list(sys.modules.items())
+               if name.startswith(prefix) and module is not None}
+    order = []
+    visiting = set()
+
+    def visit(name):
+        if name in visiting or name not in modules:
+            return
+        visiting.add(name)
+        for dependency in sorted(module_dependencies(modules[name])):
+            visit(dependency)
+        order.append(name)
+
+    for name in sorted(modules):
+        visit(name)
+    return order
+
+def reload_modules():
+    from importlib import reload
+    for name in reload_order():
+        reload(sys.modules[__name__ + '.' + name])
 
 def run():
+    from maya import cmds
+
     try:
         os.environ['OPENAI_API_KEY']
     except KeyError:
         cmds.error(u'環境変数 OPENAI_API_KEY が設定されていません。')
     else:
-        core.showUI()
\ No newline at end of file
+        if DEV_MODE:
+            reload_modules()
+        from . import core
+        return core.showUI()
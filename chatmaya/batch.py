@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# ウィンドウを開かずにプロンプトの一覧からスクリプトを生成する
+#   mayapy -m chatmaya.batch prompts.txt [--type python|mel] [--model gpt-4] [--concurrency 4]
+#   prompts.txt は1行1プロンプト (空行と#で始まる行は無視)、.jsonl の場合は {"prompt": ..., "type": "mel"}
+#   プロンプトごとに1つのセッションとしてLOG_DIRに書き出し、終わったものは <プロンプトのファイル>.progress.jsonl に記録する
+#   (途中で止めても同じコマンドで続きから実行できる。失敗したものはやり直す)
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from .openai_utils import (
+    DEFAULT_CHAT_MODEL,
+    STREAM_RESET,
+    chat_completion_stream,
+    num_tokens_for_model,
+    num_tokens_from_messages
+)
+from .prompts import SYSTEM_TEMPLATE_PY, SYSTEM_TEMPLATE_MEL, USER_TEMPLATE
+from .journal import SessionJournal, export_messages_json, export_scripts
+from .stream_parser import decompose
+from .cancel import CancelToken
+from .rate_limit import RateScheduler, set_rate_scheduler, STATE_FILE as RATE_STATE_FILE
+
+DEFAULT_CONCURRENCY = 4
+MAX_CONCURRENCY = 16
+PROGRESS_SUFFIX = '.progress.jsonl'
+RATE_STATE_ENV = 'CHATMAYA_RATE_STATE'
+SCRIPT_TYPES = ("python", "mel")
+
+class BatchPrompt(NamedTuple):
+    index :int
+    prompt :str
+    script_type :str
+
+    def key(self, model:str) -> str:
+        # 同じプロンプト/種類/モデルなら同じキー (再開時に終わったものを飛ばす)
+        return hashlib.sha1(json.dumps([self.prompt, self.script_type, model], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class BatchResult(NamedTuple):
+    key :str
+    index :int
+    session :str
+    scripts :List[str]
+    prompt_tokens :int
+    completion_tokens :int
+    seconds :float
+    error :Optional[str]
+
+class BatchSummary(NamedTuple):
+    done :int
+    failed :int
+    skipped :int
+    seconds :float
+    prompt_tokens :int
+    completion_tokens :int
+
+    @property
+    def prompts_per_min(self) -> float:
+        return (self.done + self.failed) * 60 / self.seconds if self.seconds else 0.0
+
+    @property
+    def tokens_per_min(self) -> float:
+        return (self.prompt_tokens + self.completion_tokens) * 60 / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return ("{} done, {} failed, {} skipped in {:.1f}s  "
+                "({:.1f} prompts/min, {:.0f} tokens/min: {} prompt + {} completion)").format(
+            self.done, self.failed, self.skipped, self.seconds,
+            self.prompts_per_min, self.tokens_per_min, self.prompt_tokens, self.completion_tokens)
+
+def system_message(script_type:str) -> Dict:
+    return {"role": "system", "content": SYSTEM_TEMPLATE_PY if script_type == "python" else SYSTEM_TEMPLATE_MEL}
+
+def user_message(prompt:str, script_type:str) -> Dict:
+    return {"role": "user", "content": USER_TEMPLATE.format(
+        script_type="Maya Python" if script_type == "python" else "MEL",
+        questions=prompt)}
+
+def read_prompts(path:Path, script_type:str="python") -> List[BatchPrompt]:
+    path = Path(path)
+    prompts = []
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if path.suffix == '.jsonl':
+                item = json.loads(line)
+                prompt, kind = item["prompt"], item.get("type", script_type)
+            else:
+                prompt, kind = line, script_type
+            if kind not in SCRIPT_TYPES:
+                raise ValueError("unknown script type: {}".format(kind))
+            prompts.append(BatchPrompt(len(prompts), prompt, kind))
+    return prompts
+
+def read_progress(path:Path) -> Dict[str, Dict]:
+    # 成功したものだけを終わったものとみなす
+    done = {}
+    if not Path(path).is_file():
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 書き込み途中で止まった最後の行
+                continue
+            if not record.get("error"):
+                done[record["key"]] = record
+    return done
+
+class BatchRunner(object):
+    # プロンプトごとに新しい会話で返答を受け取り、ウィンドウと同じ形式でログとスクリプトを書き出す
+    # 同時に送るリクエストはconcurrencyまで
+
+    def __init__(self, log_dir:Path, model:str=DEFAULT_CHAT_MODEL, options:Dict=None,
+                 concurrency:int=DEFAULT_CONCURRENCY, progress_path:Path=None):
+        self.log_dir = Path(log_dir)
+        self.model = model
+        self.options = options or {}
+        self.concurrency = max(1, min(int(concurrency), MAX_CONCURRENCY))
+        self.progress_path = Path(progress_path) if progress_path else None
+        self.cancel = CancelToken()
+        self.batch_id = datetime.now().strftime('%y%m%d_%H%M%S')
+        self._lock = threading.Lock()
+
+    def run_one(self, item:BatchPrompt) -> BatchResult:
+        start = time.perf_counter()
+        session = 'session_{}_b{}'.format(self.batch_id, str(item.index).zfill(4))
+        session_dir = self.log_dir / session
+        messages = [system_message(item.script_type), user_message(item.prompt, item.script_type)]
+        prompt_tokens = num_tokens_from_messages(messages, self.model)
+
+        text = ""
+        try:
+            for content in chat_completion_stream(messages=messages, model=self.model, cancel=self.cancel, **self.options):
+                if content is STREAM_RESET:
+                    text = ""
+                    continue
+                text += content
+            if self.cancel.cancelled:
+                raise RuntimeError("cancelled")
+        except Exception as e:
+            return BatchResult(self.key(item), item.index, session, [], prompt_tokens, 0,
+                               time.perf_counter() - start, "{}: {}".format(type(e).__name__, e))
+
+        messages.append({"role": "assistant", "content": text})
+        journal = SessionJournal(session_dir)
+        journal.compact(messages)
+        journal.close()
+        export_messages_json(session_dir)
+
+        _, code_list = decompose(text, item.script_type)
+        scripts = export_scripts(session_dir, code_list, item.script_type)
+
+        return BatchResult(self.key(item), item.index, session, [p.name for p in scripts], prompt_tokens,
+                           num_tokens_for_model(text, self.model), time.perf_counter() - start, None)
+
+    def key(self, item:BatchPrompt) -> str:
+        return item.key(self.model)
+
+    def record(self, result:BatchResult):
+        if self.progress_path is None:
+            return
+        with self._lock:
+            with open(self.progress_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result._asdict(), ensure_ascii=False) + "\n")
+                f.flush()
+
+    def run(self, prompts:List[BatchPrompt], on_result=None) -> BatchSummary:
+        done = read_progress(self.progress_path) if self.progress_path else {}
+        pending = [item for item in prompts if self.key(item) not in done]
+        skipped = len(prompts) - len(pending)
+
+        self.log_dir.mkdir(parents=True, exist_ok=True)
+        results = []
+        start = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        try:
+            futures = [executor.submit(self.run_one, item) for item in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                self.record(result)
+                results.append(result)
+                if on_result is not None:
+                    on_result(result, len(results), len(pending))
+        except KeyboardInterrupt:
+            # 送信中のリクエストを切る (終わったものはprogressに記録済み)
+            self.cancel.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+        ok = [r for r in results if r.error is None]
+        return BatchSummary(
+            done=len(ok),
+            failed=len(results) - len(ok),
+            skipped=skipped,
+            seconds=time.perf_counter() - start,
+            prompt_tokens=sum(r.prompt_tokens for r in results),
+            completion_tokens=sum(r.completion_tokens for r in ok))
+
+_standalone_initialized = False
+
+def init_standalone():
+    # LOG_DIRはmaya.cmdsから決まるので、mayapyの場合はstandaloneを初期化してから読む (1回だけ)
+    global _standalone_initialized
+    if _standalone_initialized:
+        return
+    _standalone_initialized = True
+    try:
+        import maya.standalone
+        maya.standalone.initialize(name='python')
+    except ImportError:
+        pass
+
+def default_log_dir() -> Path:
+    init_standalone()
+    from .info import LOG_DIR
+    return LOG_DIR
+
+def default_rate_state(log_dir:Path) -> Path:
+    # 開いているウィンドウと同じファイルでRPM/TPMの残りを共有する
+    # LOG_DIRはUSER_SETTINGS_DIR/logなので、その親に置く (mayaは読み込まない)
+    path = os.environ.get(RATE_STATE_ENV)
+    if path:
+        return Path(path)
+    return Path(log_dir).parent / RATE_STATE_FILE
+
+def print_result(result:BatchResult, count:int, total:int):
+    if result.error:
+        status = "failed  " + result.error
+    else:
+        status = "{} scripts  {:.1f}s".format(len(result.scripts), result.seconds)
+    print("[{}/{}] #{} {}  {}".format(count, total, result.index, result.session, status))
+
+def main(argv:List[str]=None) -> int:
+    parser = argparse.ArgumentParser(prog="chatmaya.batch", description="Generate scripts from a list of prompts.")
+    parser.add_argument("prompts", type=Path, help=".txt (one prompt per line) or .jsonl ({\"prompt\": ..., \"type\": ...})")
+    parser.add_argument("--type", choices=SCRIPT_TYPES, default="python")
+    parser.add_argument("--model", default=DEFAULT_CHAT_MODEL)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--log-dir", type=Path, help="default: ChatMaya LOG_DIR")
+    parser.add_argument("--progress", type=Path, help="default: <prompts>" + PROGRESS_SUFFIX)
+    parser.add_argument("--rate-state", type=Path, help="default: ${} or <log-dir>/../{}".format(RATE_STATE_ENV, RATE_STATE_FILE))
+    parser.add_argument("--no-rate-limit", action="store_true", help="do not wait for the RPM/TPM limits before sending")
+    parser.add_argument("--temperature", type=float, default=0.7)
+    parser.add_argument("--top-p", type=float, default=1.0)
+    parser.add_argument("--presence-penalty", type=float, default=0.0)
+    parser.add_argument("--frequency-penalty", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    if not os.environ.get('OPENAI_API_KEY'):
+        print(u'環境変数 OPENAI_API_KEY が設定されていません。', file=sys.stderr)
+        return 2
+
+    prompts = read_prompts(args.prompts, args.type)
+    log_dir = args.log_dir or default_log_dir()
+    if not args.no_rate_limit:
+        set_rate_scheduler(RateScheduler(args.rate_state or default_rate_state(log_dir)))
+    runner = BatchRunner(
+        log_dir=log_dir,
+        model=args.model,
+        options={
+            "temperature": args.temperature,
+            "top_p": args.top_p,
+            "presence_penalty": args.presence_penalty,
+            "frequency_penalty": args.frequency_penalty,
+        },
+        concurrency=args.concurrency,
+        progress_path=args.progress or args.prompts.with_name(args.prompts.name + PROGRESS_SUFFIX))
+
+    print("{} prompts, model {}, concurrency {}, log {}".format(len(prompts), runner.model, runner.concurrency, runner.log_dir))
+    try:
+        summary = runner.run(prompts, on_result=print_result)
+    except KeyboardInterrupt:
+        print("interrupted. run the same command again to resume.")
+        return 130
+    print(summary)
+    return 1 if summary.failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
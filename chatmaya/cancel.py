@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+from typing import Callable
+
+class CancelToken(object):
+    # 中断の合図。cancel()されたら登録されたコールバック(受信中の接続を閉じるなど)をすぐに呼ぶ
+
+    def __init__(self):
+        self.cancelled_at = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, *args):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def register(self, callback:Callable[[], None]) -> Callable[[], None]:
+        # 登録を解除する関数を返す。既に中断されていればその場で呼ぶ
+        with self._lock:
+            if not self._event.is_set():
+                key = self._next_id
+                self._next_id += 1
+                self._callbacks[key] = callback
+                return lambda: self._unregister(key)
+        callback()
+        return lambda: None
+
+    def _unregister(self, key:int):
+        with self._lock:
+            self._callbacks.pop(key, None)
+
+    def wait(self, timeout:float=None) -> bool:
+        return self._event.wait(timeout)
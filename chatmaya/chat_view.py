@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+import math
+from typing import List, NamedTuple
+
+from PySide2 import QtWidgets, QtCore, QtGui
+
+from .stream_parser import FENCE
+
+TEXT = "text"
+CODE = "code"
+
+CODE_MAX_LINES = 40 # これより長いコードブロックは省略して表示
+PADDING = 5
+BLOCK_SPACING = 4
+CODE_PADDING = 4
+STREAM_RESERVE_LINES = 10 # ストリーム中の行は高さを多めに(この行数か現在の半分)確保し、配置し直す回数を減らす
+
+BACKGROUND_COLORS = ("#27272e", "#363842")
+CODE_BACKGROUND_COLOR = "#1e1e23"
+ELIDED_TEXT_COLOR = "#8c8c96"
+
+RowRole = QtCore.Qt.UserRole + 1
+
+class Block(NamedTuple):
+    kind :str
+    text :str
+    hidden_lines :int = 0
+
+def split_blocks(text:str, max_code_lines:int=CODE_MAX_LINES) -> List[Block]:
+    # 文章とコードブロックに分ける (ストリーム中の閉じていないブロックは末尾までコード)
+    blocks = []
+    lines = []
+    in_code = False
+
+    def add_block():
+        if in_code:
+            hidden = max(len(lines) - max_code_lines, 0)
+            blocks.append(Block(CODE, "\n".join(lines[:max_code_lines]), hidden))
+        else:
+            content = "\n".join(lines).strip("\n")
+            if content:
+                blocks.append(Block(TEXT, content))
+
+    for line in text.split("\n"):
+        if line.lstrip(" \t").startswith(FENCE):
+            add_block()
+            # 閉じるフェンスの後に続く文は残す (開くフェンスの後は言語名)
+            rest = line.lstrip(" \t")[len(FENCE):]
+            lines = [rest] if in_code and rest.strip() else []
+            in_code = not in_code
+        elif not in_code and FENCE in line:
+            # 文の後に続くフェンス (StreamParserと同じく開始とみなす)
+            lines.append(line[:line.index(FENCE)])
+            add_block()
+            in_code = True
+            lines = []
+        else:
+            lines.append(line)
+    if lines or in_code:
+        add_block()
+    return blocks
+
+class LayoutItem(object):
+    __slots__ = ('block', 'top', 'height', 'text')
+
+    def __init__(self, block:Block, top:float, height:float, text:QtGui.QStaticText=None):
+        self.block = block
+        self.top = top
+        self.height = height
+        self.text = text # コードは描画する時に作る
+
+class RowLayout(NamedTuple):
+    width :int
+    height :int
+    items :List[LayoutItem]
+
+class ChatRow(object):
+    __slots__ = ('text', 'height', 'reserved', '_blocks', 'layout')
+
+    def __init__(self, text:str=""):
+        self.text = text
+        self.height = None # ビューに返した高さ (テキストが変わっても残す)
+        self.reserved = 0
+        self._blocks = None
+        self.layout = None
+
+    def set_text(self, text:str):
+        self.text = text
+        self._blocks = None
+        self.layout = None
+
+    def blocks(self) -> List[Block]:
+        if self._blocks is None:
+            self._blocks = split_blocks(self.text)
+        return self._blocks
+
+class ChatModel(QtCore.QAbstractListModel):
+    # チャット欄の1行1メッセージ (QStringListModelと同じ使い方ができる)
+
+    def __init__(self, parent=None):
+        super(ChatModel, self).__init__(parent)
+        self._rows :List[ChatRow] = []
+
+    def rowCount(self, parent=QtCore.QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._rows)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid() or not 0 <= index.row() < len(self._rows):
+            return None
+        row = self._rows[index.row()]
+        if role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return row.text
+        if role == RowRole:
+            return row
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole) -> bool:
+        if not index.isValid() or role not in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return False
+        row = self._rows[index.row()]
+        value = value or ""
+        if row.text != value:
+            row.set_text(value)
+            self.dataChanged.emit(index, index, [role])
+        return True
+
+    def flags(self, index):
+        if not index.isValid():
+            return QtCore.Qt.NoItemFlags
+        return QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEditable
+
+    def insertRows(self, row:int, count:int, parent=QtCore.QModelIndex()) -> bool:
+        if parent.isValid() or count < 1 or not 0 <= row <= len(self._rows):
+            return False
+        self.beginInsertRows(parent, row, row + count - 1)
+        self._rows[row:row] = [ChatRow() for _ in range(count)]
+        self.endInsertRows()
+        return True
+
+    def removeRows(self, row:int, count:int, parent=QtCore.QModelIndex()) -> bool:
+        if parent.isValid() or count < 1 or row < 0 or row + count > len(self._rows):
+            return False
+        self.beginRemoveRows(parent, row, row + count - 1)
+        del self._rows[row:row + count]
+        self.endRemoveRows()
+        return True
+
+    def setStringList(self, texts:List[str]):
+        self.beginResetModel()
+        self._rows = [ChatRow(text) for text in texts]
+        self.endResetModel()
+
+    def stringList(self) -> List[str]:
+        return [row.text for row in self._rows]
+
+class ChatDelegate(QtWidgets.QStyledItemDelegate):
+    # 行ごとのレイアウト(ブロックの位置と高さ)を幅と一緒にキャッシュし、変更された行のみ測り直す
+
+    def __init__(self, view:QtWidgets.QListView):
+        super(ChatDelegate, self).__init__(view)
+        self.view = view
+        self.text_font = QtGui.QFont(view.font())
+        self.code_font = QtGui.QFontDatabase.systemFont(QtGui.QFontDatabase.FixedFont)
+        self.code_font.setStyleHint(QtGui.QFont.TypeWriter)
+        if self.text_font.pointSizeF() > 0:
+            self.code_font.setPointSizeF(self.text_font.pointSizeF())
+        self.line_height = QtGui.QFontMetrics(self.text_font).height()
+        self.code_line_height = QtGui.QFontMetrics(self.code_font).lineSpacing()
+        self.layout_count = 0 # 測り直した回数
+
+    def content_width(self) -> int:
+        return self.view.viewport().width()
+
+    def static_text(self, text:str, font:QtGui.QFont, width:float=None) -> QtGui.QStaticText:
+        # QStaticTextは改行文字を行区切りとして扱わない
+        static = QtGui.QStaticText(text.replace("\n", u"\u2028"))
+        static.setTextFormat(QtCore.Qt.PlainText)
+        static.setPerformanceHint(QtGui.QStaticText.AggressiveCaching)
+        if width is not None:
+            static.setTextWidth(width)
+        static.prepare(QtGui.QTransform(), font)
+        return static
+
+    def row_layout(self, row:ChatRow, width:int) -> RowLayout:
+        if row.layout is not None and row.layout.width == width:
+            return row.layout
+        self.layout_count += 1
+
+        inner = max(width - PADDING * 2, 1)
+        items = []
+        top = PADDING
+        for block in row.blocks():
+            if block.kind == CODE:
+                # コードは折り返さないので行数から高さが決まる
+                static = None
+                height = (block.text.count("\n") + 1) * self.code_line_height + CODE_PADDING * 2
+                if block.hidden_lines:
+                    height += self.line_height
+            else:
+                static = self.static_text(block.text, self.text_font, inner)
+                height = static.size().height()
+            items.append(LayoutItem(block, top, height, static))
+            top += height + BLOCK_SPACING
+        if items:
+            top -= BLOCK_SPACING
+        else:
+            top += self.line_height
+
+        row.layout = RowLayout(width, int(math.ceil(top + PADDING)), items)
+        return row.layout
+
+    def row_height(self, row:ChatRow, width:int) -> int:
+        return max(self.row_layout(row, width).height, row.reserved)
+
+    def sizeHint(self, option, index) -> QtCore.QSize:
+        row = index.data(RowRole)
+        if row is None:
+            return super(ChatDelegate, self).sizeHint(option, index)
+        width = self.content_width()
+        row.height = self.row_height(row, width)
+        return QtCore.QSize(width, row.height)
+
+    def paint(self, painter, option, index):
+        row = index.data(RowRole)
+        if row is None:
+            return super(ChatDelegate, self).paint(painter, option, index)
+        layout = self.row_layout(row, self.content_width())
+        rect = option.rect
+
+        painter.save()
+        painter.setClipRect(rect)
+        painter.fillRect(rect, QtGui.QColor(BACKGROUND_COLORS[index.row() % 2]))
+        if option.state & QtWidgets.QStyle.State_Selected:
+            highlight = QtGui.QColor(option.palette.color(QtGui.QPalette.Highlight))
+            highlight.setAlpha(80)
+            painter.fillRect(rect, highlight)
+
+        text_color = option.palette.color(QtGui.QPalette.Text)
+        left = rect.left() + PADDING
+        inner = rect.width() - PADDING * 2
+        for item in layout.items:
+            top = rect.top() + item.top
+            if item.block.kind == CODE:
+                block_rect = QtCore.QRectF(left, top, inner, item.height)
+                painter.fillRect(block_rect, QtGui.QColor(CODE_BACKGROUND_COLOR))
+                painter.save()
+                painter.setClipRect(block_rect, QtCore.Qt.IntersectClip)
+                painter.setFont(self.code_font)
+                painter.setPen(text_color)
+                if item.text is None:
+                    item.text = self.static_text(item.block.text, self.code_font)
+                painter.drawStaticText(QtCore.QPointF(left + CODE_PADDING, top + CODE_PADDING), item.text)
+                if item.block.hidden_lines:
+                    painter.setPen(QtGui.QColor(ELIDED_TEXT_COLOR))
+                    painter.drawText(
+                        QtCore.QRectF(left + CODE_PADDING, block_rect.bottom() - CODE_PADDING - self.line_height,
+                                      inner, self.line_height),
+                        QtCore.Qt.AlignLeft | QtCore.Qt.AlignVCenter,
+                        u"... ({} more lines)".format(item.block.hidden_lines))
+                painter.restore()
+            else:
+                painter.setFont(self.text_font)
+                painter.setPen(text_color)
+                painter.drawStaticText(QtCore.QPointF(left, top), item.text)
+        painter.restore()
+
+    # ダブルクリックで全文を選択/コピーできるようにする
+    def createEditor(self, parent, option, index):
+        editor = QtWidgets.QPlainTextEdit(parent)
+        editor.setFrameShape(QtWidgets.QFrame.NoFrame)
+        return editor
+
+    def setEditorData(self, editor, index):
+        editor.setPlainText(index.data(QtCore.Qt.EditRole) or "")
+
+    def setModelData(self, editor, model, index):
+        model.setData(index, editor.toPlainText(), QtCore.Qt.EditRole)
+
+    def updateEditorGeometry(self, editor, option, index):
+        editor.setGeometry(option.rect)
+
+class ChatView(QtWidgets.QListView):
+    # 変更された行は再描画のみ行い、高さが変わった時だけ全体を配置し直す
+
+    def __init__(self, parent=None):
+        super(ChatView, self).__init__(parent)
+        self.chat_delegate = ChatDelegate(self)
+        self.setItemDelegate(self.chat_delegate)
+        self.setWordWrap(True)
+        self.setUniformItemSizes(False)
+        self.setVerticalScrollMode(QtWidgets.QAbstractItemView.ScrollPerPixel)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.verticalScrollBar().setSingleStep(20)
+        self.stream_index = None
+
+    def begin_stream(self, *args):
+        # 最終行をストリーム中の行とする
+        self.end_stream()
+        model = self.model()
+        if model is not None and model.rowCount():
+            self.stream_index = QtCore.QPersistentModelIndex(model.index(model.rowCount() - 1, 0))
+
+    def end_stream(self, *args):
+        # 確保していた高さを戻す
+        index, self.stream_index = self.stream_index, None
+        if index is None or not index.isValid():
+            return
+        index = self.model().index(index.row(), 0)
+        row = index.data(RowRole)
+        if row is not None and row.reserved:
+            row.reserved = 0
+            if self.chat_delegate.row_height(row, self.chat_delegate.content_width()) != row.height:
+                self.chat_delegate.sizeHintChanged.emit(index)
+
+    def dataChanged(self, top_left, bottom_right, roles=[]):
+        # QListViewはデータが変わるたびに全行を配置し直すため、再描画のみ行う
+        QtWidgets.QAbstractItemView.dataChanged(self, top_left, bottom_right, roles)
+        width = self.chat_delegate.content_width()
+        stream_row = self.stream_index.row() if self.stream_index is not None and self.stream_index.isValid() else -1
+        for row_number in range(top_left.row(), bottom_right.row() + 1):
+            index = self.model().index(row_number, 0)
+            row = index.data(RowRole)
+            if row is None:
+                continue
+            height = self.chat_delegate.row_layout(row, width).height
+            if row_number == stream_row and height > row.reserved:
+                row.reserved = height + max(STREAM_RESERVE_LINES * self.chat_delegate.line_height, height // 2)
+            if self.chat_delegate.row_height(row, width) != row.height:
+                self.chat_delegate.sizeHintChanged.emit(index)
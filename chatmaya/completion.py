@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+import time
+import queue
+from typing import Callable, Dict, Iterator, List, Tuple
+
+from PySide2 import QtCore
+
+from .openai_utils import chat_completion_stream, chat_completion_stream_n, num_tokens_for_model, STREAM_RESET
+from .completion_cache import CompletionCache
+from .cancel import CancelToken
+from .stream_parser import StreamParser, ParserEvent, SENTENCE, CODE_END
+from .metrics import MetricsRegistry, METRICS, TTFT, TOKENS_PER_SEC, COMPLETION_TOKENS, use_metrics
+from .trace import TRACER
+
+RENDER_FPS = 30 # チャット欄の最大再描画回数/秒
+
+def indexed(stream:Iterator[str], index:int=0) -> Iterator[Tuple[int, str]]:
+    try:
+        for content in stream:
+            if content is STREAM_RESET:
+                yield content
+                continue
+            yield index, content
+    finally:
+        stream.close()
+
+class CompletionWorker(QtCore.QObject):
+    # ワーカースレッドでストリームを受信し、差分をシグナルで通知する
+    # 候補が複数の場合、チャット欄と読み上げは1つ目の候補のみ
+
+    delta = QtCore.Signal(str)
+    reset = QtCore.Signal()
+    code_block = QtCore.Signal(int, str, str)
+    finished = QtCore.Signal(str, str, bool)
+    failed = QtCore.Signal(str)
+
+    def __init__(self, messages:List[Dict], model:str, options:Dict, voice_queue:queue.Queue, 
+                 cache:CompletionCache=None, bypass_cache:bool=False, candidates:int=1,
+                 cancel:CancelToken=None, clear_voice:Callable=None, metrics:MetricsRegistry=METRICS, parent=None):
+        super(CompletionWorker, self).__init__(parent)
+        self.messages = list(messages)
+        self.model = model
+        self.options = options
+        self.voice_queue = voice_queue
+        self.clear_voice = clear_voice
+        self.metrics = metrics
+        self.cache = cache
+        self.bypass_cache = bypass_cache
+        self.candidates = max(1, candidates)
+        self.cache_hit = False
+        self.cancel = cancel or CancelToken()
+        self.texts = []
+        self.comments = []
+
+    @property
+    def stop_requested(self) -> bool:
+        return self.cancel.cancelled
+
+    def stop(self, *args):
+        # UIスレッドから呼ばれ、受信中の接続をその場で切る
+        self.cancel.cancel()
+
+    def open_stream(self) -> Iterator[Tuple[int, str]]:
+        if self.candidates > 1:
+            # 複数候補はキャッシュしない
+            return chat_completion_stream_n(messages=self.messages, model=self.model, n=self.candidates,
+                                            cancel=self.cancel, **self.options)
+        if self.cache is not None:
+            return indexed(self.cache.stream(messages=self.messages, model=self.model, bypass=self.bypass_cache,
+                                             cancel=self.cancel, **self.options))
+        return indexed(chat_completion_stream(messages=self.messages, model=self.model, cancel=self.cancel, **self.options))
+
+    def run(self):
+        # API呼び出し(リトライ/レート制限の待ち)の記録もこのウィンドウの集計に入れる
+        with use_metrics(self.metrics):
+            self._run()
+
+    def _run(self):
+        texts = [""] * self.candidates
+        parsers = [StreamParser() for _ in range(self.candidates)]
+        first_token_at = None
+
+        start = time.perf_counter()
+        stream = self.open_stream()
+
+        try:
+            for item in stream:
+                if self.stop_requested:
+                    break
+                if item is STREAM_RESET:
+                    # 再接続後に返答が変わったので最初から受け直す
+                    # 前の返答の読み上げは新しい返答の文を入れる前にこのスレッドで捨てる (二重に読まないため)
+                    if self.clear_voice is not None:
+                        self.clear_voice()
+                    texts = [""] * self.candidates
+                    parsers = [StreamParser() for _ in range(self.candidates)]
+                    self.reset.emit()
+                    continue
+                index, content = item
+                with TRACER.span("chunk", "completion"):
+                    texts[index] += content
+                    if index == 0:
+                        if first_token_at is None:
+                            first_token_at = time.perf_counter()
+                            TRACER.instant("first token", "completion")
+                        self.delta.emit(content)
+                    with TRACER.span("parse", "completion"):
+                        events = parsers[index].feed(content)
+                    self.handle_events(index, events)
+
+        except Exception as e:
+            if not self.stop_requested:
+                self.failed.emit(str(e))
+                return
+        finally:
+            stream.close()
+            if self.cache is not None and self.candidates == 1:
+                self.cache_hit = self.cache.last_hit
+
+        # 最後の文や閉じていないコードブロック
+        end = time.perf_counter()
+        TRACER.complete("completion", start, end, "completion", {"model": self.model, "candidates": self.candidates})
+        if not self.stop_requested:
+            for index, parser in enumerate(parsers):
+                with TRACER.span("parse", "completion"):
+                    events = parser.close()
+                self.handle_events(index, events)
+            self.record_metrics(texts[0], start, first_token_at, end)
+
+        # 2つ目以降の候補のコードを実行した場合に、その候補を履歴に残せるようにする
+        self.texts = texts
+        self.comments = [parser.comment() for parser in parsers]
+        self.finished.emit(texts[0], parsers[0].comment(), self.stop_requested)
+
+    def record_metrics(self, text:str, start:float, first_token_at:float, end:float):
+        # キャッシュからの再生はAPIの速度ではないので記録しない
+        if self.cache_hit or first_token_at is None:
+            return
+        elapsed = end - first_token_at
+        tokens = num_tokens_for_model(text, self.model)
+        self.metrics.observe(TTFT, (first_token_at - start) * 1000)
+        self.metrics.inc(COMPLETION_TOKENS, tokens)
+        if elapsed > 0 and tokens > 1:
+            # 最初のトークン以降の受信速度
+            self.metrics.observe(TOKENS_PER_SEC, (tokens - 1) / elapsed)
+
+    def handle_events(self, candidate:int, events:List[ParserEvent]):
+        for event in events:
+            if event.kind == SENTENCE:
+                # ボイス合成キューに１文ずつ追加
+                if candidate == 0:
+                    self.voice_queue.put(event.text)
+            elif event.kind == CODE_END:
+                self.code_block.emit(candidate, event.lang, event.text)
+
+class StreamRenderer(QtCore.QObject):
+    # 受け取った差分をまとめ、一定間隔でチャット欄の最終行に反映する
+
+    def __init__(self, model:QtCore.QAbstractItemModel, view, fps:int=RENDER_FPS, parent=None):
+        super(StreamRenderer, self).__init__(parent)
+        self.model = model
+        self.view = view
+        self.text = ""
+        self._dirty = False
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(int(1000 / fps))
+        self.timer.timeout.connect(self.flush)
+
+    def start(self, *args):
+        self.text = ""
+        self._dirty = False
+        self.view.begin_stream()
+        self.timer.start()
+
+    def clear(self, *args):
+        self.text = ""
+        self._dirty = True
+
+    def append(self, content:str):
+        self.text += content
+        self._dirty = True
+
+    def flush(self, *args):
+        if not self._dirty:
+            return
+        self._dirty = False
+        with TRACER.span("render", "ui"):
+            self.model.setData(self.model.index(self.model.rowCount() - 1), self.text)
+            self.view.scrollToBottom()
+
+    def stop(self, *args):
+        self.timer.stop()
+        self.flush()
+        self.view.end_stream()
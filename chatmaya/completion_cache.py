@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List
+
+from .disk_cache import DiskLRUCache, make_key
+from .openai_utils import chat_completion_stream, STREAM_RESET
+from .cancel import CancelToken
+
+CACHE_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 7 * 24 * 60 * 60 # 秒
+REPLAY_CHUNK_CHARS = 8
+
+class CompletionCache(object):
+    # model/オプション/messagesが同じリクエストの返答をディスクに保存し、ストリームとして再生する
+
+    def __init__(self, directory:Path, max_bytes:int=CACHE_BYTES, ttl:float=CACHE_TTL):
+        self.store = DiskLRUCache(directory, max_bytes, ".json")
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.last_hit = False
+
+    @staticmethod
+    def key(messages:List[Dict], model:str, options:Dict) -> str:
+        return make_key(model, options, [dict(m) for m in messages])
+
+    def _valid(self, entry) -> bool:
+        # 壊れた/古い形式のエントリや空の返答はヒットとして扱わない
+        if not isinstance(entry, dict):
+            return False
+        created, content = entry.get("created"), entry.get("content")
+        if not isinstance(created, (int, float)) or not isinstance(content, str) or not content.strip():
+            return False
+        return time.time() - created <= self.ttl
+
+    def get(self, key:str):
+        data = self.store.get(key)
+        entry = None
+        if data is not None:
+            try:
+                entry = json.loads(data.decode('utf-8'))
+            except ValueError:
+                pass
+            if not self._valid(entry):
+                self.store.delete(key)
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["content"]
+
+    def put(self, key:str, content:str):
+        entry = {"created": time.time(), "content": content}
+        self.store.put(key, json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+
+    def stream(self, messages:List[Dict], model:str, bypass:bool=False, cancel:CancelToken=None, **kwargs) -> Iterator[str]:
+        key = self.key(messages, model, kwargs)
+
+        if not bypass:
+            content = self.get(key)
+            if content is not None:
+                self.last_hit = True
+                yield from replay(content)
+                return
+
+        self.last_hit = False
+        message_text = ""
+        for content in chat_completion_stream(messages=messages, model=model, cancel=cancel, **kwargs):
+            if content is STREAM_RESET:
+                message_text = ""
+            else:
+                message_text += content
+            yield content
+
+        # 途中で止めた場合(GeneratorExit/中断)や空の返答は保存しない
+        if cancel is not None and cancel.cancelled:
+            return
+        if not message_text.strip():
+            return
+        self.put(key, message_text)
+
+def replay(content:str, chunk_chars:int=REPLAY_CHUNK_CHARS) -> Iterator[str]:
+    # キャッシュした返答をストリームと同じように少しずつ返す
+    for i in range(0, len(content), chunk_chars):
+        yield content[i:i + chunk_chars]
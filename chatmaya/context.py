@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Pattern
+
+from .openai_utils import (
+    DEFAULT_CHAT_MODEL,
+    REPLY_PRIMING_TOKENS,
+    context_window,
+    num_tokens_for_model,
+    num_tokens_from_message
+)
+from .history import MessageHistory
+from .stream_parser import normalize_lang
+from .prompts import USER_TEMPLATE, FIX_TEMPLATE, SUMMARY_TEMPLATE, CODE_REFERENCE_TEMPLATE
+
+RESERVED_COMPLETION_TOKENS = 1024 # 返答用に空けておくトークン数
+KEEP_RECENT_MESSAGES = 2 # 最新の質問と返答は常にそのまま送る
+MAX_SENT_MESSAGES = 10 # これより古いメッセージは予算に収まっても要約にする
+SUMMARY_MAX_TOKENS = 400
+SUMMARY_LINE_CHARS = 120
+REFERENCE_COMMANDS = 4 # 省略したコードの参照に残すコマンド名の数
+CACHE_SIZE = 2048
+
+CODE_BLOCK_PATTERN = re.compile(r'^[ \t]*```[ \t]*([\w+-]*)[^\n]*\n(.*?)(?:^[ \t]*```[ \t]*$|\Z)', re.M | re.S)
+PY_COMMAND_PATTERN = re.compile(r'\b(?:cmds|mc|pm|om|om2)\.(\w+)')
+MEL_COMMAND_PATTERN = re.compile(r'(?:^|[;{])\s*([a-z][A-Za-z0-9_]*)\b', re.M)
+MEL_KEYWORDS = {"if", "else", "for", "while", "do", "switch", "case", "return", "global", "proc",
+                "string", "int", "float", "vector", "matrix", "break", "continue"}
+
+def template_pattern(template:str, field:str) -> Pattern:
+    # テンプレートから埋め込んだ部分だけを取り出す正規表現を作る
+    head, tail = template.split("{" + field + "}")
+    head = re.escape(head).replace(re.escape("{script_type}"), ".*?")
+    return re.compile(head + "(.*)" + re.escape(tail) + r"\Z", re.S)
+
+QUESTION_PATTERN = template_pattern(USER_TEMPLATE, "questions")
+ERROR_PATTERN = template_pattern(FIX_TEMPLATE, "error")
+
+def has_code(text:str) -> bool:
+    return CODE_BLOCK_PATTERN.search(text) is not None
+
+def is_error_report(message:Dict) -> bool:
+    return message.get("role") == "user" and ERROR_PATTERN.match(message.get("content") or "") is not None
+
+def code_commands(code:str, lang:str) -> List[str]:
+    if lang == "mel":
+        names = [name for name in MEL_COMMAND_PATTERN.findall(code) if name not in MEL_KEYWORDS]
+    else:
+        names = PY_COMMAND_PATTERN.findall(code)
+    return list(OrderedDict.fromkeys(names))[:REFERENCE_COMMANDS]
+
+def elide_code(text:str) -> str:
+    # コードブロックを行数と使っているコマンド名だけの短い参照に置き換える
+    def reference(match):
+        lang = normalize_lang(match.group(1)) or "code"
+        code = match.group(2).strip("\n")
+        commands = code_commands(code, lang)
+        return CODE_REFERENCE_TEMPLATE.format(
+            lang=lang,
+            lines=len(code.splitlines()),
+            commands=", uses " + ", ".join(commands) if commands else "")
+    return CODE_BLOCK_PATTERN.sub(reference, text)
+
+def shorten(text:str, limit:int=SUMMARY_LINE_CHARS) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit - 1] + u"…"
+
+def summary_line(message:Dict) -> str:
+    # 1メッセージを1行にする (LLMは使わず抜き出すだけ)
+    content = message.get("content") or ""
+    if message.get("role") == "user":
+        match = ERROR_PATTERN.match(content)
+        if match:
+            lines = [line for line in match.group(1).strip().splitlines() if line.strip()]
+            return u"Error: " + shorten(lines[-1] if lines else "")
+        match = QUESTION_PATTERN.match(content)
+        return u"Q: " + shorten(match.group(1) if match else content)
+    elided = elide_code(content)
+    references = re.findall(r'\[[^\]]*script omitted[^\]]*\]', elided)
+    prose = shorten(re.sub(r'\[[^\]]*script omitted[^\]]*\]', " ", elided))
+    return u"A: " + " ".join([prose] + references).strip()
+
+class ContextResult(NamedTuple):
+    messages :List[Dict]
+    prompt_tokens :int
+    budget :int
+    elided :int       # コードを参照に置き換えた返答の数
+    summarized :int   # 要約に回したメッセージの数
+    dropped :int      # 要約にも入らず削ったメッセージの数
+
+class ContextManager(object):
+    # 送信するメッセージをモデルのコンテキスト長に収める (履歴自体は変更しない)
+    # 1. 最新のやり取り/最新のコードとそれ以降のエラーはそのまま
+    # 2. それより古い返答のコードブロックは短い参照に置き換える
+    # 3. まだ収まらなければ古い順に1行ずつの要約(system)にまとめる
+    # 省略/要約した結果はメッセージごとにキャッシュし、次のリクエストで使い回す
+
+    def __init__(self, max_prompt_tokens:int=None, reserved_tokens:int=RESERVED_COMPLETION_TOKENS,
+                 keep_recent:int=KEEP_RECENT_MESSAGES, max_messages:int=MAX_SENT_MESSAGES,
+                 summary_tokens:int=SUMMARY_MAX_TOKENS):
+        self.max_prompt_tokens = max_prompt_tokens
+        self.reserved_tokens = reserved_tokens
+        self.keep_recent = keep_recent
+        self.max_messages = max_messages
+        self.summary_tokens = summary_tokens
+        self._elided = OrderedDict()
+        self._lines = OrderedDict()
+        self._tokens = OrderedDict()
+
+    def budget(self, model:str) -> int:
+        budget = context_window(model) - self.reserved_tokens
+        if self.max_prompt_tokens:
+            budget = min(budget, self.max_prompt_tokens)
+        return budget
+
+    @staticmethod
+    def _cached(cache:OrderedDict, key, func):
+        value = cache.get(key)
+        if value is None:
+            value = func()
+            cache[key] = value
+            if len(cache) > CACHE_SIZE:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return value
+
+    def count(self, message:Dict, model:str=DEFAULT_CHAT_MODEL) -> int:
+        # APIと同じ数え方 (1メッセージごとの区切りを含む)
+        return self._cached(self._tokens, (model,) + tuple(sorted(message.items())),
+                            lambda: num_tokens_from_message(message, model))
+
+    def count_message(self, messages:List[Dict], index:int, message:Dict, model:str=DEFAULT_CHAT_MODEL) -> int:
+        # 履歴のメッセージそのままならMessageHistoryの数えた値を使う (キャッシュを2重に持たない)
+        if isinstance(messages, MessageHistory) and messages.model == model and messages[index] is message:
+            return messages.token_count(index)
+        return self.count(message, model)
+
+    def count_text(self, text:str, model:str=DEFAULT_CHAT_MODEL) -> int:
+        return self._cached(self._tokens, (model, text), lambda: num_tokens_for_model(text, model))
+
+    def elide(self, message:Dict) -> Dict:
+        content = message.get("content") or ""
+        elided = self._cached(self._elided, content, lambda: elide_code(content))
+        return message if elided == content else dict(message, content=elided)
+
+    def summary_line(self, message:Dict) -> str:
+        return self._cached(self._lines, (message.get("role"), message.get("content") or ""),
+                            lambda: summary_line(message))
+
+    def keep_indices(self, turns:List[Dict]) -> set:
+        n = len(turns)
+        keep = set(range(max(n - self.keep_recent, 0), n))
+        for i in reversed(range(n)):
+            if turns[i].get("role") == "assistant" and has_code(turns[i].get("content") or ""):
+                # 最新のコードとその質問、それ以降のエラー報告
+                keep.update((i - 1, i) if i > 0 else (i,))
+                keep.update(j for j in range(i + 1, n) if is_error_report(turns[j]))
+                break
+        return keep
+
+    def summary_lines(self, lines:List[str], model:str=DEFAULT_CHAT_MODEL) -> List[str]:
+        # 新しい行から上限まで残す
+        kept = []
+        tokens = self.count({"role": "system", "content": SUMMARY_TEMPLATE.format(summary="")}, model)
+        for line in reversed(lines):
+            line_tokens = self.count_text(line, model) + 1
+            if tokens + line_tokens > self.summary_tokens:
+                break
+            kept.append(line)
+            tokens += line_tokens
+        kept.reverse()
+        return kept
+
+    def make_summary(self, lines:List[str], model:str=DEFAULT_CHAT_MODEL) -> Optional[Dict]:
+        kept = self.summary_lines(lines, model)
+        if not kept:
+            return None
+        return {"role": "system", "content": SUMMARY_TEMPLATE.format(summary="\n".join(kept))}
+
+    def build(self, messages:List[Dict], model:str, examples:Dict=None) -> ContextResult:
+        budget = self.budget(model)
+        system, turns = list(messages[:1]), list(messages[1:])
+        keep = self.keep_indices(turns)
+
+        body = [m if i in keep or m.get("role") != "assistant" else self.elide(m) for i, m in enumerate(turns)]
+        tokens = [self.count_message(messages, i + 1, m, model) for i, m in enumerate(body)]
+        fixed = sum(self.count_message(messages, 0, m, model) for m in system) + REPLY_PRIMING_TOKENS
+        example_tokens = self.count(examples, model) if examples else 0
+        total = fixed + sum(tokens)
+
+        # 古い順に要約へ回す (そのまま送るメッセージの手前まで)
+        start = 0
+        lines = []
+        line_tokens = self.count({"role": "system", "content": SUMMARY_TEMPLATE.format(summary="")}, model)
+        summary_tokens = 0
+        while start < len(body) and start not in keep and (
+                len(body) - start > self.max_messages or total + summary_tokens + example_tokens > budget):
+            total -= tokens[start]
+            lines.append(self.summary_line(turns[start]))
+            start += 1
+            # 要約は上限を超えたら古い行から捨てるので、上限で頭打ちになる
+            line_tokens += self.count_text(lines[-1], model) + 1
+            summary_tokens = min(line_tokens, self.summary_tokens)
+        summary = self.make_summary(lines, model)
+        summary_tokens = self.count(summary, model) if summary else 0
+
+        # 残したメッセージ自体が大きすぎる場合は、例/要約/古いメッセージの順に削る
+        dropped = 0
+        if total + summary_tokens + example_tokens > budget:
+            examples, example_tokens = None, 0
+        if total + summary_tokens > budget:
+            summary, summary_tokens = None, 0
+        while total > budget and start < len(body) - 1:
+            total -= tokens[start]
+            start += 1
+            dropped += 1
+
+        result = system + ([summary] if summary else []) + body[start:]
+        if examples:
+            result.insert(len(result) - 1, examples)
+        return ContextResult(
+            messages=result,
+            prompt_tokens=total + summary_tokens + example_tokens,
+            budget=budget,
+            elided=sum(1 for m, original in zip(body[start:], turns[start:]) if m is not original),
+            summarized=len(lines) if summary else 0,
+            dropped=dropped if summary else dropped + len(lines))
@@ -1,16 +1,14 @@
 # -*- coding: utf-8 -*-
-import json
-import re
-from uuid import uuid4
 from pathlib import Path
 from datetime import datetime
 from concurrent.futures import ThreadPoolExecutor
+import time
 import queue
-import keyboard
+import threading
 import subprocess
 
 from maya import cmds, OpenMaya, OpenMayaUI
-from PySide2 import QtWidgets, QtCore
+from PySide2 import QtWidgets, QtCore, QtGui
 from shiboken2 import wrapInstance
 
 from .info import (
@@ -20,7 +18,8 @@ from .info import (
     USER_SETTINGS_DIR,
     USER_SETTINGS_INI,
     USER_SETTINGS_JSON,
-    LOG_DIR
+    LOG_DIR,
+    ensure_dirs
 )
 from .prompts import (
     SYSTEM_TEMPLATE_PY,
@@ -28,22 +27,35 @@ from .prompts import (
     USER_TEMPLATE,
     FIX_TEMPLATE
 )
-from .openai_utils import (
-    num_tokens_from_text, 
-    chat_completion_stream,
-    DEFAULT_CHAT_MODEL
-)
+from .openai_utils import DEFAULT_CHAT_MODEL, num_tokens_for_model
+from .rate_limit import RateScheduler, get_rate_scheduler, set_rate_scheduler, STATE_FILE as RATE_STATE_FILE
 from .voice import (
     text2voice, 
-    play_wave
+    SynthesisPipeline
 )
+from .player import AudioPlayer
+from .voice_cache import VoiceCache
+from .completion_cache import CompletionCache
 from .exec_code import (
     exec_mel,
     exec_py
 )
 from .settings import Settings, SettingsData
+from .completion import CompletionWorker, StreamRenderer
+from .chat_view import ChatModel, ChatView
+from .history import MessageHistory
+from .journal import SessionJournal, export_messages_json, export_scripts
+from .search import SearchIndex, SearchHit, SCRIPT
+from .search_panel import SearchPanel
+from .metrics import MetricsRegistry, MetricsWriter, use_metrics, TRIM, PLAYBACK_WAIT, UNDERRUNS, Q_SYNTHESIS, Q_PLAY
+from .metrics_panel import MetricsPanel
+from .trace import TRACER, ENABLED as TRACE_ENABLED
+from .retrieval import ScriptMemory, format_examples
+from .context import ContextManager
+from .cancel import CancelToken
+from .warmup import WarmUp, VOICEVOX, ENABLED as WARMUP_ENABLED
+from .stream_parser import decompose
 
-MAX_MESSAGES_TOKEN = 2500
 DEFAULT_GEOMETORY = (400, 300, 900, 600)
 
 def maya_main_window():
@@ -53,6 +65,7 @@ def maya_main_window():
 def showUI():
     window = ChatMaya(parent=maya_main_window())
     window.show()
+    return window
 
 class ChatMaya(QtWidgets.QMainWindow):
 
@@ -60,13 +73,34 @@ class ChatMaya(QtWidgets.QMainWindow):
         super(ChatMaya, self).__init__(parent, *args, **kwargs)
 
         self._exit_flag = False
+        ensure_dirs()
+
+        # 計測値はウィンドウごとに持つ (複数のウィンドウを開いても混ざらない)
+        self.metrics = MetricsRegistry()
+        # トレースはプロセス全体で1つのファイル。開いたウィンドウだけが閉じる
+        self.trace_path = None
 
         # voice
         self.q_voice_synthesis = queue.Queue()
-        self.q_voice_play = queue.Queue()
-        self.voice_dir = Path.home() / 'AppData' / 'Local' / 'Temp'
-
-        self.__stop_completion = False
+        self.voice_pipeline = SynthesisPipeline(self.synthesize_voice)
+        self.q_voice_play = self.voice_pipeline.output
+        self.audio_player = AudioPlayer()
+        self.voice_cache = None
+        self.voice_cache_lock = threading.Lock()
+
+        # completion
+        self.completion_thread = None
+        self.completion_worker = None
+        self.prompt_tokens = 0
+        self.worker_candidates = 1
+        self.use_completion_cache = False
+        self.completion_cache = None
+        self.completion_model = DEFAULT_CHAT_MODEL
+        self.use_script_memory = True
+        self.script_memory = ScriptMemory(USER_SETTINGS_DIR / 'script_memory.jsonl')
+        if get_rate_scheduler() is None:
+            # RPM/TPMの残りは他のウィンドウ/Maya/バッチと共有する
+            set_rate_scheduler(RateScheduler(USER_SETTINGS_DIR / RATE_STATE_FILE))
 
         # thread
         self.executor = ThreadPoolExecutor(max_workers=2)
@@ -77,27 +111,55 @@ class ChatMaya(QtWidgets.QMainWindow):
         self.script_type = "python"
         self.last_error = None
         self.leave_codeblocks = False
-        self.max_total_token = MAX_MESSAGES_TOKEN
+        self.context_manager = ContextManager()
         self.init_variables()
         
         # User Prefs
         self.user_settings_ini = QtCore.QSettings(str(USER_SETTINGS_INI), QtCore.QSettings.IniFormat)
         self.user_settings_ini.setIniCodec('utf-8')
-        self.completion_model = DEFAULT_CHAT_MODEL
         self.settings = Settings()
         self.apply_settings(self.settings.get_settings())
 
+        self.search_index = SearchIndex(USER_SETTINGS_DIR / 'search_index.sqlite3', LOG_DIR)
+
         # Build UI
         self.init_ui()
         self.get_user_prefs()
+
+        # 過去のセッションの検索インデックス (変更のあったフォルダのみバックグラウンドで読み直す)
+        # 書き込みは1つのスレッドで順に行い、UIスレッドはsqliteのロックを待たない
+        self.index_cancel = threading.Event()
+        self.index_executor = ThreadPoolExecutor(max_workers=1)
+        self.index_pending = set()
+        self.index_executor.submit(self.rebuild_search_index)
+
+        # 初回の送信に必要な準備をバックグラウンドで行う
+        self.warmup = WarmUp(self.voice_speakerid, self.completion_model, parent=self)
+        self.warmup.progress.connect(self.show_warmup_status)
+        self.warmup.finished.connect(self.show_warmup_status)
+        if WARMUP_ENABLED:
+            self.warmup.start()
         
     def init_variables(self, *args):
         self.session_id = datetime.now().strftime('session_%y%m%d_%H%M%S')
         self.session_log_dir = Path(LOG_DIR / self.session_id)
 
-        self.messages = [self.set_system_message(self.script_type)]
+        self.messages = MessageHistory([self.set_system_message(self.script_type)], self.completion_model)
+        self.journal = SessionJournal(self.session_log_dir)
+        self.messages.add_listener(self.journal.record)
+        # 計測値はセッションごとに集計し直す (他のウィンドウの集計には触れない)
+        self.metrics.reset()
+        self.metrics_writer = MetricsWriter(self.session_log_dir, self.metrics)
+        if TRACER.enabled:
+            self.open_trace()
         self.code_list = []
+        self.code_labels = []
+        self.code_candidates = []
+        self.candidate_texts = []
+        self.candidate_comments = []
+        self.history_candidate = 0
         self.total_tokens = 0
+        self.last_user_message = ""
 
     def set_system_message(self, type:str="python", *args):
         if type == "python":
@@ -105,22 +167,10 @@ class ChatMaya(QtWidgets.QMainWindow):
         elif type == "mel":
             return {"role":"system", "content":SYSTEM_TEMPLATE_MEL}
 
-    def decompose_response(self, txt:str):
-        if self.script_type == "python":
-            pattern = r"```python([\s\S]*?)```"
-        else:
-            pattern = r"```mel([\s\S]*?)```"
-        
-        code_list = re.findall(pattern, txt)
-        code_list = [code.strip() for code in code_list]
-        
-        comment = re.sub(pattern, '', txt)
-        comment = re.sub('[\r?\n]+', '\n', comment)
-        comment = comment.strip()
-        
-        return comment.strip(), code_list
-
     def new_chat(self, *args):
+        if self.is_generating():
+            return
+        self.close_journal()
         self.init_variables()
         self.update_scripts()
         cmds.cmdScrollFieldExecuter(self.script_editor_py, e=True, clear=True)
@@ -129,98 +179,169 @@ class ChatMaya(QtWidgets.QMainWindow):
         self.chat_history_model.removeRows(0, self.chat_history_model.rowCount())
         self.statusBar().showMessage("New Chat")
 
-    def generate_message(self, *args):
-        
-        message_text = ""
-        sentence = ""
-        sentence_end_chars = "。！？:"
-        backquote_count = 0
-        is_code_block = False
+    def get_completion_cache(self) -> CompletionCache:
+        if self.completion_cache is None:
+            self.completion_cache = CompletionCache(USER_SETTINGS_DIR / 'completion_cache')
+        return self.completion_cache
+
+    def is_generating(self, *args) -> bool:
+        return self.completion_thread is not None
+
+    @TRACER.traced()
+    def generate_message(self, bypass_cache:bool=False, *args):
+        if self.is_generating():
+            return
 
         self.statusBar().showMessage("Completion... (Press Esc to stop)")
 
+        # 過去に実行できたスクリプトを例として差し込む (履歴には残さない)
+        examples = self.retrieve_examples() if self.use_script_memory else None
+
         # prompt tokens
-        content_list = [msg["content"] for msg in self.messages]
-        prompt_tokens = num_tokens_from_text("".join(content_list))
+        # モデルのコンテキスト長に収まるよう、古い返答のコードを省略し古いやり取りを要約して送る (履歴はそのまま)
+        with self.metrics.timer(TRIM):
+            context = self.context_manager.build(self.messages, self.completion_model, examples)
+        self.prompt_tokens = context.prompt_tokens
+
+        self.total_tokens += self.prompt_tokens
+
+        # APIコール (ワーカースレッド)
+        options = {
+            "temperature": self.completion_temperature,
+            "top_p": self.completion_top_p,
+            "presence_penalty": self.completion_presence_penalty,
+            "frequency_penalty": self.completion_frequency_penalty,
+        }
+
+        self.completion_thread = QtCore.QThread(self)
+        self.completion_worker = CompletionWorker(
+            messages=context.messages, 
+            model=self.completion_model, 
+            options=options, 
+            voice_queue=self.q_voice_synthesis,
+            cache=self.get_completion_cache() if self.use_completion_cache else None,
+            bypass_cache=bypass_cache,
+            candidates=self.completion_candidates,
+            cancel=CancelToken(),
+            clear_voice=self.clear_voice,
+            metrics=self.metrics
+        )
+        self.completion_worker.moveToThread(self.completion_thread)
+        self.completion_thread.started.connect(self.completion_worker.run)
+        self.completion_worker.delta.connect(self.stream_renderer.append)
+        self.completion_worker.reset.connect(self.reset_message)
+        self.completion_worker.code_block.connect(self.add_code_block)
+        self.completion_worker.finished.connect(self.finish_message)
+        self.completion_worker.failed.connect(self.fail_message)
 
-        if prompt_tokens > self.max_total_token:
-            self.messages = self.shrink_messages(self.messages)
+        self.code_list = []
+        self.code_labels = []
+        self.code_candidates = []
+        self.candidate_texts = []
+        self.candidate_comments = []
+        self.history_candidate = 0
+        self.worker_candidates = self.completion_candidates
+        self.update_scripts()
 
-        content_list = [msg["content"] for msg in self.messages]
-        prompt_tokens = num_tokens_from_text("".join(content_list))
+        self.stream_renderer.start()
+        self.stop_button.setEnabled(True)
+        self.completion_thread.start()
+
+    def end_completion_thread(self, *args):
+        self.stream_renderer.stop()
+        self.completion_thread.quit()
+        self.completion_thread.wait()
+        self.completion_worker.deleteLater()
+        self.completion_thread.deleteLater()
+        self.completion_worker = None
+        self.completion_thread = None
+        self.stop_button.setEnabled(False)
+
+    def disconnect_worker(self, *args):
+        worker = self.completion_worker
+        for signal in (worker.delta, worker.reset, worker.code_block, worker.finished, worker.failed):
+            try:
+                signal.disconnect()
+            except RuntimeError:
+                pass
 
-        self.total_tokens += prompt_tokens
+    def stop_completion(self, *args):
+        if self.completion_worker is not None:
+            # 受信中の接続を切り、読み上げ待ちの文も捨てる
+            self.completion_worker.stop()
+            self.clear_voice()
+            self.statusBar().showMessage("Stopping...")
 
-        # APIコール
-        try:
-            options = {
-                "temperature": self.completion_temperature,
-                "top_p": self.completion_top_p,
-                "presence_penalty": self.completion_presence_penalty,
-                "frequency_penalty": self.completion_frequency_penalty,
-            }
-
-            for content in chat_completion_stream(messages=self.messages, model=self.completion_model, **options):
-                if keyboard.is_pressed('esc'):
-                    self.__stop_completion = True
-                    break
-                message_text += content
-                self.chat_history_model.setData(
+    def fail_message(self, error:str, *args):
+        # ウィンドウを閉じた後に届いたシグナルは無視する
+        if self._exit_flag:
+            return
+        self.end_completion_thread()
+        self.messages.append({'role': 'assistant', 'content': ''})
+        self.chat_history_model.setData(
                     self.chat_history_model.index(self.chat_history_model.rowCount() - 1), 
-                    message_text)
-                self.chat_history_view.scrollToBottom()
-                cmds.refresh()
-                
-                for char in content:
-                    sentence += char
-
-                    if char == "`":
-                        backquote_count += 1
-                    else:
-                        backquote_count = 0
-                        
-                    if backquote_count == 3:
-                        is_code_block = not is_code_block
-                        backquote_count = 0
-                        sentence = ""
-
-                    if char in sentence_end_chars:
-                        if not is_code_block:
-                            # ボイス合成キューに１文ずつ追加
-                            self.q_voice_synthesis.put(sentence.strip())
-                            backquote_count = 0
-                        sentence = ""
-
-        except Exception as e:
-            cmds.error(str(e))
-            self.messages.append({'role': 'assistant', 'content': ''})
-            self.chat_history_model.setData(
-                        self.chat_history_model.index(self.chat_history_model.rowCount() - 1), 
-                        '')
+                    '')
+        cmds.error(error)
+
+    def reset_message(self, *args):
+        # 再接続で返答が変わった場合、途中までの表示とコードを破棄
+        self.stream_renderer.clear()
+        self.code_list = []
+        self.code_labels = []
+        self.code_candidates = []
+        self.update_scripts()
+
+    def add_code_block(self, candidate:int, lang:str, code:str, *args):
+        # 完成したコードブロックから順にScriptsプルダウンへ追加
+        if lang != self.script_type:
             return
-        
+        number = self.code_candidates.count(candidate) + 1
+        self.code_list.append(code)
+        self.code_candidates.append(candidate)
+        if self.worker_candidates > 1:
+            # 候補番号-ブロック番号
+            label = "{}-{}".format(candidate + 1, number)
+        else:
+            label = str(number)
+        self.code_labels.append(label)
+        self.choice_script.addItem(label)
+
+        # 1つ目の候補の最初のコードを優先して表示
+        if candidate == 0 and number == 1:
+            self.choice_script.setCurrentIndex(len(self.code_list) - 1)
+
+    @TRACER.traced()
+    def finish_message(self, message_text:str, comment:str, stopped:bool, *args):
+        # ウィンドウを閉じた後に届いたシグナルは無視する (journal/検索インデックスは閉じている)
+        if self._exit_flag:
+            return
+        cache_hit = self.completion_worker.cache_hit
+        cancelled_at = self.completion_worker.cancel.cancelled_at
+        self.candidate_texts = self.completion_worker.texts
+        self.candidate_comments = self.completion_worker.comments
+        self.end_completion_thread()
+        self.chat_history_model.setData(
+                    self.chat_history_model.index(self.chat_history_model.rowCount() - 1), 
+                    message_text)
+
         self.messages.append({'role': 'assistant', 'content': message_text})
 
         # log出力
         self.export_log()
 
-        # Escが押されたらここで終了
-        if self.__stop_completion:
-            self.statusBar().showMessage("Stop Completion.")
+        # Esc/Stopが押されたらここで終了
+        if stopped:
+            # 停止までに合成キューに入った文も捨てる
+            self.clear_voice()
+            self.statusBar().showMessage("Stop Completion. ({:.0f} ms)".format(
+                (time.perf_counter() - cancelled_at) * 1000))
             return
 
         # completion tokens
-        completion_tokens = num_tokens_from_text(message_text)
+        prompt_tokens = self.prompt_tokens
+        completion_tokens = num_tokens_for_model(message_text, self.completion_model)
         self.total_tokens += completion_tokens
 
-        # 最後の文が句読点で終わっていない場合
-        if sentence.strip():
-            if not is_code_block:
-                self.q_voice_synthesis.put(sentence.strip())
-
-        # 返答を分解
-        comment, self.code_list = self.decompose_response(message_text)
-
         # スクリプト出力
         self.export_scripts()
 
@@ -231,21 +352,17 @@ class ChatMaya(QtWidgets.QMainWindow):
                         comment)
         self.chat_history_view.scrollToBottom()
 
-        # Scriptsプルダウンを更新
-        self.update_scripts()
-
-        # コードの1つ目をscript_editorに表示
-        if self.script_type == "python":
-            editor = self.script_editor_py
-        else:
-            editor = self.script_editor_mel
-        if self.code_list:
-            cmds.cmdScrollFieldExecuter(editor, e=True, t=self.code_list[0])
-        else:
+        # コードが無ければscript_editorをクリア
+        if not self.code_list:
+            if self.script_type == "python":
+                editor = self.script_editor_py
+            else:
+                editor = self.script_editor_mel
             cmds.cmdScrollFieldExecuter(editor, e=True, clear=True)
         self.fix_error_button.setEnabled(False)
 
-        self.statusBar().showMessage("Completion Finish. ({} prompt + {} completion = {} tokens) Total:{}".format(
+        self.statusBar().showMessage("Completion Finish{}. ({} prompt + {} completion = {} tokens) Total:{}".format(
+            " (cached)" if cache_hit else "",
             prompt_tokens,
             completion_tokens,
             prompt_tokens + completion_tokens,
@@ -253,6 +370,8 @@ class ChatMaya(QtWidgets.QMainWindow):
         ))
 
     def send_message(self):
+        if self.is_generating():
+            return
         user_message = self.user_input.toPlainText()
         if not user_message:
             return
@@ -269,13 +388,12 @@ class ChatMaya(QtWidgets.QMainWindow):
             script_type="Maya Python" if self.script_type == "python" else "MEL", 
             questions=user_message)
         self.messages.append({"role": "user", "content": user_prompt})
-        #self.last_user_message = user_message
+        self.last_user_message = user_message
 
-        self.__stop_completion = False
         self.generate_message()
 
     def send_fix_message(self):
-        if self.last_error == 0:
+        if self.is_generating() or self.last_error == 0:
             return
         
         prompt = FIX_TEMPLATE.format(error=self.last_error)
@@ -289,11 +407,10 @@ class ChatMaya(QtWidgets.QMainWindow):
 
         self.chat_history_model.insertRow(self.chat_history_model.rowCount())
 
-        self.__stop_completion = False
         self.generate_message()
 
     def regenerate_message(self):
-        if len(self.messages) < 2:
+        if self.is_generating() or len(self.messages) < 2:
             return
         
         self.chat_history_model.setData(
@@ -302,39 +419,80 @@ class ChatMaya(QtWidgets.QMainWindow):
         
         self.messages.pop(-1)
 
-        self.__stop_completion = False
-        self.generate_message()
+        # Regenerateは常にキャッシュを使わない
+        self.generate_message(bypass_cache=True)
 
     def delete_last_message(self):
+        if self.is_generating():
+            return
         self.chat_history_model.removeRows(self.chat_history_model.rowCount() - 2, 2)
         self.messages.pop(-1)
         self.messages.pop(-1)
+        self.candidate_texts = []
         self.export_log()
     
-    def shrink_messages(self, messages:list) -> list:
-        messages.pop(1)
-        content_list = [msg["content"] for msg in messages]
-        prompt_tokens = num_tokens_from_text("".join(content_list))
-        if prompt_tokens > self.max_total_token:
-            messages = self.shrink_messages(messages)
-        return messages
+    def retrieve_examples(self, *args):
+        if not self.last_user_message or self.messages[-1].get("role") != "user":
+            return None
+        try:
+            found = self.script_memory.search(self.last_user_message, self.script_type)
+            return format_examples(found, model=self.completion_model)
+        except Exception:
+            return None
+
+    def answer_code_index(self, code:str) -> int:
+        # 今の返答のコードブロックと同じなら、そのcode_listの番号 (違えば-1)
+        normalize = lambda text: text.replace("\r\n", "\n").strip()
+        code = normalize(code)
+        for i, answer_code in enumerate(self.code_list):
+            if normalize(answer_code) == code:
+                return i
+        return -1
+
+    def use_candidate(self, candidate:int, *args):
+        # 実行した候補の返答を履歴の最後の返答にする (Fix Errorで失敗したコードを含む履歴を送るため)
+        if candidate == self.history_candidate or candidate >= len(self.candidate_texts) or self.is_generating():
+            return
+        if not self.messages or self.messages[-1].get("role") != "assistant":
+            return
+        self.messages[-1] = {'role': 'assistant', 'content': self.candidate_texts[candidate]}
+        self.history_candidate = candidate
+        self.chat_history_model.setData(
+                    self.chat_history_model.index(self.chat_history_model.rowCount() - 1), 
+                    self.candidate_texts[candidate] if self.leave_codeblocks else self.candidate_comments[candidate])
+        self.export_log()
 
+    @TRACER.traced()
     def execute_script(self, *args):
         cmds.cmdScrollFieldReporter(self.script_reporter, e=True, clear=True)
 
         if self.script_type == "python":
             code = cmds.cmdScrollFieldExecuter(self.script_editor_py, q=True, text=True)
+        else:
+            code = cmds.cmdScrollFieldExecuter(self.script_editor_mel, q=True, text=True)
+        index = self.answer_code_index(code)
+        if index >= 0:
+            self.use_candidate(self.code_candidates[index])
+
+        if self.script_type == "python":
             result = exec_py(code)
             if result != 0:
                 OpenMaya.MGlobal.displayError(result)
         else:
-            code = cmds.cmdScrollFieldExecuter(self.script_editor_mel, q=True, text=True)
             result = exec_mel(code)
 
         self.last_error = result
 
         self.fix_error_button.setEnabled(False if result == 0 else True)
 
+        # エラー無く実行できたスクリプトは質問と一緒に覚えておく
+        # 今の返答のコードをそのまま実行した場合のみ (検索から読み込んだ/編集した/前の返答のコードは除く)
+        if result == 0 and self.last_user_message and index >= 0:
+            try:
+                self.script_memory.add(self.last_user_message, code, self.script_type)
+            except Exception:
+                pass
+
     # voice
     def voice_synthesis_thread(self):
 
@@ -344,34 +502,60 @@ class ChatMaya(QtWidgets.QMainWindow):
             except queue.Empty:
                 continue
             
-            wav_path = text2voice(
+            # 合成は複数ワーカーで並列に行い、再生は投入順
+            self.voice_pipeline.submit(text)
+            self.metrics.gauge(Q_SYNTHESIS, self.q_voice_synthesis.qsize())
+
+            self.q_voice_synthesis.task_done()
+
+        self.voice_pipeline.shutdown()
+
+    def clear_voice(self, *args):
+        while True:
+            try:
+                self.q_voice_synthesis.get_nowait()
+            except queue.Empty:
+                break
+            self.q_voice_synthesis.task_done()
+        self.voice_pipeline.clear()
+        self.audio_player.clear()
+
+    def synthesize_voice(self, text:str):
+        # text2voiceの記録をこのウィンドウの集計に入れる
+        with use_metrics(self.metrics):
+            return text2voice(
                 text, 
-                str(uuid4()), 
-                path=self.voice_dir, 
                 speaker=self.voice_speakerid,
                 speed=self.voice_speed,
                 pitch=self.voice_pitch,
                 intonation=self.voice_intonation, 
                 volume=self.voice_volume,
-                post=self.voice_post
+                post=self.voice_post,
+                cache=self.get_voice_cache()
             )
 
-            if wav_path:
-                self.q_voice_play.put(wav_path)
-
-            self.q_voice_synthesis.task_done()
+    def get_voice_cache(self) -> VoiceCache:
+        # キャッシュフォルダの走査は最初の読み上げまで遅らせる
+        with self.voice_cache_lock:
+            if self.voice_cache is None:
+                self.voice_cache = VoiceCache(USER_SETTINGS_DIR / 'voice_cache')
+            return self.voice_cache
 
     def voice_play_thread(self):
         
         while not (self._exit_flag and self.q_voice_play.empty()):
             try:
-                wav_path = self.q_voice_play.get(timeout=1)
+                wav_data = self.q_voice_play.get(timeout=1)
             except queue.Empty:
                 continue
 
-            play_wave(wav=wav_path, delete=True)
+            # 再生までの待ち時間 = 追加する時点でバッファに残っている音声の長さ
+            self.metrics.gauge(Q_PLAY, self.q_voice_play.qsize())
+            self.metrics.observe(PLAYBACK_WAIT, self.audio_player.buffered_seconds() * 1000)
 
-            self.q_voice_play.task_done()
+            # 出力ストリームは開いたままジッタバッファに追加
+            self.audio_player.play(wav_data)
+            self.metrics.gauge(UNDERRUNS, self.audio_player.underruns)
 
     # UserPrefs
     def get_user_prefs(self, *args):
@@ -379,10 +563,25 @@ class ChatMaya(QtWidgets.QMainWindow):
         self.restoreGeometry(self.user_settings_ini.value('geometry'))
         self.user_settings_ini.endGroup()
 
+        self.user_settings_ini.beginGroup('Options')
+        self.completionCacheAction.setChecked(self.user_settings_ini.value('completionCache', False, type=bool))
+        self.scriptMemoryAction.setChecked(self.user_settings_ini.value('scriptMemory', True, type=bool))
+        # 他のウィンドウで記録中ならそのまま続ける
+        self.traceAction.setChecked(self.user_settings_ini.value('trace', False, type=bool) or TRACE_ENABLED or TRACER.enabled)
+        self.user_settings_ini.endGroup()
+
     def save_user_prefs(self, *args):
         self.user_settings_ini.beginGroup('MainWindow')
         self.user_settings_ini.setValue('geometry', self.saveGeometry())
         self.user_settings_ini.endGroup()
+
+        self.user_settings_ini.beginGroup('Options')
+        self.user_settings_ini.setValue('completionCache', self.use_completion_cache)
+        self.user_settings_ini.setValue('scriptMemory', self.use_script_memory)
+        if not TRACE_ENABLED:
+            # 環境変数で有効にした場合は保存しない
+            self.user_settings_ini.setValue('trace', TRACER.enabled)
+        self.user_settings_ini.endGroup()
         self.user_settings_ini.sync()
 
     def reset_user_prefs(self, *args):
@@ -394,16 +593,28 @@ class ChatMaya(QtWidgets.QMainWindow):
         self.completion_top_p = float(data.completion.top_p)
         self.completion_presence_penalty = float(data.completion.presence_penalty)
         self.completion_frequency_penalty = float(data.completion.frequency_penalty)
+        self.completion_candidates = int(data.completion.candidates)
         self.voice_speakerid = int(data.voice.speakerid)
         self.voice_speed = float(data.voice.speed)
         self.voice_pitch = float(data.voice.pitch)
         self.voice_intonation = float(data.voice.intonation)
         self.voice_volume = float(data.voice.volume)
         self.voice_post = float(data.voice.post)
+        self.voice_pipeline.set_workers(int(data.voice.workers))
 
     def open_settings_dialog(self, *args):
         self.settings.update(parent=maya_main_window())
         self.apply_settings(self.settings.get_settings())
+        if WARMUP_ENABLED and self.voice_speakerid != self.warmup.speaker:
+            # 話者が変わった場合はモデルを読み込み直しておく
+            self.warmup.speaker = self.voice_speakerid
+            self.warmup.start([VOICEVOX])
+
+    def show_warmup_status(self, message:str, *args):
+        # 他の表示 (送信中/完了など) は上書きしない
+        current = self.statusBar().currentMessage()
+        if current == "Ready." or current.startswith("Warming up"):
+            self.statusBar().showMessage(message)
 
     # UI
     def init_ui(self, *args):
@@ -420,6 +631,15 @@ class ChatMaya(QtWidgets.QMainWindow):
         exitAction.setShortcut("Ctrl+Q")
         exitAction.triggered.connect(self.close)
 
+        # Metrics Action
+        metricsAction = QtWidgets.QAction("Show Metrics", self)
+        metricsAction.triggered.connect(self.open_metrics_panel)
+
+        # Search Action
+        searchAction = QtWidgets.QAction("Search Logs", self)
+        searchAction.setShortcut("Ctrl+F")
+        searchAction.triggered.connect(self.open_search_panel)
+
         # Settings Action
         settingsAction = QtWidgets.QAction('Open Settings Dialog', self)
         settingsAction.triggered.connect(self.open_settings_dialog)
@@ -429,6 +649,24 @@ class ChatMaya(QtWidgets.QMainWindow):
         leaveCodeblocksAction.setChecked(self.leave_codeblocks)
         leaveCodeblocksAction.setStatusTip(u'コードブロックをチャット領域にも残しておく')
         leaveCodeblocksAction.toggled.connect(self.toggle_leave_codeblocks)
+
+        self.completionCacheAction = QtWidgets.QAction('Use completion cache', self)
+        self.completionCacheAction.setCheckable(True)
+        self.completionCacheAction.setChecked(self.use_completion_cache)
+        self.completionCacheAction.setStatusTip(u'同じモデル・設定・履歴の返答をキャッシュから再生する (Regenerateは常に再生成)')
+        self.completionCacheAction.toggled.connect(self.toggle_completion_cache)
+
+        self.scriptMemoryAction = QtWidgets.QAction('Use successful scripts as examples', self)
+        self.scriptMemoryAction.setCheckable(True)
+        self.scriptMemoryAction.setChecked(self.use_script_memory)
+        self.scriptMemoryAction.setStatusTip(u'過去にエラー無く実行できた似たスクリプトを参考としてプロンプトに含める')
+        self.scriptMemoryAction.toggled.connect(self.toggle_script_memory)
+
+        self.traceAction = QtWidgets.QAction('Record trace', self)
+        self.traceAction.setCheckable(True)
+        self.traceAction.setChecked(TRACER.enabled)
+        self.traceAction.setStatusTip(u'送信から読み上げまでの処理をセッションのフォルダにtrace.jsonとして記録する (chrome://tracing / Perfettoで開く)')
+        self.traceAction.toggled.connect(self.toggle_trace)
         
         # About Action
         aboutAction = QtWidgets.QAction('About', self)
@@ -439,6 +677,8 @@ class ChatMaya(QtWidgets.QMainWindow):
 
         fileMenu = menuBar.addMenu("File")
         fileMenu.addAction(reset_user_prefsAction)
+        fileMenu.addAction(searchAction)
+        fileMenu.addAction(metricsAction)
         fileMenu.addSeparator()
         fileMenu.addAction(exitAction)
         
@@ -446,6 +686,9 @@ class ChatMaya(QtWidgets.QMainWindow):
         settingsMenu.addAction(settingsAction)
         settingsMenu.addSeparator()
         settingsMenu.addAction(leaveCodeblocksAction)
+        settingsMenu.addAction(self.completionCacheAction)
+        settingsMenu.addAction(self.scriptMemoryAction)
+        settingsMenu.addAction(self.traceAction)
         
         helpMenu = menuBar.addMenu("Help")
         helpMenu.addAction(aboutAction)
@@ -484,17 +727,12 @@ class ChatMaya(QtWidgets.QMainWindow):
         hBoxLayout3.addWidget(self.script_type_rbtn_2)
 
         # chat history
-        self.chat_history_model = QtCore.QStringListModel()
+        self.chat_history_model = ChatModel()
 
-        self.chat_history_view = QtWidgets.QListView()
+        self.chat_history_view = ChatView()
         self.chat_history_view.setModel(self.chat_history_model)
-        self.chat_history_view.setWordWrap(True)
-        self.chat_history_view.setAlternatingRowColors(True)
-        self.chat_history_view.setStyleSheet("""
-            QListView::item { border-bottom: 0px solid; padding: 5px; }
-            QListView::item { background-color: #27272e; }
-            QListView::item:alternate { background-color: #363842; }
-            """)
+
+        self.stream_renderer = StreamRenderer(self.chat_history_model, self.chat_history_view, parent=self)
 
         # user input
         self.user_input = QtWidgets.QPlainTextEdit()
@@ -504,6 +742,16 @@ class ChatMaya(QtWidgets.QMainWindow):
         send_button = QtWidgets.QPushButton("Send")
         send_button.clicked.connect(self.send_message)
 
+        self.stop_button = QtWidgets.QPushButton("Stop")
+        self.stop_button.setMaximumWidth(80)
+        self.stop_button.setEnabled(False)
+        self.stop_button.clicked.connect(self.stop_completion)
+
+        # このウィンドウにフォーカスがある時のみ
+        stop_shortcut = QtWidgets.QShortcut(QtGui.QKeySequence(QtCore.Qt.Key_Escape), self)
+        stop_shortcut.setContext(QtCore.Qt.WindowShortcut)
+        stop_shortcut.activated.connect(self.stop_completion)
+
         regenerate_button = QtWidgets.QPushButton("Regenerate")
         regenerate_button.setMaximumWidth(120)
         regenerate_button.clicked.connect(self.regenerate_message)
@@ -514,6 +762,7 @@ class ChatMaya(QtWidgets.QMainWindow):
         
         hBoxLayout2 = QtWidgets.QHBoxLayout()
         hBoxLayout2.addWidget(send_button)
+        hBoxLayout2.addWidget(self.stop_button)
         hBoxLayout2.addWidget(regenerate_button)
         hBoxLayout2.addWidget(delete_last_button)
 
@@ -545,7 +794,7 @@ class ChatMaya(QtWidgets.QMainWindow):
         self.choice_script = QtWidgets.QComboBox()
         self.choice_script.setEditable(False)
         self.choice_script.setMaximumWidth(80)
-        self.choice_script.currentTextChanged.connect(self.change_script)
+        self.choice_script.currentIndexChanged.connect(self.change_script)
 
         self.execute_button = QtWidgets.QPushButton('Execute')
         self.execute_button.clicked.connect(self.execute_script)
@@ -573,13 +822,58 @@ class ChatMaya(QtWidgets.QMainWindow):
         widget = QtWidgets.QWidget(self)
         widget.setLayout(main_layout)
         self.setCentralWidget(widget)
+
+        # search
+        self.search_panel = SearchPanel(self.search_index, self)
+        self.search_panel.hit_activated.connect(self.load_search_hit)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.search_panel)
+        self.search_panel.hide()
+
+        # metrics
+        self.metrics_panel = MetricsPanel(self.metrics, self)
+        self.metrics_panel.add_sampler(Q_SYNTHESIS, self.q_voice_synthesis.qsize)
+        self.metrics_panel.add_sampler(Q_PLAY, self.q_voice_play.qsize)
+        self.addDockWidget(QtCore.Qt.RightDockWidgetArea, self.metrics_panel)
+        self.metrics_panel.hide()
     
     def change_model(self, text, *args):
         self.completion_model = text
+        self.messages.set_model(text)
 
     def toggle_leave_codeblocks(self, flag, *args):
         self.leave_codeblocks = flag
 
+    def toggle_completion_cache(self, flag, *args):
+        self.use_completion_cache = flag
+
+    def toggle_script_memory(self, flag, *args):
+        self.use_script_memory = flag
+
+    def toggle_trace(self, flag, *args):
+        if flag == TRACER.enabled:
+            return
+        if flag:
+            TRACER.enabled = True
+            self.open_trace()
+            self.statusBar().showMessage("Recording trace to {}".format(TRACER.path))
+        else:
+            path = TRACER.path
+            TRACER.close()
+            TRACER.enabled = False
+            self.trace_path = None
+            self.statusBar().showMessage("Trace saved to {}".format(path))
+
+    def open_trace(self, *args):
+        # 他のウィンドウが記録中なら、そのファイルに続けて記録する (開き直して切り詰めない)
+        if TRACER.path is None:
+            TRACER.open(self.session_log_dir)
+            self.trace_path = TRACER.path
+
+    def close_trace(self, *args):
+        if self.trace_path is not None and TRACER.path == self.trace_path:
+            TRACER.close()
+        self.trace_path = None
+
     def toggle_script_type(self, *args):
         if self.script_type_rbtn_1.isChecked():
             self.script_type = "python"
@@ -591,40 +885,77 @@ class ChatMaya(QtWidgets.QMainWindow):
         if self.messages:
             self.messages[0] = self.set_system_message(self.script_type)
         else:
-            self.messages = [self.set_system_message(self.script_type)]
+            self.messages.append(self.set_system_message(self.script_type))
 
     def update_scripts(self, *args):
         self.choice_script.clear()
         for i in range(int(len(self.code_list))):
-            self.choice_script.addItems(str(i+1))
+            if i < len(self.code_labels):
+                self.choice_script.addItem(self.code_labels[i])
+            else:
+                self.choice_script.addItem(str(i+1))
 
-    def change_script(self, item, *args):
-        if item:
+    def change_script(self, index, *args):
+        if 0 <= index < len(self.code_list):
             if self.script_type == "python":
                 editor = self.script_editor_py
             else:
                 editor = self.script_editor_mel
             
-            cmds.cmdScrollFieldExecuter(editor, e=True, t=self.code_list[int(item)-1])
+            cmds.cmdScrollFieldExecuter(editor, e=True, t=self.code_list[index])
 
     def about(self, *args):
         QtWidgets.QMessageBox.about(self, 'About ' + TITLE, ABOUT_TXT)
 
     def closeEvent(self, event):
         self.save_user_prefs()
+        self.warmup.cancel()
+        if self.is_generating():
+            # 止めたワーカーのfinished/failedが閉じた後のjournalや検索インデックスに届かないようにする
+            self.completion_worker.stop()
+            self.disconnect_worker()
+            self.end_completion_thread()
+        self.close_journal()
+        self.index_cancel.set()
+        self.update_search_index()
+        self.index_executor.submit(self.search_index.close)
+        self.index_executor.shutdown(wait=True)
         self._exit_flag = True
         self.executor.shutdown(wait=True)
+        self.audio_player.close()
 
     # export
+    @TRACER.traced()
     def export_log(self, *args):
-        self.session_log_dir.mkdir(parents=True, exist_ok=True)
-        log_file_path = Path(self.session_log_dir, 'messages.json')
+        # メッセージの変更はjournalに逐次追記されているので、区切りでfsyncだけ行う
+        try:
+            self.journal.sync()
+        except:
+            pass
+        try:
+            self.metrics_writer.flush()
+            TRACER.flush()
+        except:
+            pass
+        self.update_search_index()
+
+    def close_journal(self, *args):
+        # セッションの終わりに圧縮し、互換用のmessages.jsonも書き出す
         try:
-            with open(log_file_path, 'w', encoding='utf-8-sig') as f:
-                json.dump(self.messages, f, indent=4, ensure_ascii=False)
+            self.metrics_writer.close()
+            self.close_trace()
+        except:
+            pass
+        if not self.journal.is_open():
+            return
+        try:
+            self.journal.compact(self.messages)
+            self.journal.close()
+            export_messages_json(self.session_log_dir)
         except:
             pass
 
+    @TRACER.traced()
     def export_scripts(self, index=None, *args):
         export_code_list = []
         if index:
@@ -632,17 +963,65 @@ class ChatMaya(QtWidgets.QMainWindow):
         else:
             export_code_list = self.code_list
 
-        file_name_prefix = datetime.now().strftime('script_%H%M%S')
-        ext = '.py' if self.script_type == "python" else '.mel'
+        export_scripts(self.session_log_dir, export_code_list, self.script_type)
+        self.update_search_index()
 
-        for i, code in enumerate(export_code_list):
-            code_file_path = Path(self.session_log_dir, '{}_{}{}'.format(file_name_prefix, str(i).zfill(2), ext))
-            try:
-                with open(code_file_path, 'w', encoding='utf-8-sig') as f:
-                    f.writelines(code)
-            except:
-                pass
+    # search
+    def rebuild_search_index(self):
+        try:
+            self.search_index.rebuild(cancel=self.index_cancel)
+        except Exception:
+            pass
+
+    def update_search_index(self, *args):
+        # 1回のやり取りでexport_log/export_scriptsの両方から呼ばれるので、まだ始まっていないものはまとめる
+        session_dir = self.session_log_dir
+        if session_dir in self.index_pending:
+            return
+        self.index_pending.add(session_dir)
+        self.index_executor.submit(self._update_search_index, session_dir)
+
+    def _update_search_index(self, session_dir:Path):
+        self.index_pending.discard(session_dir)
+        try:
+            self.search_index.update_session(session_dir)
+        except Exception:
+            pass
+
+    def open_search_panel(self, *args):
+        self.search_panel.focus()
+
+    def open_metrics_panel(self, *args):
+        self.metrics_panel.focus()
+
+    def load_search_hit(self, hit:SearchHit, *args):
+        # スクリプトはそのまま、返答はコードブロックを取り出してエディタに読み込む
+        if hit.kind == SCRIPT:
+            script_type = "mel" if hit.name.endswith(".mel") else "python"
+            code = hit.content
+        else:
+            script_type = self.script_type
+            _, code_list = decompose(hit.content, script_type)
+            if not code_list:
+                self.statusBar().showMessage("No {} code in this message.".format(script_type))
+                return
+            code = code_list[0]
+
+        if script_type != self.script_type:
+            # toggle_script_typeが呼ばれる
+            if script_type == "python":
+                self.script_type_rbtn_1.setChecked(True)
+            else:
+                self.script_type_rbtn_2.setChecked(True)
+
+        editor = self.script_editor_py if script_type == "python" else self.script_editor_mel
+        cmds.cmdScrollFieldExecuter(editor, e=True, t=code)
+        self.statusBar().showMessage("Loaded from {} {}".format(hit.session, hit.name))
 
     def open_log_dir(self, *args):
         if self.session_log_dir.is_dir():
+            try:
+                export_messages_json(self.session_log_dir)
+            except:
+                pass
             subprocess.Popen('explorer {}'.format(self.session_log_dir))
\ No newline at end of file
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, Optional
+
+def make_key(*values) -> str:
+    raw = json.dumps(values, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+class DiskLRUCache(object):
+    # 1キー1ファイルのディスクキャッシュ。更新日時をアクセス順として使い、容量を超えたら古い順に削除
+
+    def __init__(self, directory:Path, max_bytes:int, suffix:str=".bin"):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._index = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self._load_index()
+
+    def _path(self, key:str) -> Path:
+        return self.directory / (key + self.suffix)
+
+    def _load_index(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.suffix):
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name[:-len(self.suffix)], st.st_size))
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self._total_bytes += size
+        self._evict()
+
+    def get(self, key:str) -> Optional[bytes]:
+        with self._lock:
+            if key not in self._index:
+                self.misses += 1
+                return None
+            path = self._path(key)
+            try:
+                data = path.read_bytes()
+                os.utime(path)
+            except OSError:
+                self._total_bytes -= self._index.pop(key)
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key:str, data:bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            path = self._path(key)
+            tmp_path = path.with_name(path.name + ".tmp")
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, path)
+            except OSError:
+                return
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)
+            self._index[key] = len(data)
+            self._total_bytes += len(data)
+            self._evict()
+
+    def delete(self, key:str):
+        with self._lock:
+            if key not in self._index:
+                return
+            self._total_bytes -= self._index.pop(key)
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+            try:
+                self._path(key).unlink()
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index):
+                try:
+                    self._path(key).unlink()
+                except OSError:
+                    pass
+            self._index.clear()
+            self._total_bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
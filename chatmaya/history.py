@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+from typing import Callable, Dict, List
+
+from .openai_utils import DEFAULT_CHAT_MODEL, num_tokens_from_message
+
+class MessageHistory(list):
+    # メッセージごとにトークン数を１度だけ数え、合計を保持しておく
+    # 数えるのは合計が必要になった時 (起動時にtokenizerを読み込まないため)
+    # 数え方は送信先のモデルのChatML (APIのusage.prompt_tokensと同じ)
+
+    def __init__(self, messages:List[Dict]=None, model:str=DEFAULT_CHAT_MODEL):
+        super(MessageHistory, self).__init__()
+        self.model = model
+        self._tokens = []
+        self._total = 0
+        self._pending = 0
+        self.listeners = []
+        if messages:
+            self.extend(messages)
+
+    def add_listener(self, listener:Callable):
+        # 変更のたびに listener(self, op, index, message) を呼ぶ
+        self.listeners.append(listener)
+
+    def _notify(self, op:str, index:int=None, message:Dict=None):
+        for listener in self.listeners:
+            listener(self, op, index, message)
+
+    def _count_tokens(self, message:Dict) -> int:
+        return num_tokens_from_message(message, self.model)
+
+    def set_model(self, model:str):
+        # エンコーディングやメッセージの区切りが変わるので数え直す
+        if model == self.model:
+            return
+        self.model = model
+        self._tokens = [None] * len(self)
+        self._total = 0
+        self._pending = len(self)
+
+    @property
+    def total_tokens(self) -> int:
+        if self._pending:
+            for i, tokens in enumerate(self._tokens):
+                if tokens is None:
+                    tokens = self._count_tokens(self[i])
+                    self._tokens[i] = tokens
+                    self._total += tokens
+            self._pending = 0
+        return self._total
+
+    def token_count(self, index:int) -> int:
+        tokens = self._tokens[index]
+        if tokens is None:
+            tokens = self._count_tokens(self[index])
+            self._tokens[index] = tokens
+            self._total += tokens
+            self._pending -= 1
+        return tokens
+
+    def _discard(self, tokens):
+        if tokens is None:
+            self._pending -= 1
+        else:
+            self._total -= tokens
+
+    def append(self, message:Dict):
+        super(MessageHistory, self).append(message)
+        self._tokens.append(None)
+        self._pending += 1
+        self._notify("append", message=message)
+
+    def extend(self, messages:List[Dict]):
+        for message in messages:
+            self.append(message)
+
+    def insert(self, index:int, message:Dict):
+        index = min(max(index if index >= 0 else len(self) + index, 0), len(self))
+        super(MessageHistory, self).insert(index, message)
+        self._tokens.insert(index, None)
+        self._pending += 1
+        self._notify("insert", index, message)
+
+    def pop(self, index:int=-1) -> Dict:
+        index = range(len(self))[index]
+        message = super(MessageHistory, self).pop(index)
+        self._discard(self._tokens.pop(index))
+        self._notify("pop", index)
+        return message
+
+    def clear(self):
+        super(MessageHistory, self).clear()
+        self._tokens.clear()
+        self._total = 0
+        self._pending = 0
+        self._notify("clear")
+
+    def __setitem__(self, index:int, message:Dict):
+        if isinstance(index, slice):
+            raise TypeError("MessageHistory does not support slice assignment")
+        super(MessageHistory, self).__setitem__(index, message)
+        self._discard(self._tokens[index])
+        self._tokens[index] = None
+        self._pending += 1
+        self._notify("set", range(len(self))[index], message)
+
+    def __delitem__(self, index:int):
+        if isinstance(index, slice):
+            raise TypeError("MessageHistory does not support slice deletion")
+        self.pop(index)
@@ -18,10 +18,12 @@ Supported Maya:
 (c) 2023 Hiroyuki Akasaki""".format(TITLE, VERSION)
 
 USER_SETTINGS_DIR = Path(cmds.internalVar(userAppDir=True)) / TITLE
-USER_SETTINGS_DIR.mkdir(parents=True, exist_ok=True)
 
 USER_SETTINGS_INI = Path(USER_SETTINGS_DIR / 'userSettings.ini')
 USER_SETTINGS_JSON = Path(USER_SETTINGS_DIR / 'userSettings.json')
 
 LOG_DIR = Path(USER_SETTINGS_DIR / "log")
-LOG_DIR.mkdir(parents=True, exist_ok=True)
\ No newline at end of file
+
+def ensure_dirs():
+    # import時ではなくウィンドウを開く時に作成する
+    LOG_DIR.mkdir(parents=True, exist_ok=True)
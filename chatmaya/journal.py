@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional
+
+JOURNAL_FILE = 'messages.jsonl'
+MESSAGES_FILE = 'messages.json'
+
+FSYNC_INTERVAL = 5.0 # この秒数が経つか
+FSYNC_EVENTS = 32 # このイベント数が溜まったらfsyncする
+COMPACT_EVENTS = 256 # スナップショット以降のイベントがこの数を超えたら圧縮する
+
+# イベントの種類
+SNAPSHOT = 'snapshot'
+APPEND = 'append'
+INSERT = 'insert'
+POP = 'pop'
+SET = 'set'
+CLEAR = 'clear'
+
+class SessionJournal(object):
+    # メッセージの追加/削除/差し替えを1行1イベントで追記していくログ
+    # 毎回messages.json全体を書き直さないので、書き込み量は返答の長さ分だけで済む
+
+    def __init__(
+        self,
+        directory:Path,
+        fsync_interval:float=FSYNC_INTERVAL,
+        fsync_events:int=FSYNC_EVENTS,
+        compact_events:int=COMPACT_EVENTS
+    ):
+        self.directory = Path(directory)
+        self.path = self.directory / JOURNAL_FILE
+        self.fsync_interval = fsync_interval
+        self.fsync_events = fsync_events
+        self.compact_events = compact_events
+
+        self.bytes_written = 0
+        self._file = None
+        self._events = 0 # スナップショット以降のイベント数
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def record(self, messages:List[Dict], op:str, index:int=None, message:Dict=None):
+        # MessageHistoryのリスナーとして変更のたびに呼ばれる (変更後のmessagesが渡される)
+        try:
+            if self._file is None or self._events >= self.compact_events:
+                # 最初の書き込み/イベントが溜まった場合は現在の状態をスナップショットにする
+                self.compact(messages)
+                return
+
+            event = {'op': op, 't': time.time()}
+            if index is not None:
+                event['index'] = index
+            if message is not None:
+                event['message'] = message
+            self._write(event)
+            self._events += 1
+        except OSError:
+            # ログが書けなくてもチャットは続ける
+            pass
+
+    def _write(self, event:Dict):
+        line = json.dumps(event, ensure_ascii=False) + '\n'
+        self._file.write(line)
+        # Mayaが落ちてもOSのバッファには残るよう毎回flushし、fsyncはまとめて行う
+        self._file.flush()
+        self.bytes_written += len(line.encode('utf-8'))
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_events or time.monotonic() - self._synced_at >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is None or not self._unsynced:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def compact(self, messages:List[Dict]):
+        # 現在の状態を1行のスナップショットにして置き換える
+        self.directory.mkdir(parents=True, exist_ok=True)
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        tmp_path = self.path.with_suffix('.tmp')
+        line = json.dumps({'op': SNAPSHOT, 't': time.time(), 'messages': list(messages)}, ensure_ascii=False) + '\n'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(str(tmp_path), str(self.path))
+        self.bytes_written += len(line.encode('utf-8'))
+
+        self._file = open(self.path, 'a', encoding='utf-8')
+        self._events = 0
+        self._unsynced = 0
+        self._synced_at = time.monotonic()
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+
+    def is_open(self) -> bool:
+        return self._file is not None
+
+def read_journal(path:Path) -> List[Dict]:
+    # イベントを先頭から適用してメッセージの一覧を組み立て直す
+    messages = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+            except ValueError:
+                # 書き込み途中で落ちた最後の行
+                break
+            op = event.get('op')
+            if op == SNAPSHOT:
+                messages = list(event['messages'])
+            elif op == APPEND:
+                messages.append(event['message'])
+            elif op == INSERT:
+                messages.insert(event['index'], event['message'])
+            elif op == POP:
+                messages.pop(event['index'])
+            elif op == SET:
+                messages[event['index']] = event['message']
+            elif op == CLEAR:
+                messages = []
+    return messages
+
+def load_messages(session_dir:Path) -> Optional[List[Dict]]:
+    # messages.jsonl が無い古いセッションは messages.json から読む
+    session_dir = Path(session_dir)
+    journal_path = session_dir / JOURNAL_FILE
+    if journal_path.is_file():
+        return read_journal(journal_path)
+    json_path = session_dir / MESSAGES_FILE
+    if json_path.is_file():
+        with open(json_path, encoding='utf-8-sig') as f:
+            return json.load(f)
+    return None
+
+def export_messages_json(session_dir:Path) -> Optional[Path]:
+    # 互換性のため、必要な時だけ従来のmessages.jsonを書き出す
+    session_dir = Path(session_dir)
+    journal_path = session_dir / JOURNAL_FILE
+    if not journal_path.is_file():
+        return None
+    json_path = session_dir / MESSAGES_FILE
+    with open(json_path, 'w', encoding='utf-8-sig') as f:
+        json.dump(read_journal(journal_path), f, indent=4, ensure_ascii=False)
+    return json_path
+
+def export_scripts(session_dir:Path, code_list:List[str], script_type:str="python") -> List[Path]:
+    # script_時分秒_連番.py/.mel としてセッションのフォルダに書き出す
+    file_name_prefix = datetime.now().strftime('script_%H%M%S')
+    ext = '.py' if script_type == "python" else '.mel'
+
+    paths = []
+    for i, code in enumerate(code_list):
+        code_file_path = Path(session_dir, '{}_{}{}'.format(file_name_prefix, str(i).zfill(2), ext))
+        try:
+            with open(code_file_path, 'w', encoding='utf-8-sig') as f:
+                f.writelines(code)
+            paths.append(code_file_path)
+        except:
+            pass
+    return paths
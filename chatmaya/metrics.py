@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple
+
+METRICS_FILE = 'metrics.jsonl'
+HISTORY_SIZE = 512 # パーセンタイルの計算に残す直近の値の数
+
+# 記録する値
+TTFT = 'completion.ttft_ms'
+TOKENS_PER_SEC = 'completion.tokens_per_sec'
+COMPLETION_TOKENS = 'completion.tokens'
+TRIM = 'context.trim_ms'
+RATE_WAIT = 'completion.rate_wait_ms'
+RATE_LIMITED = 'completion.rate_limited'
+AUDIO_QUERY = 'voice.audio_query_ms'
+SYNTHESIS = 'voice.synthesis_ms'
+VOICE_CACHE_HITS = 'voice.cache_hits'
+VOICE_ERRORS = 'voice.errors'
+PLAYBACK_WAIT = 'voice.playback_wait_ms'
+UNDERRUNS = 'voice.underruns'
+Q_SYNTHESIS = 'queue.voice_synthesis'
+Q_PLAY = 'queue.voice_play'
+
+# 種類
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+class MetricSummary(NamedTuple):
+    name :str
+    kind :str
+    count :int
+    last :float
+    mean :float
+    p50 :float
+    p95 :float
+    max :float
+
+def percentile(values:List[float], q:float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+class Histogram(object):
+    __slots__ = ('count', 'total', 'last', 'max', 'values')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+        self.values = deque(maxlen=HISTORY_SIZE)
+
+    def add(self, value:float):
+        self.count += 1
+        self.total += value
+        self.last = value
+        self.max = value if self.count == 1 else max(self.max, value)
+        self.values.append(value)
+
+class MetricsRegistry(object):
+    # カウンタ/ゲージ/ヒストグラムの集計 (どのスレッドからでも記録できる)
+    # 記録のたびにリスナーへ (種類, 名前, 値) を通知する
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._listeners = []
+
+    def add_listener(self, listener:Callable[[str, str, float], None]):
+        # 通知中に変更されても良いよう、リストは作り直す
+        with self._lock:
+            self._listeners = self._listeners + [listener]
+
+    def remove_listener(self, listener:Callable[[str, str, float], None]):
+        with self._lock:
+            self._listeners = [l for l in self._listeners if l != listener]
+
+    def _notify(self, listeners, kind:str, name:str, value:float):
+        for listener in listeners:
+            try:
+                listener(kind, name, value)
+            except Exception:
+                pass
+
+    def inc(self, name:str, value:float=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+            listeners = self._listeners
+        self._notify(listeners, COUNTER, name, value)
+
+    def gauge(self, name:str, value:float):
+        # 現在値と最大値を残す
+        with self._lock:
+            histogram = self._gauges.get(name)
+            if histogram is None:
+                histogram = self._gauges[name] = Histogram()
+            changed = histogram.count == 0 or histogram.last != value
+            histogram.add(value)
+            listeners = self._listeners
+        if changed:
+            self._notify(listeners, GAUGE, name, value)
+
+    def observe(self, name:str, value:float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+            listeners = self._listeners
+        self._notify(listeners, HISTOGRAM, name, value)
+
+    @contextmanager
+    def timer(self, name:str):
+        # ブロックの所要時間をmsで記録する (例外の場合は記録しない)
+        start = time.perf_counter()
+        yield
+        self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def summary(self) -> List[MetricSummary]:
+        with self._lock:
+            counters = list(self._counters.items())
+            histograms = [(GAUGE, name, h.count, h.last, h.total, h.max, list(h.values))
+                          for name, h in self._gauges.items()]
+            histograms += [(HISTOGRAM, name, h.count, h.last, h.total, h.max, list(h.values))
+                           for name, h in self._histograms.items()]
+
+        result = [MetricSummary(name, COUNTER, int(value), value, 0.0, 0.0, 0.0, value) for name, value in counters]
+        for kind, name, count, last, total, maximum, values in histograms:
+            result.append(MetricSummary(name, kind, count, last, total / count if count else 0.0,
+                                        percentile(values, 0.5), percentile(values, 0.95), maximum))
+        result.sort(key=lambda s: s.name)
+        return result
+
+    def snapshot(self) -> Dict[str, Dict]:
+        return {s.name: {k: v for k, v in s._asdict().items() if k != 'name'} for s in self.summary()}
+
+# ウィンドウに属さない記録 (バッチ/ベンチマーク) の既定
+METRICS = MetricsRegistry()
+
+_local = threading.local()
+
+def current_metrics() -> MetricsRegistry:
+    # このスレッドに割り当てたウィンドウの集計 (無ければMETRICS)
+    return getattr(_local, 'registry', None) or METRICS
+
+@contextmanager
+def use_metrics(registry:MetricsRegistry):
+    # 共通の処理(API/音声合成)の記録を、呼び出したウィンドウの集計に入れる
+    previous = getattr(_local, 'registry', None)
+    _local.registry = registry
+    try:
+        yield
+    finally:
+        _local.registry = previous
+
+class MetricsWriter(object):
+    # セッションのログフォルダにmetrics.jsonlとして追記する
+    # 記録は各スレッドから呼ばれるのでメモリに溜めるだけにし、書き込みはflush()でまとめて行う
+
+    def __init__(self, directory:Path, registry:MetricsRegistry=METRICS):
+        self.directory = Path(directory)
+        self.path = self.directory / METRICS_FILE
+        self.registry = registry
+        self.events = 0
+        self._pending = deque()
+        self._closed = False
+        registry.add_listener(self.record)
+
+    def record(self, kind:str, name:str, value:float):
+        if not self._closed:
+            self.events += 1
+            self._pending.append({'t': round(time.time(), 3), 'kind': kind, 'name': name, 'value': round(value, 3)})
+
+    def flush(self, snapshot:bool=False):
+        lines = []
+        while self._pending:
+            lines.append(json.dumps(self._pending.popleft(), ensure_ascii=False))
+        if snapshot:
+            lines.append(json.dumps({'t': round(time.time(), 3), 'kind': 'snapshot',
+                                     'metrics': self.registry.snapshot()}, ensure_ascii=False))
+        if not lines:
+            return
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write("\n".join(lines) + "\n")
+
+    def close(self):
+        # 何か記録したセッションのみ、最後に集計結果も残す
+        self.registry.remove_listener(self.record)
+        self._closed = True
+        self.flush(snapshot=self.events > 0)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+from typing import Callable
+
+from PySide2 import QtWidgets, QtCore
+
+from .metrics import MetricsRegistry, METRICS, COUNTER
+
+REFRESH_INTERVAL = 500 # ms
+COLUMNS = ("Metric", "Count", "Last", "Mean", "p50", "p95", "Max")
+
+def format_value(value:float) -> str:
+    return "{:.0f}".format(value) if value >= 100 or value == int(value) else "{:.1f}".format(value)
+
+class MetricsPanel(QtWidgets.QDockWidget):
+    # 送信から読み上げまでの各段階の計測値を表示する (表示中のみ更新)
+
+    def __init__(self, registry:MetricsRegistry=METRICS, parent=None):
+        super(MetricsPanel, self).__init__("Metrics", parent)
+        self.registry = registry
+        self.samplers = {}
+
+        self.table = QtWidgets.QTableWidget(0, len(COLUMNS))
+        self.table.setHorizontalHeaderLabels(COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QtWidgets.QAbstractItemView.NoEditTriggers)
+        self.table.setSelectionMode(QtWidgets.QAbstractItemView.NoSelection)
+        self.table.setAlternatingRowColors(True)
+        header = self.table.horizontalHeader()
+        header.setSectionResizeMode(0, QtWidgets.QHeaderView.Stretch)
+        for column in range(1, len(COLUMNS)):
+            header.setSectionResizeMode(column, QtWidgets.QHeaderView.ResizeToContents)
+
+        reset_button = QtWidgets.QPushButton("Reset")
+        reset_button.setMaximumWidth(80)
+        reset_button.clicked.connect(self.reset)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addWidget(self.table)
+        layout.addWidget(reset_button, alignment=QtCore.Qt.AlignRight)
+        widget = QtWidgets.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setInterval(REFRESH_INTERVAL)
+        self.timer.timeout.connect(self.refresh)
+        self.visibilityChanged.connect(self.toggle_refresh)
+
+    def add_sampler(self, name:str, func:Callable[[], float]):
+        # キューの長さなど、更新のたびに読み取ってゲージに記録する値
+        self.samplers[name] = func
+
+    def toggle_refresh(self, visible:bool, *args):
+        if visible:
+            self.refresh()
+            self.timer.start()
+        else:
+            self.timer.stop()
+
+    def refresh(self, *args):
+        for name, func in self.samplers.items():
+            try:
+                self.registry.gauge(name, func())
+            except Exception:
+                pass
+
+        summary = self.registry.summary()
+        self.table.setRowCount(len(summary))
+        for row, metric in enumerate(summary):
+            if metric.kind == COUNTER:
+                values = [metric.name, format_value(metric.count), "", "", "", "", ""]
+            else:
+                values = [metric.name, str(metric.count)] + [
+                    format_value(v) for v in (metric.last, metric.mean, metric.p50, metric.p95, metric.max)]
+            for column, text in enumerate(values):
+                item = self.table.item(row, column)
+                if item is None:
+                    item = QtWidgets.QTableWidgetItem()
+                    if column:
+                        item.setTextAlignment(QtCore.Qt.AlignRight | QtCore.Qt.AlignVCenter)
+                    self.table.setItem(row, column, item)
+                item.setText(text)
+
+    def reset(self, *args):
+        self.registry.reset()
+        self.refresh()
+
+    def focus(self, *args):
+        self.show()
+        self.raise_()
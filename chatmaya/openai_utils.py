@@ -1,55 +1,430 @@
 # -*- coding: utf-8 -*-
-from typing import List
-from tenacity import (
-    retry,
-    retry_if_exception_type,
-    stop_after_attempt,
-    wait_exponential,
-)
+import time
+import socket
+import random
+import threading
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+from functools import lru_cache
 
-import openai
-import tiktoken
+from .cancel import CancelToken
+from .rate_limit import get_rate_scheduler
+from .metrics import current_metrics, RATE_WAIT, RATE_LIMITED
+from .trace import TRACER
+
+# openai/tiktoken/requestsは読み込みに時間がかかるため、初回の送信時にimportする
+if TYPE_CHECKING:
+    import requests
 
 DEFAULT_CHAT_MODEL = "gpt-3.5-turbo"
 DEFAULT_ENCODING = "cl100k_base"
 
+# モデルごとのコンテキスト長 (前方一致、長い名前から順に探す)
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-16k": 16384,
+    "gpt-3.5-turbo": 4096,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# ChatMLで1メッセージごとに付くトークン数 (<|start|>{role}\n{content}<|end|>\n) と nameの増減
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+LEGACY_MESSAGE_FORMATS = {
+    "gpt-3.5-turbo-0301": (4, -1),
+}
+REPLY_PRIMING_TOKENS = 3 # 返答の頭 <|start|>assistant<|message|>
+
 MAX_ATTEMPT = 3 # リトライ回数
-MIN_SECONDS = 5 # 最小リトライ秒数
+MIN_SECONDS = 1 # 最小リトライ秒数
 MAX_SECONDS = 15 # 最大リトライ秒数
+MAX_RATE_LIMITED = 10 # RateScheduler使用時にRateLimitErrorで送り直す回数 (MAX_ATTEMPTとは別)
+
+CONNECT_TIMEOUT = 10 # 接続までの秒数
+TTFT_TIMEOUT = 30 # 最初のトークンまでの秒数
+STALL_TIMEOUT = 20 # チャンク間の最大秒数
+MAX_CONNECTIONS = 8 # 共有セッションの接続プール数
+
+class StreamTimeout(Exception):
+    # 最初のトークン/次のチャンクが期限までに届かなかった
+    pass
+
+class ContextLengthError(Exception):
+    # 送信前の見積もりでコンテキスト長を超えている (送っても InvalidRequestError になる)
+
+    def __init__(self, model:str, prompt_tokens:int, max_tokens:int, window:int):
+        super(ContextLengthError, self).__init__(
+            "{} prompt tokens + {} completion tokens exceed the {} token context window of {}".format(
+                prompt_tokens, max_tokens, window, model))
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.window = window
+
+class _StreamResetType(object):
+    def __repr__(self):
+        return "STREAM_RESET"
+
+# 再接続後の返答が既に返した内容と食い違った場合に流す合図。受け取った側はそれまでの内容を破棄する
+STREAM_RESET = _StreamResetType()
+
+@lru_cache(maxsize=None)
+def non_retryable_errors() -> Tuple:
+    # リトライしても結果が変わらないエラー
+    import openai
+    return (
+        openai.error.InvalidRequestError,
+        openai.error.AuthenticationError,
+        openai.error.PermissionError,
+        openai.error.InvalidAPIType,
+        openai.error.SignatureVerificationError,
+    )
+
+@lru_cache(maxsize=None)
+def retryable_errors() -> Tuple:
+    import openai
+    return (
+        StreamTimeout,
+        openai.error.APIError,
+        openai.error.Timeout,
+        openai.error.RateLimitError,
+        openai.error.APIConnectionError,
+        openai.error.ServiceUnavailableError,
+        openai.error.TryAgain,
+    )
+
+def is_retryable(e:Exception) -> bool:
+    if isinstance(e, non_retryable_errors()) or is_quota_error(e):
+        return False
+    return isinstance(e, retryable_errors())
 
-def retry_decorator(func):
-    return retry(
-        #reraise=True,
-        stop=stop_after_attempt(MAX_ATTEMPT),
-        wait=wait_exponential(multiplier=1, min=MIN_SECONDS, max=MAX_SECONDS),
-        retry=(
-            retry_if_exception_type(openai.error.APIError)
-            | retry_if_exception_type(openai.error.Timeout)
-            | retry_if_exception_type(openai.error.RateLimitError)
-            | retry_if_exception_type(openai.error.APIConnectionError)
-            | retry_if_exception_type(openai.error.InvalidRequestError)
-            | retry_if_exception_type(openai.error.AuthenticationError)
-            | retry_if_exception_type(openai.error.ServiceUnavailableError)
-        )
-    )(func)
+def is_quota_error(e:Exception) -> bool:
+    # 残高不足もRateLimitErrorで返るが、待っても送れない
+    import openai
+    return isinstance(e, openai.error.RateLimitError) and getattr(e, "code", None) == "insufficient_quota"
+
+def is_rate_limited(e:Exception) -> bool:
+    import openai
+    return isinstance(e, openai.error.RateLimitError) and not is_quota_error(e)
+
+def retry_wait(e:Exception, attempt:int) -> float:
+    # RateLimitErrorはRetry-Afterに従う
+    headers = getattr(e, "headers", None) or {}
+    retry_after = headers.get("retry-after") or headers.get("Retry-After")
+    if retry_after:
+        try:
+            return min(float(retry_after), MAX_SECONDS)
+        except ValueError:
+            pass
+    wait = MIN_SECONDS * (2 ** (attempt - 1))
+    return min(wait, MAX_SECONDS) * random.uniform(0.8, 1.2)
+
+@lru_cache(maxsize=None)
+def get_encoding(encoding_name:str=DEFAULT_ENCODING):
+    import tiktoken
+    return tiktoken.get_encoding(encoding_name)
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> "requests.Session":
+    # openaiはスレッドごとにセッションを作るため、送信のたびに接続(TLS)からやり直しになる
+    # 1つのセッションを共有してKeep-Aliveで使い回す
+    import requests
+    import openai
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_CONNECTIONS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+            openai.requestssession = _session
+        return _session
+
+def preconnect(request_timeout:float=CONNECT_TIMEOUT):
+    # 軽いリクエストを送り、APIサーバーとの接続を張っておく
+    from openai import api_requestor
+
+    get_session()
+    requestor = api_requestor.APIRequestor()
+    requestor.request("get", "/models", request_timeout=request_timeout)
+
+@lru_cache(maxsize=None)
+def encoding_for_model(model:str=DEFAULT_CHAT_MODEL):
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return get_encoding(DEFAULT_ENCODING)
+
+def context_window(model:str) -> int:
+    for name in sorted(MODEL_CONTEXT_WINDOWS, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return MODEL_CONTEXT_WINDOWS[name]
+    return DEFAULT_CONTEXT_WINDOW
 
 def num_tokens_from_text(text:str, encoding_name:str=DEFAULT_ENCODING) -> int:
-    encoding = tiktoken.get_encoding(encoding_name)
+    encoding = get_encoding(encoding_name)
     num_tokens = len(encoding.encode(text))
     return num_tokens
 
-@retry_decorator
-def chat_completion_stream(messages:List, model:str=DEFAULT_CHAT_MODEL, **kwargs) -> str:
-        
-        result = openai.ChatCompletion.create(
-            model=model,
-            messages=messages,
-            stream=True,
-            **kwargs
-        )
-        
-        for chunk in result:
-            if chunk:
-                content = chunk['choices'][0]['delta'].get('content')
+def num_tokens_for_model(text:str, model:str=DEFAULT_CHAT_MODEL) -> int:
+    # APIのusage.completion_tokensと同じく、モデルのエンコーディングで数える
+    return len(encoding_for_model(model).encode(text))
+
+def num_tokens_from_message(message:Dict, model:str=DEFAULT_CHAT_MODEL) -> int:
+    # APIのusage.prompt_tokensと同じ数え方 (role/nameと区切りのトークンを含む)
+    encoding = encoding_for_model(model)
+    tokens_per_message, tokens_per_name = LEGACY_MESSAGE_FORMATS.get(model, (TOKENS_PER_MESSAGE, TOKENS_PER_NAME))
+    num_tokens = tokens_per_message
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value or ""))
+        if key == "name":
+            num_tokens += tokens_per_name
+    return num_tokens
+
+def num_tokens_from_messages(messages:List[Dict], model:str=DEFAULT_CHAT_MODEL) -> int:
+    return sum(num_tokens_from_message(message, model) for message in messages) + REPLY_PRIMING_TOKENS
+
+def check_context_length(messages:List[Dict], model:str=DEFAULT_CHAT_MODEL, max_tokens:int=None) -> int:
+    # 送信前にコンテキスト長に収まるか確かめ、プロンプトのトークン数を返す
+    prompt_tokens = num_tokens_from_messages(messages, model)
+    window = context_window(model)
+    if prompt_tokens + (max_tokens or 1) > window:
+        raise ContextLengthError(model, prompt_tokens, max_tokens or 1, window)
+    return prompt_tokens
+
+def abort_response(response:"requests.Response"):
+    # 別スレッドで読み込み中のソケットを確実に止めるため、closeの前にshutdownする
+    raw = getattr(response, "raw", None)
+    sock = None
+    connection = getattr(raw, "_connection", None)
+    if connection is not None:
+        sock = getattr(connection, "sock", None)
+    if sock is None:
+        try:
+            sock = raw._fp.fp.raw._sock
+        except AttributeError:
+            pass
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    try:
+        response.close()
+    except Exception:
+        pass
+
+class _Watchdog(object):
+    # 期限までに次のチャンクが来なければレスポンスを切断する
+
+    def __init__(self, response:"requests.Response", timeout:float):
+        self.response = response
+        self.expired = False
+        self._deadline = time.monotonic() + timeout
+        self._cond = threading.Condition()
+        self._done = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def reset(self, timeout:float):
+        with self._cond:
+            self._deadline = time.monotonic() + timeout
+
+    def stop(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def _run(self):
+        with self._cond:
+            while not self._done:
+                remaining = self._deadline - time.monotonic()
+                if remaining <= 0:
+                    self.expired = True
+                    break
+                self._cond.wait(remaining)
+        if self.expired:
+            abort_response(self.response)
+
+def open_chat_stream(params:Dict, request_timeout=None) -> Tuple["requests.Response", Iterator]:
+    from openai import api_requestor
+
+    get_session()
+    requestor = api_requestor.APIRequestor()
+    response = requestor.request_raw(
+        "post",
+        "/chat/completions",
+        params=params,
+        stream=True,
+        request_timeout=request_timeout or (CONNECT_TIMEOUT, max(TTFT_TIMEOUT, STALL_TIMEOUT))
+    )
+    try:
+        chunks, _ = requestor._interpret_response(response, stream=True)
+    except Exception:
+        # エラーの返答 (429など) でも接続をプールに戻す
+        response.close()
+        raise
+    return response, chunks
+
+def _iter_chunks(
+    params:Dict,
+    ttft_timeout:float,
+    stall_timeout:float,
+    cancel:Optional[CancelToken]=None
+) -> Iterator[Tuple[int, str]]:
+    import requests
+    import urllib3
+    import openai
+
+    response, chunks = open_chat_stream(params)
+    scheduler = get_rate_scheduler()
+    if scheduler is not None:
+        scheduler.update(params["model"], response.headers)
+    if not hasattr(chunks, "__next__"):
+        # event-streamでない返答
+        chunks = iter([chunks])
+
+    # 中断されたら次のチャンクを待たずに接続を切る
+    unregister = cancel.register(lambda: abort_response(response)) if cancel else None
+    watchdog = _Watchdog(response, ttft_timeout)
+    received = False
+    try:
+        for chunk in chunks:
+            data = chunk.data if hasattr(chunk, "data") else chunk
+            for choice in data.get('choices', []):
+                content = choice.get('delta', {}).get('content')
                 if content:
-                    yield content
\ No newline at end of file
+                    if not received:
+                        received = True
+                        watchdog.reset(stall_timeout)
+                    yield choice.get('index', 0), content
+            if received:
+                watchdog.reset(stall_timeout)
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError, ValueError, AttributeError) as e:
+        if cancel is not None and cancel.cancelled:
+            return
+        if watchdog.expired:
+            raise StreamTimeout("No tokens received for {} seconds".format(
+                stall_timeout if received else ttft_timeout)) from e
+        raise openai.error.APIConnectionError("Stream interrupted: {}".format(e)) from e
+    finally:
+        if unregister is not None:
+            unregister()
+        watchdog.stop()
+        abort_response(response)
+
+    if watchdog.expired:
+        raise StreamTimeout("Stream timed out")
+
+def wait_rate_limit(params:Dict, cost:int, cancel:Optional[CancelToken]=None) -> bool:
+    # RateSchedulerがあれば送れるようになるまで待つ (中断されたらFalse)
+    scheduler = get_rate_scheduler()
+    if scheduler is None:
+        return True
+    start = TRACER.timestamp()
+    waited = scheduler.acquire(params["model"], cost, cancel)
+    if waited < 0:
+        return False
+    if waited > 0:
+        current_metrics().observe(RATE_WAIT, waited * 1000)
+        TRACER.complete("rate wait", start, cat="completion", args={"tokens": cost})
+    return True
+
+def completion_cost(params:Dict, prompt_tokens:int) -> int:
+    # TPMにはプロンプトとmax_tokens(候補の数だけ)が送信時に数えられる
+    return prompt_tokens + (params.get("max_tokens") or 0) * int(params.get("n", 1))
+
+def stream_with_retry(
+    params:Dict,
+    max_attempt:int=None,
+    ttft_timeout:float=None,
+    stall_timeout:float=None,
+    cancel:Optional[CancelToken]=None,
+    cost:int=None
+) -> Iterator:
+    max_attempt = max_attempt or MAX_ATTEMPT
+    ttft_timeout = ttft_timeout or TTFT_TIMEOUT
+    stall_timeout = stall_timeout or STALL_TIMEOUT
+    if cost is None and get_rate_scheduler() is not None:
+        cost = completion_cost(params, num_tokens_from_messages(params["messages"], params["model"]))
+
+    # 途中で切れた場合は再接続し、既に返した部分は読み飛ばす
+    emitted = {}
+    attempt = 0
+    rate_limited = 0
+    while True:
+        if cancel is not None and cancel.cancelled:
+            return
+        if not wait_rate_limit(params, cost, cancel):
+            return
+        attempt += 1
+        received = {}
+        chunks = _iter_chunks(params, ttft_timeout, stall_timeout, cancel)
+        try:
+            for index, content in chunks:
+                start = len(received.get(index, ""))
+                received[index] = received.get(index, "") + content
+                done = emitted.get(index, "")
+                overlap = done[start:start + len(content)]
+                if content[:len(overlap)] == overlap:
+                    new = content[len(overlap):]
+                    if new:
+                        emitted[index] = received[index]
+                        yield index, new
+                    continue
+
+                # 前回と違う内容になったので最初からやり直す
+                yield STREAM_RESET
+                emitted = dict(received)
+                for i, text in received.items():
+                    yield i, text
+            if cancel is not None and cancel.cancelled:
+                return
+            if any(len(received.get(i, "")) < len(text) for i, text in emitted.items()):
+                # 前回より短い返答で終わった場合も、既に返した末尾を残さないよう最初からやり直す
+                yield STREAM_RESET
+                for i, text in received.items():
+                    yield i, text
+            return
+        except Exception as e:
+            if cancel is not None and cancel.cancelled:
+                return
+            scheduler = get_rate_scheduler()
+            if scheduler is not None and is_rate_limited(e):
+                # 次のwait_rate_limitがリセットまでちょうど待つので、ここでは待たない
+                current_metrics().inc(RATE_LIMITED)
+                scheduler.update(params["model"], getattr(e, "headers", None), limited=True)
+                rate_limited += 1
+                if rate_limited > MAX_RATE_LIMITED:
+                    raise
+                attempt -= 1
+                continue
+            if not is_retryable(e) or attempt >= max_attempt:
+                raise
+            if cancel is not None:
+                cancel.wait(retry_wait(e, attempt))
+            else:
+                time.sleep(retry_wait(e, attempt))
+        finally:
+            chunks.close()
+
+def chat_completion_stream(messages:List, model:str=DEFAULT_CHAT_MODEL, cancel:CancelToken=None, **kwargs) -> Iterator[str]:
+    prompt_tokens = check_context_length(messages, model, kwargs.get("max_tokens"))
+    params = dict(kwargs, model=model, messages=list(messages), stream=True)
+    for item in stream_with_retry(params, cancel=cancel, cost=completion_cost(params, prompt_tokens)):
+        if item is STREAM_RESET:
+            yield item
+            continue
+        index, content = item
+        if index == 0:
+            yield content
+
+def chat_completion_stream_n(messages:List, model:str=DEFAULT_CHAT_MODEL, n:int=1, cancel:CancelToken=None, **kwargs) -> Iterator[Tuple[int, str]]:
+    # n個の候補を同時に生成し、(候補番号, 差分)を返す
+    prompt_tokens = check_context_length(messages, model, kwargs.get("max_tokens"))
+    params = dict(kwargs, model=model, messages=list(messages), stream=True, n=n)
+    yield from stream_with_retry(params, cancel=cancel, cost=completion_cost(params, prompt_tokens))
@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+import io
+import time
+import wave
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from .trace import TRACER
+
+CHUNK_SIZE = 1024 # frames
+CONTINUATION_WINDOW = 2.0 # この秒数以内に次の音声が来た場合は途切れ(underrun)とみなす
+
+class AudioFormat(NamedTuple):
+    sampwidth :int
+    channels :int
+    rate :int
+
+    def frame_size(self) -> int:
+        return self.sampwidth * self.channels
+
+def read_wave(data:bytes):
+    with wave.open(io.BytesIO(data), mode='rb') as wf:
+        fmt = AudioFormat(wf.getsampwidth(), wf.getnchannels(), wf.getframerate())
+        frames = wf.readframes(wf.getnframes())
+    return fmt, frames
+
+def convert(frames:bytes, src:AudioFormat, dst:AudioFormat) -> bytes:
+    # 出力ストリームの形式に合わせてサンプル幅/チャンネル数/サンプリングレートを変換
+    if src == dst:
+        return frames
+
+    import audioop
+
+    width = src.sampwidth
+    if width == 1:
+        frames = audioop.bias(frames, 1, -128) # wavの8bitはunsigned
+    if width != dst.sampwidth:
+        frames = audioop.lin2lin(frames, width, dst.sampwidth)
+        width = dst.sampwidth
+
+    channels = src.channels
+    if channels == 2 and dst.channels == 1:
+        frames = audioop.tomono(frames, width, 0.5, 0.5)
+        channels = 1
+    elif channels == 1 and dst.channels == 2:
+        frames = audioop.tostereo(frames, width, 1.0, 1.0)
+        channels = 2
+
+    if src.rate != dst.rate:
+        frames, _ = audioop.ratecv(frames, width, channels, src.rate, dst.rate, None)
+
+    if width == 1:
+        frames = audioop.bias(frames, 1, 128)
+    return frames
+
+class AudioSink(ABC):
+    # 音声の出力先
+
+    @abstractmethod
+    def open(self, fmt:AudioFormat):
+        pass
+
+    @abstractmethod
+    def write(self, frames:bytes):
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+class PyAudioSink(AudioSink):
+    # サンプル形式ごとに1本の出力ストリームを開いたまま使い回す
+
+    def __init__(self, chunk_size:int=CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self._pyaudio = None
+        self._streams = {}
+        self._stream = None
+
+    def open(self, fmt:AudioFormat):
+        import pyaudio
+
+        if self._pyaudio is None:
+            self._pyaudio = pyaudio.PyAudio()
+        if fmt not in self._streams:
+            self._streams[fmt] = self._pyaudio.open(
+                format=self._pyaudio.get_format_from_width(fmt.sampwidth),
+                channels=fmt.channels,
+                rate=fmt.rate,
+                frames_per_buffer=self.chunk_size,
+                output=True)
+        self._stream = self._streams[fmt]
+
+    def write(self, frames:bytes):
+        self._stream.write(frames)
+
+    def close(self):
+        for stream in self._streams.values():
+            stream.stop_stream()
+            stream.close()
+        self._streams = {}
+        self._stream = None
+        if self._pyaudio is not None:
+            self._pyaudio.terminate()
+            self._pyaudio = None
+
+class NullSink(AudioSink):
+    # 何も再生しない (realtime=Trueなら再生時間分だけ待つ)
+
+    def __init__(self, realtime:bool=False):
+        self.realtime = realtime
+        self.fmt = None
+        self.frames_written = 0
+
+    def open(self, fmt:AudioFormat):
+        self.fmt = fmt
+
+    def write(self, frames:bytes):
+        n = len(frames) // self.fmt.frame_size()
+        self.frames_written += n
+        if self.realtime:
+            time.sleep(n / self.fmt.rate)
+
+    def close(self):
+        pass
+
+class WaveFileSink(AudioSink):
+    # 再生する代わりに1つのwavファイルへ書き出す
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self._wf = None
+        self.fmt = None
+
+    def open(self, fmt:AudioFormat):
+        if self._wf is not None:
+            return
+        self.fmt = fmt
+        self._wf = wave.open(str(self.path), 'wb')
+        self._wf.setsampwidth(fmt.sampwidth)
+        self._wf.setnchannels(fmt.channels)
+        self._wf.setframerate(fmt.rate)
+
+    def write(self, frames:bytes):
+        self._wf.writeframes(frames)
+
+    def close(self):
+        if self._wf is not None:
+            self._wf.close()
+            self._wf = None
+
+class AudioPlayer(object):
+    # 出力ストリームを開いたまま、ジッタバッファのPCMを隙間なく書き込み続ける
+
+    def __init__(self, sink:AudioSink=None, output_format:Optional[AudioFormat]=None, chunk_size:int=CHUNK_SIZE):
+        self.sink = sink if sink is not None else PyAudioSink(chunk_size)
+        self.output_format = output_format
+        self.chunk_size = chunk_size
+
+        self.underruns = 0
+        self.gap_seconds = 0.0
+        self.frames_played = 0
+
+        self._buffer = deque()
+        self._buffered_frames = 0
+        self._cond = threading.Condition()
+        self._playing = False
+        self._starved_at = None
+        self._cleared = False # clear()で空にした場合は途切れとして数えない
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def play(self, data:bytes):
+        fmt, frames = read_wave(data)
+        with self._cond:
+            if self.output_format is None:
+                self.output_format = fmt
+            frames = convert(frames, fmt, self.output_format)
+
+            step = self.chunk_size * self.output_format.frame_size()
+            for i in range(0, len(frames), step):
+                self._buffer.append(frames[i:i + step])
+            self._buffered_frames += len(frames) // self.output_format.frame_size()
+
+            if self._starved_at is not None:
+                gap = time.monotonic() - self._starved_at
+                if gap < CONTINUATION_WINDOW:
+                    self.underruns += 1
+                    self.gap_seconds += gap
+                self._starved_at = None
+            self._cond.notify_all()
+
+    def buffered_seconds(self) -> float:
+        with self._cond:
+            if not self.output_format:
+                return 0.0
+            return self._buffered_frames / self.output_format.rate
+
+    def is_idle(self) -> bool:
+        with self._cond:
+            return not self._buffer and not self._playing
+
+    def wait_idle(self, timeout:float=None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._buffer and not self._playing, timeout)
+
+    def clear(self):
+        with self._cond:
+            self._buffer.clear()
+            self._buffered_frames = 0
+            self._starved_at = None
+            self._cleared = True
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._buffer.clear()
+            self._cond.notify_all()
+        self._thread.join()
+        self.sink.close()
+
+    def _run(self):
+        opened = None
+        played_from = None
+        while True:
+            with self._cond:
+                while not self._buffer and not self._closed:
+                    if self._playing:
+                        self._playing = False
+                        self._starved_at = None if self._cleared else time.monotonic()
+                        self._cond.notify_all()
+                        # 途切れずに再生した区間を1つのスパンにする
+                        TRACER.complete("play_wave", played_from, cat="voice")
+                    self._cond.wait()
+                if self._closed:
+                    return
+                chunk = self._buffer.popleft()
+                self._cleared = False
+                fmt = self.output_format
+                self._buffered_frames -= len(chunk) // fmt.frame_size()
+                if not self._playing:
+                    played_from = time.perf_counter()
+                self._playing = True
+
+            if opened != fmt:
+                self.sink.open(fmt)
+                opened = fmt
+            self.sink.write(chunk)
+            self.frames_played += len(chunk) // fmt.frame_size()
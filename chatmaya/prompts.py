@@ -18,4 +18,22 @@ USER_TEMPLATE = """Write a {script_type} script that can be executed in Maya to
 FIX_TEMPLATE = """実行したら以下のようなエラーが出ました。修復してください。
 
 # Error:
-{error}"""
\ No newline at end of file
+{error}"""
+
+EXAMPLES_TEMPLATE = """以下は過去に同じような質問で生成し、エラー無く実行できたスクリプトです。役に立つ場合は参考にしてください。
+
+{examples}"""
+
+EXAMPLE_TEMPLATE = """# Question:
+{question}
+
+# Script:
+```{script_type}
+{code}
+```"""
+
+SUMMARY_TEMPLATE = """以下はこれより前の会話の要約です。
+
+{summary}"""
+
+CODE_REFERENCE_TEMPLATE = """[{lang} script omitted: {lines} lines{commands}]"""
\ No newline at end of file
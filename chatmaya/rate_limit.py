@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from .cancel import CancelToken
+
+STATE_FILE = 'rate_limit.json'
+
+# モデルごとの1分あたりのリクエスト数/トークン数 (APIの返すx-ratelimit-*ヘッダで上書きされる)
+MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo": (3500, 90000),
+    "gpt-3.5-turbo-16k": (3500, 180000),
+    "gpt-4": (200, 40000),
+    "gpt-4-32k": (200, 80000),
+}
+DEFAULT_RATE_LIMITS = (3500, 90000)
+MAX_WAIT_SLICE = 5.0 # 他のプロセスが覚えた制限を読み直す間隔
+STALE_SECONDS = 3600 # これより古いモデルの状態は読み込み時に捨てる
+LOCK_TIMEOUT = 10.0 # これ以上ロックが取れなければスケジュールせずに送る
+LOCK_POLL = 0.05
+
+logger = logging.getLogger(__name__)
+
+# CHATMAYA_RATE_LIMITS="gpt-4=500:30000,gpt-3.5-turbo=3500:90000" で既定値を変更する
+def parse_rate_limits(text:str) -> Dict[str, Tuple[int, int]]:
+    limits = {}
+    for item in (text or "").split(","):
+        match = re.match(r'\s*([\w.\-]+)\s*=\s*(\d+)\s*:\s*(\d+)\s*$', item)
+        if match:
+            limits[match.group(1)] = (int(match.group(2)), int(match.group(3)))
+    return limits
+
+MODEL_RATE_LIMITS.update(parse_rate_limits(os.environ.get("CHATMAYA_RATE_LIMITS")))
+
+def default_rate_limits(model:str) -> Tuple[int, int]:
+    for name in sorted(MODEL_RATE_LIMITS, key=len, reverse=True):
+        if model == name or model.startswith(name + "-"):
+            return MODEL_RATE_LIMITS[name]
+    return DEFAULT_RATE_LIMITS
+
+def parse_duration(text:str) -> Optional[float]:
+    # x-ratelimit-reset-* の "20ms" / "1s" / "6m0s" / "1h2m3.5s" を秒にする
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    parts = re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', text)
+    if not parts:
+        return None
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+class FileLock(object):
+    # 同じマシンの他のプロセス(別のMaya/バッチ)との排他
+    # Windowsはmsvcrt、それ以外はfcntlでロックファイルの先頭1バイトをロックする
+    # timeout秒以内に取れなければTimeoutErrorにする (ロックを持ったまま止まったプロセスで待ち続けない)
+
+    def __init__(self, path:Path, timeout:float=LOCK_TIMEOUT):
+        self.path = Path(path)
+        self.timeout = timeout
+        self._thread_lock = threading.Lock()
+        self._file = None
+
+    def _try_lock(self, f) -> bool:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            try:
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            except OSError:
+                return False
+        else:
+            import fcntl
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+        return True
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        if not self._thread_lock.acquire(timeout=self.timeout):
+            raise TimeoutError("could not lock {} in {}s".format(self.path, self.timeout))
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            f = open(self.path, 'a+b')
+            try:
+                while not self._try_lock(f):
+                    if time.monotonic() >= deadline:
+                        raise TimeoutError("could not lock {} in {}s".format(self.path, self.timeout))
+                    time.sleep(LOCK_POLL)
+            except Exception:
+                f.close()
+                raise
+            self._file = f
+        except Exception:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+        f, self._file = self._file, None
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        finally:
+            f.close()
+            self._thread_lock.release()
+
+class RateScheduler(object):
+    # モデルごとにリクエスト数とトークン数のトークンバケットを持ち、送信前に必要な分だけ待つ
+    # 状態はロックしたファイルに置き、同じマシンの全ウィンドウ/プロセスで共有する (pathがNoneならこのプロセスのみ)
+    # バケットは1分で空から満杯まで回復する。APIの返すx-ratelimit-*ヘッダで上限と残りを合わせる
+    # 状態ファイルをロック/読み書きできない場合は警告を出し、スケジュールせずに送る (429のリトライに任せる)
+
+    def __init__(self, path:Path=None):
+        self.path = Path(path) if path else None
+        self._lock = FileLock(self.path.with_suffix('.lock')) if self.path else threading.Lock()
+        self._memory = {}
+
+    def _load(self) -> Dict:
+        if self.path is None:
+            return self._memory
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        now = time.time()
+        return {model: bucket for model, bucket in state.items()
+                if isinstance(bucket, dict) and now - bucket.get("updated", 0) < STALE_SECONDS}
+
+    def _save(self, state:Dict):
+        if self.path is None:
+            self._memory = state
+            return
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(str(tmp), str(self.path))
+
+    @staticmethod
+    def _bucket(state:Dict, model:str, now:float) -> Dict:
+        bucket = state.get(model)
+        if bucket is None:
+            rpm, tpm = default_rate_limits(model)
+            bucket = state[model] = {"rpm": rpm, "tpm": tpm, "requests": float(rpm), "tokens": float(tpm),
+                                     "requests_reset": 0.0, "tokens_reset": 0.0, "updated": now}
+        # 前回からの経過時間分を回復する
+        elapsed = max(0.0, now - bucket["updated"])
+        bucket["requests"] = min(bucket["rpm"], bucket["requests"] + elapsed * bucket["rpm"] / 60)
+        bucket["tokens"] = min(bucket["tpm"], bucket["tokens"] + elapsed * bucket["tpm"] / 60)
+        bucket["updated"] = now
+        return bucket
+
+    @staticmethod
+    def _wait_seconds(bucket:Dict, tokens:int, now:float) -> float:
+        tokens = min(tokens, bucket["tpm"]) # 上限より大きいリクエストは満杯になるまで待って送る
+        wait = max(0.0, bucket["requests_reset"] - now, bucket["tokens_reset"] - now)
+        if bucket["requests"] < 1:
+            wait = max(wait, (1 - bucket["requests"]) * 60 / bucket["rpm"])
+        if bucket["tokens"] < tokens:
+            wait = max(wait, (tokens - bucket["tokens"]) * 60 / bucket["tpm"])
+        return wait
+
+    def try_acquire(self, model:str, tokens:int) -> float:
+        # 送れる場合は消費して0を、送れない場合は待つべき秒数を返す
+        try:
+            with self._lock:
+                state = self._load()
+                now = time.time()
+                bucket = self._bucket(state, model, now)
+                wait = self._wait_seconds(bucket, tokens, now)
+                if wait <= 0:
+                    bucket["requests"] -= 1
+                    bucket["tokens"] -= min(tokens, bucket["tpm"])
+                self._save(state)
+                return wait
+        except OSError as e:
+            logger.warning("rate limit state is unavailable, sending without scheduling: %s", e)
+            return 0.0
+
+    def acquire(self, model:str, tokens:int, cancel:CancelToken=None) -> float:
+        # 送れるようになるまで待ち、待った秒数を返す (中断された場合は-1)
+        start = time.perf_counter()
+        while True:
+            wait = self.try_acquire(model, tokens)
+            if wait <= 0:
+                return time.perf_counter() - start
+            wait = min(wait, MAX_WAIT_SLICE)
+            if cancel is not None:
+                if cancel.wait(wait):
+                    return -1
+            else:
+                time.sleep(wait)
+
+    def update(self, model:str, headers, limited:bool=False):
+        # APIの返したx-ratelimit-*ヘッダに合わせる (429の場合はリセットまで送らない)
+        if not headers:
+            return
+        get = lambda name: headers.get(name) or headers.get(name.title())
+        values = {}
+        for key, name in (("rpm", "x-ratelimit-limit-requests"), ("tpm", "x-ratelimit-limit-tokens"),
+                          ("requests", "x-ratelimit-remaining-requests"), ("tokens", "x-ratelimit-remaining-tokens")):
+            try:
+                values[key] = float(get(name))
+            except (TypeError, ValueError):
+                pass
+        resets = {key: parse_duration(get(name)) for key, name in
+                  (("requests_reset", "x-ratelimit-reset-requests"), ("tokens_reset", "x-ratelimit-reset-tokens"))}
+        retry_after = parse_duration(get("retry-after"))
+        if not values and not limited:
+            return
+
+        try:
+            with self._lock:
+                self._update(model, values, resets, retry_after, limited)
+        except OSError as e:
+            logger.warning("rate limit state is unavailable, skipping update: %s", e)
+
+    def _update(self, model:str, values:Dict, resets:Dict, retry_after:Optional[float], limited:bool):
+        state = self._load()
+        now = time.time()
+        bucket = self._bucket(state, model, now)
+        for key in ("rpm", "tpm"):
+            if values.get(key, 0) > 0:
+                bucket[key] = values[key]
+        for key in ("requests", "tokens"):
+            limit = bucket["rpm" if key == "requests" else "tpm"]
+            if key in values:
+                # サーバーの残りの方が少なければ合わせる (他のマシンからの利用分)
+                bucket[key] = min(bucket[key], values[key], limit)
+            else:
+                bucket[key] = min(bucket[key], limit)
+        if limited:
+            exhausted = [k for k in ("requests", "tokens") if values.get(k, 1) <= 0 and resets[k + "_reset"]]
+            for key in exhausted:
+                bucket[key + "_reset"] = max(bucket[key + "_reset"], now + resets[key + "_reset"])
+            if not exhausted:
+                # どちらを超えたか分からない場合はRetry-After (無ければ1秒分) 待つ
+                bucket["requests_reset"] = max(bucket["requests_reset"], now + (retry_after or 60 / bucket["rpm"]))
+        self._save(state)
+
+_scheduler = None
+
+def set_rate_scheduler(scheduler:Optional[RateScheduler]):
+    global _scheduler
+    _scheduler = scheduler
+
+def get_rate_scheduler() -> Optional[RateScheduler]:
+    return _scheduler
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import re
+import json
+import math
+import time
+import hashlib
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional
+
+from .openai_utils import DEFAULT_CHAT_MODEL, num_tokens_for_model
+from .prompts import EXAMPLES_TEMPLATE, EXAMPLE_TEMPLATE
+
+TOP_K = 3
+TOKEN_BUDGET = 600 # 例として差し込む最大トークン数
+MIN_SCORE = 0.06 # 質問の語が全て一致した場合を1とした一致度。これ未満は差し込まない
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+WORD_PATTERN = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+CAMEL_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+|[0-9]+')
+CJK_PATTERN = re.compile(r'[぀-ヿ㐀-鿿]+')
+
+def tokenize(text:str) -> List[str]:
+    # 英単語/識別子は全体とcamelCaseの各部分、日本語は2文字ずつ
+    tokens = []
+    for word in WORD_PATTERN.findall(text):
+        lower = word.lower()
+        tokens.append(lower)
+        parts = [part.lower() for part in CAMEL_PATTERN.findall(word.replace("_", " ")) if len(part) > 1]
+        tokens += [part for part in parts if part != lower]
+    for run in CJK_PATTERN.findall(text):
+        if len(run) == 1:
+            tokens.append(run)
+        tokens += [run[i:i + 2] for i in range(len(run) - 1)]
+    return tokens
+
+class Example(NamedTuple):
+    question :str
+    code :str
+    script_type :str
+
+class ScriptMemory(object):
+    # 実行に成功したスクリプトと、それを生成した質問のBM25インデックス
+    # ディスクには1行1件で追記し、起動後最初の検索時にメモリ上に読み込む
+
+    def __init__(self, path:Path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._examples = []
+        self._keys = {}
+        self._docs = [] # 例ごとの Counter(token)
+        self._lengths = []
+        self._df = Counter()
+        self._total_length = 0
+
+    def __len__(self) -> int:
+        self._load()
+        return len(self._examples)
+
+    @staticmethod
+    def key(code:str, script_type:str) -> str:
+        return hashlib.sha1((script_type + "\n" + code.strip()).encode('utf-8')).hexdigest()
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.path.is_file():
+                return
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self._index(Example(record["question"], record["code"], record["script_type"]))
+
+    def _index(self, example:Example) -> bool:
+        key = self.key(example.code, example.script_type)
+        if key in self._keys:
+            return False
+        # 質問の語を重く見るため2回数える
+        counts = Counter(tokenize(example.question) * 2 + tokenize(example.code))
+        self._keys[key] = len(self._examples)
+        self._examples.append(example)
+        self._docs.append(counts)
+        self._lengths.append(sum(counts.values()))
+        self._total_length += self._lengths[-1]
+        self._df.update(counts.keys())
+        return True
+
+    def add(self, question:str, code:str, script_type:str) -> bool:
+        if not question or not code.strip():
+            return False
+        self._load()
+        example = Example(question, code.strip(), script_type)
+        with self._lock:
+            if not self._index(example):
+                return False
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            record = dict(example._asdict(), t=time.time())
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        return True
+
+    def search(self, query:str, script_type:str, k:int=TOP_K, min_score:float=MIN_SCORE) -> List[Example]:
+        self._load()
+        terms = set(tokenize(query))
+        with self._lock:
+            n = len(self._examples)
+            if not n or not terms:
+                return []
+            avg_length = self._total_length / n
+            idf = {t: math.log(1 + (n - self._df[t] + 0.5) / (self._df[t] + 0.5)) for t in terms}
+            # 例の数に依らない閾値にするため、全ての語が十分に一致した場合のスコアで割る
+            ideal = sum(idf.values()) * (BM25_K1 + 1)
+            idf = {t: weight for t, weight in idf.items() if self._df[t]}
+
+            scored = []
+            for i, counts in enumerate(self._docs):
+                if self._examples[i].script_type != script_type:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[i] / avg_length)
+                score = 0.0
+                for term, weight in idf.items():
+                    tf = counts.get(term)
+                    if tf:
+                        score += weight * tf * (BM25_K1 + 1) / (tf + norm)
+                if score / ideal >= min_score:
+                    scored.append((score, i))
+            scored.sort(reverse=True)
+            return [self._examples[i] for _, i in scored[:k]]
+
+def format_examples(examples:List[Example], budget:int=TOKEN_BUDGET, model:str=DEFAULT_CHAT_MODEL) -> Optional[Dict]:
+    # トークン数の上限に収まる分だけ、順位の高い例から並べる
+    blocks = []
+    used = num_tokens_for_model(EXAMPLES_TEMPLATE.format(examples=""), model)
+    for example in examples:
+        block = EXAMPLE_TEMPLATE.format(
+            question=example.question,
+            script_type=example.script_type,
+            code=example.code)
+        tokens = num_tokens_for_model(block, model) + 1
+        if used + tokens > budget:
+            continue
+        blocks.append(block)
+        used += tokens
+    if not blocks:
+        return None
+    return {"role": "system", "content": EXAMPLES_TEMPLATE.format(examples="\n\n".join(blocks))}
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+from typing import List, NamedTuple
+
+from .journal import load_messages
+
+SESSION_PREFIX = 'session_'
+SCRIPT_SUFFIXES = ('.py', '.mel')
+SEARCH_LIMIT = 50
+COMMIT_SESSIONS = 50 # 作成時にまとめてcommitするセッション数
+
+MESSAGE = 'message'
+SCRIPT = 'script'
+
+class SearchHit(NamedTuple):
+    session :str
+    kind :str
+    name :str
+    role :str
+    snippet :str
+    content :str
+
+def folder_signature(session_dir:Path) -> str:
+    # 中身は読まずにファイル名/サイズ/更新時刻だけで変更を判定する
+    entries = []
+    with os.scandir(session_dir) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append("{}:{}:{}".format(entry.name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha1("\n".join(sorted(entries)).encode('utf-8')).hexdigest()
+
+def read_scripts(session_dir:Path) -> List[Path]:
+    return sorted(p for p in Path(session_dir).iterdir() if p.suffix in SCRIPT_SUFFIXES and p.is_file())
+
+def like_pattern(term:str) -> str:
+    # %と_をそのままの文字として部分一致させる (ESCAPE '\')
+    return "%{}%".format(term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+def fts_query(text:str) -> str:
+    # 入力をそのままFTS5の構文として解釈させず、空白区切りの語のAND検索にする
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in text.split())
+
+class SearchIndex(object):
+    # LOG_DIR以下の全セッションの質問/返答/スクリプトの全文検索インデックス (SQLite FTS5)
+
+    def __init__(self, db_path:Path, log_dir:Path):
+        self.db_path = Path(db_path)
+        self.log_dir = Path(log_dir)
+        self._local = threading.local()
+        self.trigram = True
+        self._init_db()
+
+    def connect(self) -> sqlite3.Connection:
+        # sqliteの接続はスレッドごとに持つ
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(str(self.db_path), timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _init_db(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS sessions (name TEXT PRIMARY KEY, signature TEXT)")
+        try:
+            # 日本語は単語の区切りが無いため、部分一致できるtrigramを使う
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5("
+                "session UNINDEXED, kind UNINDEXED, name UNINDEXED, role UNINDEXED, content, tokenize='trigram')")
+        except sqlite3.OperationalError:
+            # trigramの無い古いsqlite
+            self.trigram = False
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5("
+                "session UNINDEXED, kind UNINDEXED, name UNINDEXED, role UNINDEXED, content)")
+        conn.commit()
+
+    def session_dirs(self) -> List[Path]:
+        if not self.log_dir.is_dir():
+            return []
+        return sorted(p for p in self.log_dir.iterdir() if p.is_dir() and p.name.startswith(SESSION_PREFIX))
+
+    def update_session(self, session_dir:Path, signature:str=None, commit:bool=True) -> bool:
+        # 1つのセッションを索引し直す。変更が無ければ何もしない
+        session_dir = Path(session_dir)
+        if not session_dir.is_dir():
+            return False
+        signature = signature or folder_signature(session_dir)
+        conn = self.connect()
+        row = conn.execute("SELECT signature FROM sessions WHERE name=?", (session_dir.name,)).fetchone()
+        if row and row[0] == signature:
+            return False
+
+        docs = []
+        for message in load_messages(session_dir) or []:
+            if message.get("role") in ("user", "assistant") and message.get("content"):
+                docs.append((session_dir.name, MESSAGE, "", message["role"], message["content"]))
+        for path in read_scripts(session_dir):
+            with open(path, encoding='utf-8-sig', errors='replace') as f:
+                docs.append((session_dir.name, SCRIPT, path.name, "", f.read()))
+
+        if row is not None:
+            # sessionには索引が無く全件を走査するため、索引済みの場合のみ消す
+            conn.execute("DELETE FROM docs WHERE session=?", (session_dir.name,))
+        conn.executemany("INSERT INTO docs (session, kind, name, role, content) VALUES (?, ?, ?, ?, ?)", docs)
+        conn.execute("INSERT OR REPLACE INTO sessions (name, signature) VALUES (?, ?)", (session_dir.name, signature))
+        if commit:
+            conn.commit()
+        return True
+
+    def rebuild(self, cancel:threading.Event=None) -> int:
+        # 変更のあったセッションのみ読み直し、消えたセッションは削除する
+        conn = self.connect()
+        updated = 0
+        names = set()
+        try:
+            for session_dir in self.session_dirs():
+                if cancel is not None and cancel.is_set():
+                    return updated
+                names.add(session_dir.name)
+                try:
+                    if self.update_session(session_dir, commit=False):
+                        updated += 1
+                except (OSError, ValueError):
+                    continue
+                if updated and updated % COMMIT_SESSIONS == 0:
+                    conn.commit()
+
+            indexed = set(row[0] for row in conn.execute("SELECT name FROM sessions"))
+            for name in indexed - names:
+                conn.execute("DELETE FROM docs WHERE session=?", (name,))
+                conn.execute("DELETE FROM sessions WHERE name=?", (name,))
+        finally:
+            conn.commit()
+        return updated
+
+    def search(self, text:str, limit:int=SEARCH_LIMIT) -> List[SearchHit]:
+        terms = text.split()
+        if not terms:
+            return []
+        conn = self.connect()
+        if self.trigram and any(len(term) < 3 for term in terms):
+            # trigramは3文字未満の語を検索できないのでLIKEで探す
+            where = " AND ".join("content LIKE ? ESCAPE '\\'" for _ in terms)
+            rows = conn.execute(
+                "SELECT session, kind, name, role, substr(content, 1, 200), content FROM docs "
+                "WHERE {} ORDER BY session DESC LIMIT ?".format(where),
+                [like_pattern(term) for term in terms] + [limit]).fetchall()
+        else:
+            rows = conn.execute(
+                "SELECT session, kind, name, role, snippet(docs, 4, '[', ']', '...', 16), content FROM docs "
+                "WHERE docs MATCH ? ORDER BY rank LIMIT ?",
+                (fts_query(text), limit)).fetchall()
+        return [SearchHit(*row) for row in rows]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
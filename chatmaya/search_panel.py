@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import time
+import sqlite3
+
+from PySide2 import QtWidgets, QtCore
+
+from .search import SearchIndex, SCRIPT
+
+SEARCH_DELAY = 150 # ms 入力が止まってから検索する
+
+class SearchPanel(QtWidgets.QDockWidget):
+    # 過去のセッションを検索し、選んだスクリプトをエディタに読み込む
+
+    hit_activated = QtCore.Signal(object)
+
+    def __init__(self, index:SearchIndex, parent=None):
+        super(SearchPanel, self).__init__("Search", parent)
+        self.index = index
+        self.hits = []
+
+        self.query_edit = QtWidgets.QLineEdit()
+        self.query_edit.setPlaceholderText("Search past sessions and scripts...")
+        self.query_edit.setClearButtonEnabled(True)
+
+        self.result_list = QtWidgets.QListWidget()
+        self.result_list.setWordWrap(True)
+        self.result_list.setAlternatingRowColors(True)
+        self.result_list.itemActivated.connect(self.activate)
+
+        self.info_label = QtWidgets.QLabel()
+
+        self.timer = QtCore.QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(SEARCH_DELAY)
+        self.timer.timeout.connect(self.search)
+        self.query_edit.textChanged.connect(self.schedule_search)
+        self.query_edit.returnPressed.connect(self.search)
+
+        layout = QtWidgets.QVBoxLayout()
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addWidget(self.query_edit)
+        layout.addWidget(self.result_list)
+        layout.addWidget(self.info_label)
+        widget = QtWidgets.QWidget()
+        widget.setLayout(layout)
+        self.setWidget(widget)
+
+    def schedule_search(self, *args):
+        self.timer.start()
+
+    def search(self, *args):
+        self.timer.stop()
+        text = self.query_edit.text()
+        start = time.perf_counter()
+        try:
+            self.hits = self.index.search(text)
+        except sqlite3.Error as e:
+            self.hits = []
+            self.info_label.setText(str(e))
+            return
+        seconds = time.perf_counter() - start
+
+        self.result_list.clear()
+        for hit in self.hits:
+            if hit.kind == SCRIPT:
+                title = "{}  {}".format(hit.session, hit.name)
+            else:
+                title = "{}  ({})".format(hit.session, hit.role)
+            self.result_list.addItem("{}\n{}".format(title, " ".join(hit.snippet.split())))
+        self.info_label.setText("{} hits ({:.1f} ms)".format(len(self.hits), seconds * 1000) if text else "")
+
+    def activate(self, item, *args):
+        row = self.result_list.row(item)
+        if 0 <= row < len(self.hits):
+            self.hit_activated.emit(self.hits[row])
+
+    def focus(self, *args):
+        self.show()
+        self.raise_()
+        self.query_edit.setFocus()
+        self.query_edit.selectAll()
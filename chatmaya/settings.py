@@ -12,6 +12,7 @@ class CompletionSettings(BaseModel):
     top_p :float = 1.0
     presence_penalty :float = 0.0
     frequency_penalty :float = 0.0
+    candidates :int = 1
 
 class VoiceSettings(BaseModel):
     speakerid :int = 47
@@ -20,6 +21,7 @@ class VoiceSettings(BaseModel):
     intonation :float = 1.0
     volume :float = 1.0
     post :float = 0.1
+    workers :int = 2
 
 class SettingsData(BaseModel):
     completion :CompletionSettings = CompletionSettings()
@@ -32,6 +34,7 @@ class SettingsData(BaseModel):
             top_p = dict["completion"]["top_p"],
             presence_penalty = dict["completion"]["presence_penalty"],
             frequency_penalty = dict["completion"]["frequency_penalty"],
+            candidates = dict["completion"].get("candidates", CompletionSettings.__fields__["candidates"].default),
         )
         voice_settings = VoiceSettings(
             speakerid = dict["voice"]["speakerid"],
@@ -40,6 +43,7 @@ class SettingsData(BaseModel):
             intonation = dict["voice"]["intonation"],
             volume = dict["voice"]["volume"],
             post = dict["voice"]["post"],
+            workers = dict["voice"].get("workers", VoiceSettings.__fields__["workers"].default),
         )
         
         return cls(
@@ -53,7 +57,8 @@ class SettingsData(BaseModel):
                 "temperature": self.completion.temperature,
                 "top_p": self.completion.top_p,
                 "presence_penalty": self.completion.presence_penalty,
-                "frequency_penalty": self.completion.frequency_penalty
+                "frequency_penalty": self.completion.frequency_penalty,
+                "candidates": self.completion.candidates
             },
             "voice": {
                 "speakerid": self.voice.speakerid,
@@ -61,7 +66,8 @@ class SettingsData(BaseModel):
                 "pitch": self.voice.pitch,
                 "intonation": self.voice.intonation,
                 "volume": self.voice.volume,
-                "post": self.voice.post
+                "post": self.voice.post,
+                "workers": self.voice.workers
             }
         }
 
@@ -150,6 +156,13 @@ class SettingsDialog(QtWidgets.QDialog):
         self.frequency_penalty_spinbox.setSingleStep(0.1)
         self.frequency_penalty_spinbox.setMinimumWidth(100)
         completion_layout.addRow("Frequency Penalty:", self.frequency_penalty_spinbox)
+
+        # candidates
+        self.candidates_spinbox = QtWidgets.QSpinBox(self)
+        self.candidates_spinbox.setRange(1, 5)
+        self.candidates_spinbox.setMinimumWidth(100)
+        self.candidates_spinbox.setToolTip(u'1回の送信で並列に生成する返答の数')
+        completion_layout.addRow("Candidates:", self.candidates_spinbox)
         
         # Voice Settings group
         voice_group = QtWidgets.QGroupBox("VOICEVOX")
@@ -195,6 +208,13 @@ class SettingsDialog(QtWidgets.QDialog):
         self.post_spinbox.setMinimumWidth(60)
         voice_layout.addRow("Post:", self.post_spinbox)
 
+        # workers
+        self.workers_spinbox = QtWidgets.QSpinBox(self)
+        self.workers_spinbox.setRange(1, 8)
+        self.workers_spinbox.setMinimumWidth(60)
+        self.workers_spinbox.setToolTip(u'並列で音声合成するリクエスト数')
+        voice_layout.addRow("Workers:", self.workers_spinbox)
+
         # Buttons
         buttons = QtWidgets.QDialogButtonBox(
             QtWidgets.QDialogButtonBox.Ok | QtWidgets.QDialogButtonBox.Cancel,
@@ -218,6 +238,7 @@ class SettingsDialog(QtWidgets.QDialog):
             self.top_p_spinbox.setValue(self._data.completion.top_p)
             self.presence_penalty_spinbox.setValue(self._data.completion.presence_penalty)
             self.frequency_penalty_spinbox.setValue(self._data.completion.frequency_penalty)
+            self.candidates_spinbox.setValue(self._data.completion.candidates)
 
             self.speakerid_spinbox.setValue(self._data.voice.speakerid)
             self.speed_spinbox.setValue(self._data.voice.speed)
@@ -225,6 +246,7 @@ class SettingsDialog(QtWidgets.QDialog):
             self.intonation_spinbox.setValue(self._data.voice.intonation)
             self.volume_spinbox.setValue(self._data.voice.volume)
             self.post_spinbox.setValue(self._data.voice.post)
+            self.workers_spinbox.setValue(self._data.voice.workers)
         except:
             pass
     
@@ -233,12 +255,14 @@ class SettingsDialog(QtWidgets.QDialog):
         self._data.completion.top_p = round(self.top_p_spinbox.value(), 2)
         self._data.completion.presence_penalty = round(self.presence_penalty_spinbox.value(), 2)
         self._data.completion.frequency_penalty = round(self.frequency_penalty_spinbox.value(), 2)
+        self._data.completion.candidates = self.candidates_spinbox.value()
         self._data.voice.speakerid = self.speakerid_spinbox.value()
         self._data.voice.speed = round(self.speed_spinbox.value(), 2)
         self._data.voice.pitch = round(self.pitch_spinbox.value(), 2)
         self._data.voice.intonation = round(self.intonation_spinbox.value(), 2)
         self._data.voice.volume = round(self.volume_spinbox.value(), 2)
         self._data.voice.post = round(self.post_spinbox.value(), 2)
+        self._data.voice.workers = self.workers_spinbox.value()
 
         self.accept() 
     
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+import re
+from typing import List, NamedTuple, Tuple
+
+SENTENCE_END_CHARS = "。！？:"
+FENCE = "```"
+
+SENTENCE = "sentence"
+CODE_START = "code_start"
+CODE_LINE = "code_line"
+CODE_END = "code_end"
+
+LANG_ALIASES = {
+    "py": "python",
+    "python": "python",
+    "python3": "python",
+    "mel": "mel",
+}
+
+class ParserEvent(NamedTuple):
+    kind :str
+    text :str = ""
+    lang :str = ""
+    index :int = -1
+    terminated :bool = True
+
+def normalize_lang(tag:str) -> str:
+    tag = tag.strip().lower()
+    return LANG_ALIASES.get(tag, tag)
+
+class StreamParser(object):
+    # ストリームの差分を受け取り、文章とコードブロックをイベントとして返す
+
+    def __init__(self, sentence_end_chars:str=SENTENCE_END_CHARS):
+        self.sentence_end_chars = sentence_end_chars
+        self.prose = ""
+        self.code_blocks :List[Tuple[str, str]] = []
+
+        self._line = ""         # フェンスか判定待ちの文字 or コード行
+        self._sentence = ""
+        self._in_code = False
+        self._in_fence_line = False
+        self._lang = ""
+        self._code_lines :List[str] = []
+        self._line_is_prose = False
+
+    def feed(self, delta:str) -> List[ParserEvent]:
+        events = []
+        for char in delta:
+            if self._in_code:
+                self._feed_code(char, events)
+            elif self._in_fence_line:
+                self._feed_fence_line(char, events)
+            else:
+                self._feed_prose(char, events)
+        return events
+
+    def close(self) -> List[ParserEvent]:
+        events = []
+        if self._in_fence_line:
+            self._open_block(self._line, events)
+            self._line = ""
+        if self._in_code:
+            if self._line:
+                self._add_code_line(self._line, events)
+                self._line = ""
+            self._close_block(events, terminated=False)
+        else:
+            self._flush_line_head(events)
+            self._emit_sentence(events)
+        return events
+
+    # prose
+    def _feed_prose(self, char:str, events:List[ParserEvent]):
+        # フェンスかどうか確定するまで保留する (行頭はインデントも含め、行の途中はバッククォートのみ)
+        candidate = self._line + char
+        head = candidate if self._line_is_prose else candidate.lstrip(" \t")
+        if FENCE.startswith(head):
+            self._line = candidate
+            if head == FENCE:
+                # "以下です: ```python" のように文の後に続くフェンスも開始とみなす
+                self._line = ""
+                self._in_fence_line = True
+                self._emit_sentence(events)
+            return
+        self._flush_line_head(events)
+        self._add_prose_char(char, events)
+
+    def _flush_line_head(self, events:List[ParserEvent]):
+        self._line_is_prose = True
+        head, self._line = self._line, ""
+        for c in head:
+            self._add_prose_char(c, events)
+
+    def _add_prose_char(self, char:str, events:List[ParserEvent]):
+        self.prose += char
+        if char == "\n":
+            self._emit_sentence(events)
+            self._line_is_prose = False
+            return
+        self._sentence += char
+        if char in self.sentence_end_chars:
+            self._emit_sentence(events)
+
+    def _emit_sentence(self, events:List[ParserEvent]):
+        sentence = self._sentence.strip()
+        self._sentence = ""
+        if sentence:
+            events.append(ParserEvent(SENTENCE, sentence))
+
+    # fence
+    def _feed_fence_line(self, char:str, events:List[ParserEvent]):
+        if char == "\n":
+            self._open_block(self._line, events)
+            self._line = ""
+            return
+        self._line += char
+
+    def _open_block(self, tag:str, events:List[ParserEvent]):
+        self._in_fence_line = False
+        self._in_code = True
+        self._lang = normalize_lang(tag)
+        self._code_lines = []
+        events.append(ParserEvent(CODE_START, lang=self._lang, index=len(self.code_blocks)))
+
+    # code
+    def _feed_code(self, char:str, events:List[ParserEvent]):
+        if char != "\n":
+            self._line += char
+            if self._line.strip() == FENCE:
+                self._line = ""
+                self._close_block(events)
+            return
+        self._add_code_line(self._line, events)
+        self._line = ""
+
+    def _add_code_line(self, line:str, events:List[ParserEvent]):
+        self._code_lines.append(line)
+        events.append(ParserEvent(CODE_LINE, line, self._lang, len(self.code_blocks)))
+
+    def _close_block(self, events:List[ParserEvent], terminated:bool=True):
+        code = "\n".join(self._code_lines).strip()
+        index = len(self.code_blocks)
+        self.code_blocks.append((self._lang, code))
+        events.append(ParserEvent(CODE_END, code, self._lang, index, terminated))
+        self._in_code = False
+        self._line_is_prose = True
+        self._code_lines = []
+
+    def comment(self) -> str:
+        comment = re.sub('[\r?\n]+', '\n', self.prose)
+        return comment.strip()
+
+def decompose(txt:str, script_type:str="python") -> Tuple[str, List[str]]:
+    parser = StreamParser()
+    parser.feed(txt)
+    parser.close()
+    code_list = [code for lang, code in parser.code_blocks if lang == script_type]
+    return parser.comment(), code_list
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+from pathlib import Path
+from typing import Dict, Optional
+
+TRACE_FILE = 'trace.json'
+
+# CHATMAYA_TRACE=1 で起動時から記録する (Settingsメニューからも切り替えられる)
+ENABLED = os.environ.get("CHATMAYA_TRACE") == "1"
+
+def trace_path(directory:Path) -> Path:
+    # 同じセッションで記録し直した場合は別のファイルにする
+    path = Path(directory) / TRACE_FILE
+    number = 2
+    while path.exists():
+        path = Path(directory) / "trace_{}.json".format(number)
+        number += 1
+    return path
+
+class Tracer(object):
+    # Chrome/Perfettoのトレース形式 (Trace Event Format) でスパンを記録する
+    # 記録はメモリに溜めるだけにし、flush()でファイルに追記する
+    # ファイルはJSON配列で、close()までは閉じ括弧が無い (トレースビューアはそのまま読める)
+
+    def __init__(self, enabled:bool=ENABLED):
+        self.enabled = enabled
+        self.path = None
+        self._pid = os.getpid()
+        self._origin = time.perf_counter()
+        self._events = deque()
+        self._threads = set()
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def timestamp(self, t:float=None) -> float:
+        # perf_counterの秒を記録開始からのμsにする
+        return round(((time.perf_counter() if t is None else t) - self._origin) * 1000000, 1)
+
+    def _add(self, event:Dict):
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self._events.append({'name': 'thread_name', 'ph': 'M', 'pid': self._pid, 'tid': tid,
+                                 'args': {'name': threading.current_thread().name}})
+        event['pid'] = self._pid
+        event['tid'] = tid
+        self._events.append(event)
+
+    def complete(self, name:str, start:float, end:float=None, cat:str='app', args:Dict=None):
+        # start/endはperf_counterの値
+        if not self.enabled:
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': self.timestamp(start),
+                 'dur': round(((time.perf_counter() if end is None else end) - start) * 1000000, 1)}
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    def instant(self, name:str, cat:str='app', args:Dict=None):
+        if not self.enabled:
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'i', 's': 't', 'ts': self.timestamp()}
+        if args:
+            event['args'] = args
+        self._add(event)
+
+    @contextmanager
+    def _span(self, name:str, cat:str, args:Optional[Dict]):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.complete(name, start, cat=cat, args=args)
+
+    def span(self, name:str, cat:str='app', args:Dict=None):
+        # 無効な場合は何もしないコンテキストを返す
+        if not self.enabled:
+            return nullcontext()
+        return self._span(name, cat, args)
+
+    def traced(self, name:str=None, cat:str='app'):
+        # 関数全体をスパンにするデコレータ
+        def decorator(func):
+            label = name or func.__name__
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                with self._span(label, cat, None):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def open(self, directory:Path):
+        # ファイルは最初のflushで作る (何も記録しなかったセッションには作らない)
+        self.close()
+        with self._lock:
+            self.path = trace_path(directory)
+            self._written = 0
+            self._threads.clear()
+            self._events.clear()
+
+    def flush(self):
+        with self._lock:
+            if self.path is None:
+                # 記録先を開いていない間のイベントは捨てる (メモリに溜め続けない)
+                self._events.clear()
+                return
+            if not self._events:
+                return
+            lines = []
+            while self._events:
+                lines.append(json.dumps(self._events.popleft(), ensure_ascii=False))
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(("[\n" if self._written == 0 else ",\n") + ",\n".join(lines))
+            self._written += len(lines)
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self.path is not None and self._written:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write("\n]\n")
+            self.path = None
+            self._written = 0
+
+# アプリ全体で1つ
+TRACER = Tracer()
@@ -1,74 +1,176 @@
 # -*- coding: utf-8 -*-
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+import io
+import os
 import json
-import requests
+import queue
+import threading
+import time
 import wave
-import pyaudio
 import re
-import alkana
+
+from .voice_cache import VoiceCache
+from .metrics import current_metrics, AUDIO_QUERY, SYNTHESIS, VOICE_CACHE_HITS, VOICE_ERRORS
+from .trace import TRACER
+
+# requests/pyaudio/alkanaは最初の読み上げ時にimportする
+if TYPE_CHECKING:
+    import requests
 
 CHUNK_SIZE = 1024
 BASE_URL = "http://127.0.0.1:50021"
+DEFAULT_WORKERS = 2
+MAX_WORKERS = 8
 
-def alkana_(text:str) -> str:
-    
-    pattern = r'[a-zA-Z]+'
-    words = re.findall(pattern, text)
-    
-    for w in words:
-        kana = alkana.get_kana(w)
-        if kana:
-            text = re.sub(w, kana, text)
+# 指定した場合のみ合成したwavをディスクにも書き出す (デバッグ用)
+DEBUG_DIR = os.environ.get("CHATMAYA_VOICE_DEBUG_DIR")
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> "requests.Session":
+    # VOICEVOXへの接続はKeep-Aliveで使い回す
+    import requests
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=MAX_WORKERS)
+            _session.mount("http://", adapter)
+        return _session
+
+def initialize_speaker(speaker:int=0, timeout:float=30):
+    # 話者のモデルを読み込ませておき、最初の合成が遅くならないようにする
+    session = get_session()
+    res = session.post(BASE_URL + "/initialize_speaker",
+                       params={"speaker": speaker, "skip_reinit": "true"}, timeout=timeout)
+    if res.status_code in (404, 405, 422):
+        # initialize_speakerの無い古いエンジンは短い文のaudio_queryで代用
+        res = session.post(BASE_URL + "/audio_query",
+                           params={"text": "あ", "speaker": speaker}, timeout=timeout)
+    res.raise_for_status()
+
+WORD_PATTERN = re.compile(r'[a-zA-Z]+')
+# camelCase/PascalCase/略語の区切り (polyCube -> poly, Cube / XMLFile -> XML, File)
+CAMEL_PATTERN = re.compile(r'[A-Z]+(?![a-z])|[A-Z]?[a-z]+')
+KANA_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=KANA_CACHE_SIZE)
+def get_kana(word:str) -> Optional[str]:
+    import alkana
+    return alkana.get_kana(word)
+
+@lru_cache(maxsize=KANA_CACHE_SIZE)
+def word_to_kana(word:str) -> str:
+    kana = get_kana(word)
+    if kana:
+        return kana
 
-    return text
+    # Mayaの識別子などは単語に分けて変換
+    parts = CAMEL_PATTERN.findall(word)
+    if len(parts) > 1:
+        return "".join(get_kana(part) or part for part in parts)
+    return word
 
+def alkana_(text:str) -> str:
+    # 英単語を1回の走査でカナに置き換える (単語の一部は置き換えない)
+    return WORD_PATTERN.sub(lambda m: word_to_kana(m.group(0)), text)
+
+@TRACER.traced(cat="voice")
 def text2voice(
     text:str, 
-    filename:str, 
-    path:Path, 
     speaker:int=0, 
     volume:float=1.0, 
     speed:float=1.0, 
     pitch:float=0.0, 
     intonation:float=1.0,
-    post:float=0.0
-) -> Path:
-
-    path = path.resolve()
-    path.mkdir(parents=True, exist_ok=True)
+    post:float=0.0,
+    debug_dir:Optional[Path]=None,
+    cache:Optional[VoiceCache]=None
+) -> Optional[bytes]:
 
     text = alkana_(text)
 
+    session = get_session()
+
     # audio_query
-    try:
-        res1 = requests.post(BASE_URL + "/audio_query",
-                        params={"text": text, "speaker": speaker})
-        res1.raise_for_status()
-    except Exception as e:
-        #print("Error :", e)
-        return
-    
-    res1 = res1.json()
-    res1["volumeScale"]=volume
-    res1["speedScale"]=speed
-    res1["pitchScale"]=pitch
-    res1["intonationScale"]=intonation
-    res1["postPhonemeLength"]=post
-    
+    query = None
+    if cache is not None:
+        query_key = cache.query_key(text, speaker)
+        query = cache.query.get(query_key)
+
+    if query is None:
+        start = time.perf_counter()
+        try:
+            res1 = session.post(BASE_URL + "/audio_query",
+                            params={"text": text, "speaker": speaker})
+            res1.raise_for_status()
+        except Exception as e:
+            #print("Error :", e)
+            current_metrics().inc(VOICE_ERRORS)
+            return
+        current_metrics().observe(AUDIO_QUERY, (time.perf_counter() - start) * 1000)
+        TRACER.complete("audio_query", start, cat="voice")
+        query = res1.content
+        if cache is not None:
+            cache.query.put(query_key, query)
+
     # synthesis
-    res2 = requests.post(BASE_URL + "/synthesis",
-                        params={"speaker": speaker},
-                        data=json.dumps(res1))
+    audio = None
+    if cache is not None:
+        audio_key = cache.audio_key(query, speaker, speed, pitch, intonation, volume, post)
+        audio = cache.audio.get(audio_key)
+
+    if audio is None:
+        res1 = json.loads(query)
+        res1["volumeScale"]=volume
+        res1["speedScale"]=speed
+        res1["pitchScale"]=pitch
+        res1["intonationScale"]=intonation
+        res1["postPhonemeLength"]=post
+
+        start = time.perf_counter()
+        try:
+            res2 = session.post(BASE_URL + "/synthesis",
+                            params={"speaker": speaker},
+                            data=json.dumps(res1))
+            res2.raise_for_status()
+        except Exception as e:
+            current_metrics().inc(VOICE_ERRORS)
+            return
+        current_metrics().observe(SYNTHESIS, (time.perf_counter() - start) * 1000)
+        TRACER.complete("synthesis", start, cat="voice")
+        audio = res2.content
+        if cache is not None:
+            cache.audio.put(audio_key, audio)
+    else:
+        current_metrics().inc(VOICE_CACHE_HITS)
     
-    audio_file = Path(path, filename + '.wav')
+    if debug_dir is None and DEBUG_DIR:
+        debug_dir = Path(DEBUG_DIR)
+    if debug_dir is not None:
+        dump_wave(audio, debug_dir)
+
+    return audio
+
+def dump_wave(data:bytes, path:Path) -> Path:
+    path = path.resolve()
+    path.mkdir(parents=True, exist_ok=True)
+    audio_file = Path(path, str(uuid4()) + '.wav')
     with open(audio_file, mode="wb") as f:
-        f.write(res2.content)
-    
+        f.write(data)
     return audio_file
 
-def play_wave(wav:Path, delete=False):
-    
-    with wave.open(str(wav), mode='r') as wf:
+@TRACER.traced(cat="voice")
+def play_wave(data:bytes):
+    import pyaudio
+
+    with wave.open(io.BytesIO(data), mode='rb') as wf:
 
         p = pyaudio.PyAudio()
         stream = p.open(format=p.get_format_from_width(wf.getsampwidth()),
@@ -85,5 +187,101 @@ def play_wave(wav:Path, delete=False):
         stream.close()
         p.terminate()
 
-    if delete:
-        wav.unlink()
\ No newline at end of file
+class ReorderBuffer(object):
+    # 合成が終わった順ではなく、投入された順に取り出すためのバッファ
+
+    def __init__(self):
+        self._items = {}
+        self._next = 0
+        self._cond = threading.Condition()
+
+    def put(self, seq:int, item):
+        with self._cond:
+            if seq < self._next:
+                # clear()より前に投入された文
+                return
+            self._items[seq] = item
+            self._cond.notify_all()
+
+    def is_stale(self, seq:int) -> bool:
+        with self._cond:
+            return seq < self._next
+
+    def clear(self, next_seq:int):
+        # next_seqより前の文を全て捨てる
+        with self._cond:
+            self._items.clear()
+            self._next = max(self._next, next_seq)
+            self._cond.notify_all()
+
+    def get(self, timeout:float=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                # 合成に失敗した文(None)は飛ばす
+                while self._next in self._items:
+                    item = self._items.pop(self._next)
+                    self._next += 1
+                    if item is not None:
+                        return item
+
+                if deadline is None:
+                    self._cond.wait()
+                    continue
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise queue.Empty
+                self._cond.wait(remaining)
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._items)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+class SynthesisPipeline(object):
+    # 複数ワーカーで並列に合成し、結果をReorderBufferに順番通りに並べる
+
+    def __init__(self, synthesize:Callable[[str], Optional[bytes]], workers:int=DEFAULT_WORKERS):
+        self.synthesize = synthesize
+        self.output = ReorderBuffer()
+        self.workers = 0
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._executor = None
+        self.set_workers(workers)
+
+    def set_workers(self, workers:int):
+        workers = max(1, min(int(workers), MAX_WORKERS))
+        if workers == self.workers:
+            return
+        old_executor = self._executor
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        if old_executor:
+            old_executor.shutdown(wait=False)
+
+    def submit(self, text:str) -> int:
+        with self._lock:
+            seq = self._seq
+            self._seq += 1
+            self._executor.submit(self._run, seq, text)
+        return seq
+
+    def clear(self):
+        # 合成待ち/合成中の文の結果を捨てる
+        with self._lock:
+            self.output.clear(self._seq)
+
+    def _run(self, seq:int, text:str):
+        if self.output.is_stale(seq):
+            return
+        try:
+            result = self.synthesize(text)
+        except Exception:
+            result = None
+        self.output.put(seq, result)
+
+    def shutdown(self, wait:bool=True):
+        self._executor.shutdown(wait=wait)
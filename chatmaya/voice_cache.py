@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import hashlib
+from pathlib import Path
+from typing import Dict
+
+from .disk_cache import DiskLRUCache, make_key
+
+QUERY_CACHE_BYTES = 16 * 1024 * 1024
+AUDIO_CACHE_BYTES = 256 * 1024 * 1024
+
+class VoiceCache(object):
+    # audio_queryの結果と合成済みの音声の2段キャッシュ
+
+    def __init__(self, directory:Path, query_bytes:int=QUERY_CACHE_BYTES, audio_bytes:int=AUDIO_CACHE_BYTES):
+        self.directory = Path(directory)
+        self.query = DiskLRUCache(self.directory / "query", query_bytes, ".json")
+        self.audio = DiskLRUCache(self.directory / "audio", audio_bytes, ".wav")
+
+    @staticmethod
+    def query_key(text:str, speaker:int) -> str:
+        return make_key(text, speaker)
+
+    @staticmethod
+    def audio_key(query:bytes, speaker:int, speed:float, pitch:float, intonation:float, volume:float, post:float) -> str:
+        query_hash = hashlib.sha1(query).hexdigest()
+        return make_key(query_hash, speaker, speed, pitch, intonation, volume, post)
+
+    def stats(self) -> Dict:
+        return {"query": self.query.stats(), "audio": self.audio.stats()}
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import threading
+from typing import Callable, Dict, List, Optional
+
+from PySide2 import QtCore
+
+from . import openai_utils, voice
+
+# CHATMAYA_WARMUP=0 の場合は行わない (初回送信の計測用)
+ENABLED = os.environ.get("CHATMAYA_WARMUP", "1") != "0"
+
+TOKENIZER = "tokenizer"
+API = "API"
+VOICEVOX = "VOICEVOX"
+
+class WarmUp(QtCore.QObject):
+    # 初回の送信で時間のかかる準備 (tokenizerの読み込み/APIへの接続/話者モデルの読み込み) を
+    # ウィンドウを開いた時にバックグラウンドで済ませておく
+
+    progress = QtCore.Signal(str)
+    finished = QtCore.Signal(str)
+
+    def __init__(self, speaker:int=0, model:str=openai_utils.DEFAULT_CHAT_MODEL, parent=None):
+        super(WarmUp, self).__init__(parent)
+        self.speaker = speaker
+        self.model = model
+        self.results = {} # name -> (秒数, エラー)
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._cancelled = threading.Event()
+
+    def steps(self) -> Dict[str, Callable]:
+        return {
+            TOKENIZER: self.warm_tokenizer,
+            API: openai_utils.preconnect,
+            VOICEVOX: self.warm_voice,
+        }
+
+    def warm_tokenizer(self):
+        # 送信時と同じ経路で呼び、キャッシュされるencoderを揃える
+        openai_utils.num_tokens_from_text("ChatMaya")
+        openai_utils.num_tokens_from_message({"role": "user", "content": "ChatMaya"}, self.model)
+
+    def warm_voice(self):
+        voice.alkana_("ChatMaya") # 英単語辞書の読み込み
+        voice.initialize_speaker(self.speaker)
+
+    def start(self, names:Optional[List[str]]=None):
+        steps = self.steps()
+        names = names or list(steps)
+        with self._lock:
+            self._pending += len(names)
+        self._notify(self.progress, "Warming up {}...".format(" / ".join(names)))
+        # 互いに待つ必要が無いので並列に行う
+        for name in names:
+            threading.Thread(target=self._run, args=(name, steps[name]), daemon=True).start()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def is_cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _run(self, name:str, step:Callable):
+        error = None
+        start = time.perf_counter()
+        if not self.is_cancelled():
+            try:
+                step()
+            except Exception as e:
+                error = e
+        seconds = time.perf_counter() - start
+
+        with self._lock:
+            self.results[name] = (seconds, error)
+            self._pending -= 1
+            done = self._pending == 0
+        if done:
+            self._notify(self.finished, self.summary())
+
+    def summary(self) -> str:
+        items = []
+        for name, (seconds, error) in self.results.items():
+            if error is None:
+                items.append("{} {:.2f}s".format(name, seconds))
+            else:
+                items.append("{}: unavailable".format(name))
+        return "Ready. ({})".format(" / ".join(items))
+
+    def _notify(self, signal, message:str):
+        if self.is_cancelled():
+            return
+        try:
+            signal.emit(message)
+        except RuntimeError:
+            # ウィンドウが閉じられた後
+            pass